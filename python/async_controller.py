@@ -0,0 +1,537 @@
+"""
+asyncio facade for the Controller.
+
+AsyncController lets one event loop drive the teensy alongside other coroutines (camera trigger, SpikeGLX
+control, a live dashboard, ...) without a thread per device:
+
+    async def experiment(controller):
+        ctrl = AsyncController(controller)
+        await ctrl.start_recording()
+        await ctrl.present_gas("hypoxia", presentation_time=10)
+        await ctrl.run_train(duration_sec=2, freq=10, amp=0.5, pulse_duration_sec=0.01)
+        await ctrl.wait(5)
+        await ctrl.stop_recording()
+        ctrl.close()
+
+    asyncio.run(experiment(Controller("/dev/ttyACM0")))
+
+On POSIX the serial port's file descriptor is registered with `loop.add_reader`, so replies are read
+when the driver reports data and the awaiting coroutine wakes up immediately. Where the port has no selectable
+file descriptor (e.g. COM ports on Windows), the Controller's serial I/O thread is kept and its futures are
+awaited instead.
+
+Entries are appended to the wrapped Controller's log and journal, so save_log, plot_log, etc. work as usual.
+stop_recording writes the log table, as the Controller's does.
+"""
+
+import asyncio
+import collections
+
+from commands import MAX_FRAME_BYTES
+from serial_io import (
+    ACK,
+    DRAIN_ONLY,
+    IDLE,
+    REPLY_HEADER_BYTES,
+    AckTimeoutError,
+    ProtocolError,
+    Reply,
+    ReplyParser,
+    _Request,
+    oldest_pending,
+    record_desync,
+    resolve_reply,
+)
+from nebPod import sec2ms
+
+
+class AsyncSerialIO:
+    """
+    Runs submitted commands on an event loop, reading the port with `loop.add_reader`.
+
+    Same interface as SerialIOThread, but submit returns an asyncio.Future. Commands are sent and acknowledged
+    strictly one at a time, in the order they were submitted.
+
+    Attributes:
+        serial_object (Transport): The transport to the teensy (see transports.py).
+        last_future (asyncio.Future): Future of the most recently submitted request.
+        desync_bytes (collections.Counter): Stale bytes discarded, by command name.
+    """
+
+    def __init__(self, serial_object, loop, desync_bytes=None):
+        """
+        Args:
+            serial_object (Transport): The transport to the teensy (see transports.py). Must have a selectable fileno().
+            loop (asyncio.AbstractEventLoop): The loop to run on.
+            desync_bytes (collections.Counter, optional): Counter to add discarded bytes to. Defaults to a new one.
+
+        Raises:
+            NotImplementedError: If the loop cannot watch the port's file descriptor.
+        """
+        self.serial_object = serial_object
+        self.loop = loop
+        self.last_future = None
+        self.desync_bytes = desync_bytes if desync_bytes is not None else collections.Counter()
+        self._requests = collections.deque()
+        self._current = None
+        self._deadline = None
+        self._rx = bytearray()
+        self._tx_buffer = bytearray(MAX_FRAME_BYTES)
+        self._tx_view = memoryview(self._tx_buffer)
+        self._saved_timeout = serial_object.timeout
+        self._fd = serial_object.fileno()
+        loop.add_reader(self._fd, self._on_readable)
+        serial_object.timeout = 0  # Reads only return what the driver already has
+
+    def submit(self, command, values, timeout, drain=False):
+        """
+        Queue a command.
+
+        Args:
+            command (Command): Entry from a command table.
+            values (list): Field values already checked by command.values().
+            timeout (float): Seconds to wait for the acknowledgement once the command has been sent.
+            drain (bool, optional): Discard stale bytes from the input buffer before sending. Defaults to False.
+
+        Returns:
+            asyncio.Future: Resolves to a Reply, or raises AckTimeoutError.
+        """
+        request = _Request(command, values, timeout, drain, self.loop.create_future())
+        self.last_future = request.future
+        self._requests.append(request)
+        if self._current is None:
+            self._start_next()
+        return request.future
+
+    def drain(self):
+        """
+        Queue a request that only discards stale bytes from the input buffer.
+
+        Returns:
+            asyncio.Future: Resolves to the number of bytes discarded.
+        """
+        return self.submit(None, None, 0.0, drain=True)
+
+    def stop(self):
+        """
+        Stop watching the port and restore its timeout. Requests that have not been acknowledged are cancelled.
+        """
+        self.loop.remove_reader(self._fd)
+        if self._deadline is not None:
+            self._deadline.cancel()
+        for request in [self._current, *self._requests]:
+            if request is not None and not request.future.done():
+                request.future.cancel()
+        self._current = None
+        self._requests.clear()
+        self.serial_object.timeout = self._saved_timeout
+
+    def _start_next(self):
+        while self._requests:
+            request = self._requests.popleft()
+            if request.future.cancelled():
+                continue
+            try:
+                n_drained = self._drain(request) if request.drain else 0
+                if request.command is None:
+                    request.future.set_result(n_drained)
+                    continue
+                n_bytes = request.command.pack_values_into(self._tx_buffer, request.values)
+                self.serial_object.write(self._tx_view[:n_bytes])
+            except Exception as e:
+                request.future.set_exception(e)
+                continue
+            self._current = request
+            self._deadline = self.loop.call_later(request.timeout, self._on_timeout)
+            self._parse_reply()
+            return
+
+    def _drain(self, request):
+        self._read_available()
+        n_bytes = len(self._rx)
+        if n_bytes:
+            name = request.command.name if request.command is not None else DRAIN_ONLY
+            record_desync(self.desync_bytes, name, bytes(self._rx))
+        self._rx.clear()
+        return n_bytes
+
+    def _read_available(self):
+        n_waiting = self.serial_object.in_waiting
+        if n_waiting > 0:
+            self._rx += self.serial_object.read(n_waiting)
+
+    def _on_readable(self):
+        try:
+            self._read_available()
+        except Exception as e:
+            if self._current is not None:
+                self._finish(exception=e)
+            return
+        self._parse_reply()
+
+    def _parse_reply(self):
+        """
+        Resolve the current request once its payload and acknowledgement byte have arrived.
+        """
+        request = self._current
+        if request is None:
+            return
+        n_payload = request.command.reply_bytes
+        ack_index = self._rx.find(ACK, n_payload)
+        if ack_index < 0:
+            return
+        reply = Reply(
+            request.command.name, bytes(self._rx[:n_payload]), bytes(self._rx[n_payload:ack_index])
+        )
+        del self._rx[: ack_index + 1]
+        self._finish(result=reply)
+
+    def _on_timeout(self):
+        request = self._current
+        self._finish(
+            exception=AckTimeoutError(
+                f"{request.command.name}: teensy did not reply within {request.timeout:.1f}s "
+                f"(got {len(self._rx)} bytes without an acknowledgement)"
+            )
+        )
+
+    def _finish(self, result=None, exception=None):
+        request = self._current
+        self._current = None
+        self._deadline.cancel()
+        self._deadline = None
+        if not request.future.done():
+            if exception is not None:
+                request.future.set_exception(exception)
+            else:
+                request.future.set_result(result)
+        self._start_next()
+
+
+class AsyncPipelinedIO(AsyncSerialIO):
+    """
+    Protocol v2 version of AsyncSerialIO. Frames are written as soon as they are submitted and replies are
+    matched to commands by sequence id.
+    """
+
+    def __init__(self, serial_object, loop, desync_bytes=None):
+        super().__init__(serial_object, loop, desync_bytes)
+        self.parser = ReplyParser()
+        self._pending = {}
+        self._next_seq = 0
+        self._busy_until = 0.0
+        self._n_skipped_drained = 0
+
+    def submit(self, command, values, timeout, drain=False):
+        """
+        Write a command frame. See PipelinedSerialIO.submit.
+
+        Returns:
+            asyncio.Future: Resolves to a Reply, or raises AckTimeoutError or ProtocolError.
+        """
+        request = _Request(command, values, timeout, drain, self.loop.create_future())
+        self.last_future = request.future
+        seq = self._next_seq
+        if seq in self._pending:
+            request.future.set_exception(ProtocolError("256 commands are already in flight"))
+            return request.future
+        self._next_seq = (seq + 1) % 256
+        self._busy_until = max(self.loop.time(), self._busy_until) + timeout
+        try:
+            n_bytes = command.pack_frame_into(self._tx_buffer, values, seq)
+            self.serial_object.write(self._tx_view[:n_bytes])
+        except Exception as e:
+            request.future.set_exception(e)
+            return request.future
+        request.deadline = self.loop.call_at(self._busy_until, self._on_timeout, seq)
+        self._pending[seq] = request
+        return request.future
+
+    def drain(self):
+        """
+        Stray bytes are already skipped by the reply parser.
+
+        Returns:
+            asyncio.Future: Resolves to the number of stray bytes skipped since the last drain.
+        """
+        future = self.loop.create_future()
+        future.set_result(self.parser.skipped_bytes - self._n_skipped_drained)
+        self._n_skipped_drained = self.parser.skipped_bytes
+        return future
+
+    def stop(self):
+        self.loop.remove_reader(self._fd)
+        for request in self._pending.values():
+            request.deadline.cancel()
+            if not request.future.done():
+                request.future.cancel()
+        self._pending.clear()
+        self.serial_object.timeout = self._saved_timeout
+
+    def _on_readable(self):
+        try:
+            n_waiting = self.serial_object.in_waiting
+            data = self.serial_object.read(n_waiting) if n_waiting > 0 else b""
+        except Exception as e:
+            for request in self._pending.values():
+                request.deadline.cancel()
+                if not request.future.done():
+                    request.future.set_exception(e)
+            self._pending.clear()
+            return
+        awaited = oldest_pending(self._pending)
+        replies = self.parser.feed(data)
+        for seq, index, onset_us in self.parser.last_records:
+            if seq in self._pending:
+                self._pending[seq].records.append((index, onset_us, None))
+        for seq, status, payload, onset_us in replies:
+            request = self._pending.pop(seq, None)
+            if request is None:
+                # Reply to a command that already timed out
+                self.desync_bytes[IDLE] += REPLY_HEADER_BYTES + len(payload)
+                continue
+            request.deadline.cancel()
+            resolve_reply(request, seq, status, payload, onset_us)
+        if self.parser.last_skipped:
+            record_desync(self.desync_bytes, awaited, self.parser.last_skipped)
+
+    def _on_timeout(self, seq):
+        request = self._pending.pop(seq)
+        if not request.future.done():
+            request.future.set_exception(
+                AckTimeoutError(f"{request.command.name}: teensy did not reply within {request.timeout:.1f}s")
+            )
+
+
+class AsyncController:
+    """
+    Awaitable versions of the Controller's core methods, sharing its serial port, gas map and log.
+
+    Must be created from a coroutine running on the event loop that will drive it. Until `close` is called,
+    use the AsyncController for anything that talks to the teensy, not the wrapped Controller.
+
+    Attributes:
+        controller (Controller): The wrapped controller.
+        uses_reader (bool): True if the port is read with loop.add_reader, False if the I/O thread is used.
+    """
+
+    def __init__(self, controller):
+        """
+        Args:
+            controller (Controller): A connected Controller.
+        """
+        self.controller = controller
+        self.loop = asyncio.get_running_loop()
+        serial_object = controller.serial_port
+        try:
+            serial_object.fileno()
+            controller.block_until_read()
+            controller._io.stop()
+            if controller.protocol_version >= 2:
+                self._io = AsyncPipelinedIO(serial_object, self.loop, controller.desync_bytes)
+            else:
+                self._io = AsyncSerialIO(serial_object, self.loop, controller.desync_bytes)
+            self.uses_reader = True
+        except (AttributeError, NotImplementedError, OSError):
+            if not controller._io.is_alive():
+                controller._start_io()
+            self._io = None
+            self.uses_reader = False
+
+    def close(self):
+        """
+        Hand the serial port back to the wrapped Controller.
+        """
+        if self._io is None:
+            return
+        self._io.stop()
+        self._io = None
+        self.controller._start_io()
+
+    def submit(self, name, expected_sec=0.0, timeout=None, drain=False, **fields):
+        """
+        Queue a command without logging it. See Controller.submit.
+
+        Either way the command is recorded in the Controller's device journal and timed by its timing monitor.
+        When the event loop owns the port, a dropped link is not recovered here: the command fails, and the
+        Controller's supervisor restores the journalled state on its next command once the port is handed back
+        (see close).
+
+        Returns:
+            asyncio.Future: Resolves to the teensy's Reply, or raises AckTimeoutError.
+        """
+        if self._io is None:
+            return asyncio.wrap_future(
+                self.controller.submit(name, expected_sec, timeout, drain=drain, **fields)
+            )
+        future, _ = self.controller._submit_to(self._io, name, expected_sec, timeout, drain, fields)
+        return future
+
+    async def block_until_read(self):
+        """
+        Wait until every command submitted so far has been acknowledged.
+        """
+        last_future = self._io.last_future if self._io is not None else None
+        if last_future is not None:
+            await last_future
+        elif self._io is None:
+            self.controller.block_until_read()
+
+    def _log(self, label, category, start_time, end_time, params, log_enabled):
+        output = dict(
+            label=label, category=category, start_time=start_time, end_time=end_time, **params
+        )
+        if log_enabled:
+            self.controller._append_log(output)
+            # Commands the timing monitor flagged since the last entry, as the Controller's logger does
+            for flag in self.controller.timing.pop_flags():
+                self.controller._append_log(flag)
+        return output
+
+    async def wait(self, wait_time_sec, msg=None, verbose=False):
+        """
+        Pause the coroutine for a predetermined amount of time. Other tasks on the loop keep running.
+
+        Args:
+            wait_time_sec (float): Wait time in seconds.
+            msg (str, optional): Message to print if verbose. Defaults to None.
+            verbose (bool, optional): Verbosity flag. Defaults to False.
+
+        Returns:
+            dict: Output dictionary with the requested and elapsed durations.
+        """
+        print(msg or f"Waiting {wait_time_sec}s") if verbose else None
+        start_time = self.controller.clock.now()
+        await asyncio.sleep(wait_time_sec)
+        end_time = self.controller.clock.now()
+        params = {"duration": wait_time_sec, "elapsed": end_time - start_time}
+        return self._log("wait", "event", start_time, end_time, params, log_enabled=False)
+
+    async def open_valve(self, valve_number, log_style=None, log_enabled=True):
+        """
+        Open a valve by its pin number on the teensy. Closes all other valves. See Controller.open_valve.
+        """
+        start_time = self.controller.clock.now()
+        await self.submit("open_valve", valve=valve_number)
+        if log_style == "gas":
+            label = f"{self.controller.gas_map[valve_number]}"
+        else:
+            label = f"open_valve_{int(valve_number)}"
+        return self._log(label, "gas", start_time, float("nan"), {}, log_enabled)
+
+    async def present_gas(self, gas, presentation_time=None, verbose=False, log_enabled=True):
+        """
+        Open the valve of a gas, then wait for the presentation time. See Controller.present_gas.
+
+        Args:
+            gas (str): Gas name, must be a value in gas_map.
+            presentation_time (float, optional): Presentation time in seconds. Defaults to None.
+            verbose (bool, optional): Verbosity flag. Defaults to False.
+
+        Returns:
+            dict: Output dictionary with function call details.
+        """
+        gas_map = self.controller.gas_map
+        assert gas in gas_map.values(), (
+            f"requested gas is not available. Must be :{gas_map.values()}"
+        )
+        inv_map = {v: k for k, v in gas_map.items()}
+
+        start_time = self.controller.clock.now()
+        print(f"Presenting {gas}") if verbose else None
+        await self.open_valve(inv_map[gas], log_enabled=False)
+        if presentation_time is not None:
+            await self.wait(presentation_time)
+        return self._log(f"present_{gas}", "gas", start_time, float("nan"), {}, log_enabled)
+
+    async def run_train(
+        self, duration_sec, freq, amp, pulse_duration_sec, verbose=False, log_enabled=True
+    ):
+        """
+        Run a single train of opto pulses. See Controller.run_train.
+
+        Args:
+            duration_sec (float): Full train duration in seconds.
+            freq (float): Stimulation frequency in Hz.
+            amp (float): Amplitude of the stimulation (0-1).
+            pulse_duration_sec (float): Pulse duration in seconds.
+            verbose (bool, optional): Verbosity flag. Defaults to False.
+
+        Returns:
+            dict: Output dictionary with function call details.
+        """
+        duration = sec2ms(duration_sec)
+        pulse_duration = sec2ms(pulse_duration_sec)
+        print(
+            f"Running opto train:\n\tAmplitude:{amp:.2f}V\n\tFrequency:{freq:.1f}Hz\n\tPulse duration:{pulse_duration}ms\n\tTrain duration:{duration_sec:.3f}s"
+        ) if verbose else None
+        amp_int = self.controller._amp2int(amp)
+
+        start_time = self.controller.clock.now()
+        await self.submit(
+            "run_train",
+            expected_sec=duration_sec,
+            drain=True,
+            duration=duration,
+            freq=freq,
+            amp=amp_int,
+            pulse_duration=pulse_duration,
+        )
+        end_time = self.controller.clock.now()
+
+        params_out = dict(
+            amplitude=amp,
+            duration=duration_sec,
+            frequency=freq,
+            pulse_duration=pulse_duration_sec,
+        )
+        return self._log("opto_train", "opto", start_time, end_time, params_out, log_enabled)
+
+    async def start_recording(self, increment_gate=True, verbose=True, log_enabled=True):
+        """
+        Start a recording using either the spikeglx api or the TTL method. See Controller.start_recording.
+
+        Returns:
+            dict: Output dictionary with function call details.
+        """
+        controller = self.controller
+        start_time = self.controller.clock.now()
+        if controller.record_control == "sglx":
+            controller.start_recording_sglx(increment_gate=increment_gate)
+        elif controller.record_control == "ttl":
+            if increment_gate:
+                print("incrementing gate flag is not valid in TTL mode, ignoring")
+            await self.submit("start_recording_ttl", drain=True)
+        else:
+            raise ValueError("record_control must be sglx or ttl")
+        print(
+            "=" * 50 + f"\nStarting recording via {controller.record_control}!\n" + "=" * 50
+        ) if verbose else None
+        controller.rec_start_time = controller.clock.now()
+        controller._journal_meta()
+        return self._log("rec_start", "event", start_time, float("nan"), {}, log_enabled)
+
+    async def stop_recording(self, verbose=True, log_enabled=True):
+        """
+        Stop a recording using either the spikeglx api or the TTL method, then flush the journal and write the log
+        table. See Controller.stop_recording.
+
+        Returns:
+            dict: Output dictionary with function call details.
+        """
+        controller = self.controller
+        start_time = self.controller.clock.now()
+        if controller.record_control == "sglx":
+            controller.stop_recording_sglx()
+        elif controller.record_control == "ttl":
+            await self.submit("stop_recording_ttl", drain=True)
+        else:
+            raise ValueError("record_control must be sglx or ttl")
+        print(
+            "=" * 50 + f"\nStopping recording via {controller.record_control}!\n" + "=" * 50
+        ) if verbose else None
+        controller.rec_stop_time = controller.clock.now()
+        output = self._log("rec_stop", "event", start_time, float("nan"), {}, log_enabled)
+        controller.flush_log()
+        controller.save_log()
+        return output
@@ -0,0 +1,64 @@
+"""
+Benchmark the host CPU used while waiting for the teensy to acknowledge a firmware-timed command.
+
+Runs opto trains against the pty-backed TeensySimulator and compares the process CPU time of the
+legacy busy-spin acknowledgement wait with the blocking read done by the Controller's I/O thread.
+
+Usage (Linux):
+    cd /path/to/nebPod/python
+    python benchmarks/bench_ack_wait.py
+"""
+import os
+import sys
+import time
+from pathlib import Path
+
+sys.path.append(str(Path(__file__).parent.parent))
+os.environ.setdefault("QT_QPA_PLATFORM", "offscreen")
+
+from commands import COMMANDS
+from nebPod import Controller
+from teensy_sim import TeensySimulator
+
+TRAIN_SEC = 2.0
+N_TRAINS = 3
+
+
+TRAIN = dict(duration=int(TRAIN_SEC * 1000), freq=10, amp=50, pulse_duration=10)
+
+
+def spin_train(controller):
+    # The write and acknowledgement wait that block_until_read used to do. The I/O thread is idle
+    # between requests, so the port can be used directly here.
+    controller.serial_port.write(COMMANDS["run_train"].pack(**TRAIN))
+    while True:
+        if controller.serial_port.in_waiting > 0:
+            controller.serial_port.read(1)
+            break
+
+
+def blocking_train(controller):
+    controller.submit("run_train", expected_sec=TRAIN_SEC, **TRAIN).result()
+
+
+def measure(controller, run):
+    cpu_start = time.process_time()
+    wall_start = time.perf_counter()
+    for _ in range(N_TRAINS):
+        run(controller)
+    wall = time.perf_counter() - wall_start
+    cpu = time.process_time() - cpu_start
+    return cpu, wall
+
+
+def main():
+    with TeensySimulator(protocol_version=1) as sim:
+        controller = Controller(f"serial://{sim.port}")
+        print(f"{N_TRAINS} x {TRAIN_SEC:.1f}s trains against {sim.port}")
+        for name, run in [("busy-spin", spin_train), ("submit().result()", blocking_train)]:
+            cpu, wall = measure(controller, run)
+            print(f"{name:>18}: wall {wall:6.2f}s  cpu {cpu:6.3f}s  ({100 * cpu / wall:5.1f}% of a core)")
+
+
+if __name__ == "__main__":
+    main()
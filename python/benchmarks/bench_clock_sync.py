@@ -0,0 +1,118 @@
+"""
+Check the device onset times in the log against the simulator's true onsets, with a known drift and latency.
+
+The simulated teensy's micros() drifts against the host clock and starts close to its wrap. Every command
+reaches it after a latency, and every reply comes back after the same latency plus jitter. Opto pulses are
+logged for a while with clock pings in between, then for every pulse the error of the logged host start_time
+(taken before the serial round trip) and of the corrected device_onset_time are compared.
+
+Jitter only on the replies makes the link asymmetric, and the onset times keep a bias of about half the mean
+jitter: the part of the error clock pings cannot see.
+
+Fails if the estimated drift is off by more than --max-ppm-error, if a pulse has no device_onset_time, or if the
+device onset times are off by more than --max-onset-error-ms on average or --max-abs-onset-error-ms at most.
+
+Usage:
+    cd /path/to/nebPod/python
+    python benchmarks/bench_clock_sync.py [--drift-ppm 50] [--latency-ms 1] [--jitter-ms 0.5] [--duration 30]
+        [--max-ppm-error 10] [--max-onset-error-ms 1] [--max-abs-onset-error-ms 2]
+"""
+import argparse
+import os
+import sys
+import time
+from pathlib import Path
+
+import numpy as np
+
+sys.path.append(str(Path(__file__).parent.parent))
+os.environ.setdefault("QT_QPA_PLATFORM", "offscreen")
+
+from nebPod import Controller
+from teensy_sim import TeensySimulator
+
+PULSE_INTERVAL_SEC = 0.2
+
+
+def true_onset_times(sim, clock):
+    """
+    Host clock times of the simulator's pulse onsets.
+    """
+    anchor = clock.anchor()
+    return np.array(
+        [
+            (anchor["anchor_wall_ns"] + onset_ns - anchor["anchor_monotonic_ns"]) / 1e9
+            for command, onset_ns in sim.onsets
+            if command == "p"
+        ]
+    )
+
+
+def describe(name, errors_sec):
+    errors_ms = 1e3 * errors_sec
+    print(
+        f"{name:>18}: mean {errors_ms.mean():7.3f}ms  sd {errors_ms.std():6.3f}ms  "
+        f"max abs {np.abs(errors_ms).max():6.3f}ms"
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--drift-ppm", type=float, default=50.0)
+    parser.add_argument("--latency-ms", type=float, default=1.0)
+    parser.add_argument("--jitter-ms", type=float, default=0.5)
+    parser.add_argument("--duration", type=float, default=30.0, help="Seconds of pulses")
+    parser.add_argument("--max-ppm-error", type=float, default=10.0)
+    parser.add_argument("--max-onset-error-ms", type=float, default=1.0, help="On the mean device onset error")
+    parser.add_argument("--max-abs-onset-error-ms", type=float, default=2.0)
+    args = parser.parse_args()
+
+    sim = TeensySimulator(
+        loopback=True,
+        drift_ppm=args.drift_ppm,
+        micros_at_start=2**32 - int(args.duration / 2 * 1e6),
+        latency_sec=args.latency_ms / 1000,
+        latency_jitter_sec=args.jitter_ms / 1000,
+        request_latency_sec=args.latency_ms / 1000,
+    ).start()
+    controller = Controller(None, transport=sim.transport, record_control="ttl")
+    controller.clock_ping_interval_sec = 1.0
+    n_pulses = int(args.duration / PULSE_INTERVAL_SEC)
+    for _ in range(n_pulses):
+        controller.run_pulse(0.01, 0.5)
+        time.sleep(PULSE_INTERVAL_SEC)
+
+    entries = [entry for entry in controller.log if entry["label"] == "opto_pulse"]
+    true_onsets = true_onset_times(sim, controller.clock)[-len(entries):]
+    start_times = np.array([entry["start_time"] for entry in entries])
+    onset_times = np.array([entry.get("device_onset_time", np.nan) for entry in entries])
+    summary = controller.clock_sync.summary()
+    print(
+        f"Injected drift {args.drift_ppm:.1f}ppm, estimated {summary['drift_ppm']:.1f}ppm from "
+        f"{summary['n_pings']} pings ({summary['n_rejected']} rejected). micros() wrapped halfway through.\n"
+        f"Latency {args.latency_ms}ms each way, + up to {args.jitter_ms}ms on replies: expected bias about "
+        f"{args.jitter_ms / 4:.3f}ms\n"
+    )
+    synced = ~np.isnan(onset_times)
+    describe("host start_time", start_times - true_onsets)
+    onset_errors_ms = 1e3 * (onset_times[synced] - true_onsets[synced])
+    describe("device_onset_time", onset_errors_ms / 1e3)
+    controller.disconnect()
+    sim.stop()
+
+    failures = []
+    if abs(summary["drift_ppm"] - args.drift_ppm) > args.max_ppm_error:
+        failures.append(f"estimated drift is off by {summary['drift_ppm'] - args.drift_ppm:.1f}ppm")
+    if not synced.all():
+        failures.append(f"{(~synced).sum()} of {len(synced)} pulses have no device_onset_time")
+    if abs(onset_errors_ms.mean()) > args.max_onset_error_ms:
+        failures.append(f"device onset times are off by {onset_errors_ms.mean():.3f}ms on average")
+    if np.abs(onset_errors_ms).max() > args.max_abs_onset_error_ms:
+        failures.append(f"a device onset time is off by {np.abs(onset_errors_ms).max():.3f}ms")
+    if failures:
+        raise SystemExit("FAIL: " + "; ".join(failures))
+    print("OK")
+
+
+if __name__ == "__main__":
+    main()
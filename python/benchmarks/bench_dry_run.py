@@ -0,0 +1,77 @@
+"""
+Dry run the example protocol twice from the same start and check that the log tables are identical, byte for byte.
+
+Each dry run runs in its own process, as `python dry_run.py <protocol> --start-sec <start>` would, with its own data
+directory. The runs take a fraction of a second each, for over an hour of experiment. Exits with an error if the
+tables differ, and prints the first lines that do.
+
+Usage:
+    cd /path/to/nebPod/python
+    python benchmarks/bench_dry_run.py [--protocol examples/tac_calca_protocol.yaml] [--start-sec 1.7e9] [--runs 2]
+"""
+import argparse
+import difflib
+import os
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+PYTHON_DIR = Path(__file__).parent.parent
+
+
+def dry_run(protocol, start_sec, data_dir):
+    """
+    Run one dry run in a new process.
+
+    Returns:
+        tuple: (path of the log table, wall time in seconds)
+    """
+    env = dict(os.environ, QT_QPA_PLATFORM=os.environ.get("QT_QPA_PLATFORM", "offscreen"))
+    start = time.perf_counter()
+    completed = subprocess.run(
+        [sys.executable, "dry_run.py", str(protocol), "--start-sec", str(start_sec), "--data-dir", str(data_dir)],
+        cwd=PYTHON_DIR,
+        env=env,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.PIPE,
+        text=True,
+    )
+    if completed.returncode != 0:
+        print(completed.stderr[-2000:])
+        raise SystemExit(f"Dry run of {protocol} failed")
+    real_sec = time.perf_counter() - start
+    log_fns = sorted(Path(data_dir).rglob("_cibbrig_log.table.*.tsv"))
+    if len(log_fns) != 1:
+        raise SystemExit(f"Expected one log table in {data_dir}, found {len(log_fns)}")
+    return log_fns[0], real_sec
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--protocol", type=Path, default=Path("examples/tac_calca_protocol.yaml"))
+    parser.add_argument("--start-sec", type=float, default=1.7e9)
+    parser.add_argument("--runs", type=int, default=2)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory(prefix="bench_dry_run_") as tmp_dir:
+        tables = []
+        for ii in range(args.runs):
+            log_fn, real_sec = dry_run(args.protocol, args.start_sec, Path(tmp_dir).joinpath(f"run{ii}"))
+            tables.append(log_fn.read_bytes())
+            print(f"run {ii}: {len(tables[-1].splitlines()) - 1} log rows in {real_sec:.2f}s")
+
+        different = [ii for ii in range(1, len(tables)) if tables[ii] != tables[0]]
+        for ii in different:
+            diff = difflib.unified_diff(
+                tables[0].decode().splitlines(), tables[ii].decode().splitlines(), "run 0", f"run {ii}", lineterm=""
+            )
+            print("\n".join(list(diff)[:20]))
+    if different:
+        raise SystemExit(f"FAIL: runs {different} wrote a different log table than run 0")
+    print(f"OK: {args.runs} dry runs from start {args.start_sec} wrote identical log tables")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,97 @@
+"""
+Benchmark the cost of logging one event against the length of the log.
+
+Compares appending to the log journal (what @logger does) with rebuilding and rewriting the whole TSV table on
+every entry (what @logger used to do by calling save_log). The journal's cost per event stays flat, the
+table's grows with the log.
+
+Also compares fsyncing every entry inside the logging call with handing it to the LogWriter thread under a
+policy that fsyncs every entry: with the writer thread the stimulus path does not wait for the disk. Last, compares
+the Controller's default write-ahead policy, which waits for every entry to be flushed, with batched flushes.
+
+Usage:
+    cd /path/to/nebPod/python
+    python benchmarks/bench_log.py
+"""
+import os
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+sys.path.append(str(Path(__file__).parent.parent))
+os.environ.setdefault("QT_QPA_PLATFORM", "offscreen")
+
+from log_journal import DurabilityPolicy, LogJournal
+from nebPod import Controller
+from teensy_sim import TeensySimulator
+
+LOG_LENGTHS = [100, 1000, 5000, 10000]
+N_TIMED = 50
+ENTRY = dict(label="opto_pulse", category="opto", start_time=0.0, end_time=0.0, amplitude=0.5, duration=0.01)
+
+
+def fill(controller, n_entries):
+    while len(controller.log) < n_entries:
+        entry = controller.make_log_entry("opto_pulse", "opto", amplitude=0.5, duration=0.01, log_enabled=False)
+        controller._append_log(entry)
+
+
+def per_event_sec(controller, rewrite_table):
+    start = time.perf_counter()
+    for _ in range(N_TIMED):
+        controller.make_log_entry("opto_pulse", "opto", amplitude=0.5, duration=0.01)
+        if rewrite_table:
+            controller.save_log(verbose=False)
+    return (time.perf_counter() - start) / N_TIMED
+
+
+def open_controller(sim, log_policy=None):
+    controller = Controller(None, transport=sim.transport, log_policy=log_policy)
+    controller.gate_dest = Path(tempfile.mkdtemp())
+    controller.log_filename = "_cibbrig_log.table.bench.g0.t0.tsv"
+    controller.odormap_filename = "_cibbrig_odors.map.bench.g0.t0.json"
+    controller._open_log_journal()
+    return controller
+
+
+def main():
+    with TeensySimulator(loopback=True) as sim:
+        controller = open_controller(sim)
+        print(f"{'entries':>8} {'journal':>10} {'rewrite tsv':>12}")
+        for n_entries in LOG_LENGTHS:
+            fill(controller, n_entries)
+            journal = per_event_sec(controller, rewrite_table=False)
+            rewrite = per_event_sec(controller, rewrite_table=True)
+            print(f"{n_entries:>8} {1e3 * journal:>8.3f}ms {1e3 * rewrite:>10.3f}ms")
+        controller.disconnect()
+
+        journal = LogJournal(Path(tempfile.mkdtemp()).joinpath("inline.jsonl"))
+        start = time.perf_counter()
+        for _ in range(N_TIMED):
+            journal.append(ENTRY)
+            journal.flush(fsync=True)
+        inline = (time.perf_counter() - start) / N_TIMED
+        journal.close()
+
+        controller = open_controller(sim, DurabilityPolicy(flush_every_n=1, fsync=True))
+        logging = per_event_sec(controller, rewrite_table=False)
+        start = time.perf_counter()
+        controller.flush_log()
+        drain = time.perf_counter() - start
+        print(
+            f"\nfsync every entry: {1e3 * inline:.3f}ms per event inline, {1e3 * logging:.3f}ms per event with "
+            f"the writer thread (then {1e3 * drain:.1f}ms to drain {N_TIMED} entries at flush_log)"
+        )
+        controller.disconnect()
+
+        per_event = {}
+        for name, policy in [("write-ahead (default)", None), ("batched", DurabilityPolicy())]:
+            controller = open_controller(sim, policy)
+            per_event[name] = per_event_sec(controller, rewrite_table=False)
+            controller.disconnect()
+        print(", ".join(f"{name}: {1e3 * sec:.3f}ms per event" for name, sec in per_event.items()))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,85 @@
+"""
+Benchmark labelling query times with the condition from the log, with LogIndex against a per-time loop over the
+log entries.
+
+Sorted times (e.g. spike times of a whole recording) use the fast path. Unsorted times are looked up one chunk at a
+time with np.searchsorted, or sorted once (state_at).
+
+Usage:
+    cd /path/to/nebPod/python
+    python benchmarks/bench_log_index.py
+"""
+import sys
+import time
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+sys.path.append(str(Path(__file__).parent.parent))
+
+from log_index import LogIndex
+
+SESSION_SEC = 3600
+N_TIMES = [10**5, 10**6, 10**7, 10**8]
+N_LOOP = 10**4
+GASSES = ["O2", "N2", "Hypoxia"]
+ODORS = ["H20", "EthylButyrate", "Limonene", "Hexanal"]
+
+
+def make_log(rng):
+    rows = []
+    for ii, start in enumerate(np.arange(0, SESSION_SEC, 60.0)):
+        rows.append(dict(label=GASSES[ii % 3], category="gas", start_time=start, end_time=np.nan))
+    for ii, start in enumerate(np.arange(0, SESSION_SEC, 10.0)):
+        rows.append(dict(label="present_odor", category="odor", start_time=start, end_time=start, odor=ODORS[ii % 4]))
+    for start in np.sort(rng.uniform(0, SESSION_SEC, 5000)):
+        rows.append(dict(label="opto_pulse", category="opto", start_time=start, end_time=np.nan, duration=0.05))
+    return pd.DataFrame(rows)
+
+
+def loop_state_at(log_df, times):
+    """
+    The obvious implementation: scan the log for every time.
+    """
+    gas = log_df[log_df["category"] == "gas"].sort_values("start_time")
+    opto = log_df[log_df["category"] == "opto"]
+    opto_end = opto["start_time"] + opto["duration"]
+    labels = []
+    for t in times:
+        before = gas[gas["start_time"] <= t]
+        covering = (opto["start_time"] <= t) & (t < opto_end)
+        labels.append((before["label"].values[-1] if len(before) else None, covering.any()))
+    return labels
+
+
+def timed(func, *args):
+    start = time.perf_counter()
+    func(*args)
+    return time.perf_counter() - start
+
+
+def main():
+    rng = np.random.default_rng(0)
+    log_df = make_log(rng)
+    index = LogIndex(log_df)
+
+    times = rng.uniform(0, SESSION_SEC, N_LOOP)
+    loop_sec = timed(loop_state_at, log_df, times)
+    print(f"per-time loop: {1e6 * loop_sec / N_LOOP:.1f}us per time ({N_LOOP} times)\n")
+
+    print(f"{'times':>10} {'sorted':>10} {'unsorted':>10} {'ns/time':>8}")
+    for n_times in N_TIMES:
+        times = np.sort(rng.uniform(0, SESSION_SEC, n_times))
+        sorted_sec = timed(index.state_at, times)
+        if n_times <= 10**7:
+            unsorted_sec = timed(index.state_at, rng.permutation(times))
+            unsorted = f"{unsorted_sec:>9.3f}s"
+        else:
+            unsorted = f"{'-':>10}"
+        print(f"{n_times:>10} {sorted_sec:>9.3f}s {unsorted} {1e9 * sorted_sec / n_times:>8.1f}")
+        del times
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,58 @@
+"""
+Benchmark building the log frame and the memory held by the log, for a list of dicts against the LogStore.
+
+Usage:
+    cd /path/to/nebPod/python
+    python benchmarks/bench_log_store.py
+"""
+import sys
+import time
+import tracemalloc
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+sys.path.append(str(Path(__file__).parent.parent))
+
+from log_store import LogStore
+
+LOG_LENGTHS = [1000, 10000, 50000, 100000]
+
+
+def make_entry(ii):
+    kind = ii % 4
+    if kind == 0:
+        return dict(label="opto_pulse", category="opto", start_time=ii, end_time=np.nan, amplitude=0.5, duration=0.01)
+    if kind == 1:
+        return dict(label="opto_train", category="opto", start_time=ii, end_time=ii + 2.0, amplitude=0.5, frequency=20)
+    if kind == 2:
+        return dict(label="present_O2", category="gas", start_time=ii, end_time=np.nan)
+    return dict(label="open_olfactometer_valve", category="odor", start_time=ii, end_time=np.nan, valve=ii % 8)
+
+
+def measure(make_log, to_frame, n_entries):
+    tracemalloc.start()
+    log = make_log()
+    for ii in range(n_entries):
+        log.append(make_entry(ii))
+    memory = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    start = time.perf_counter()
+    to_frame(log)
+    return memory, time.perf_counter() - start
+
+
+def main():
+    print(f"{'entries':>8} {'list MB':>8} {'store MB':>9} {'list frame':>11} {'store frame':>12}")
+    for n_entries in LOG_LENGTHS:
+        list_memory, list_sec = measure(list, pd.DataFrame, n_entries)
+        store_memory, store_sec = measure(LogStore, LogStore.to_pandas, n_entries)
+        print(
+            f"{n_entries:>8} {list_memory / 1e6:>8.1f} {store_memory / 1e6:>9.1f} "
+            f"{1e3 * list_sec:>9.1f}ms {1e3 * store_sec:>10.1f}ms"
+        )
+
+
+if __name__ == "__main__":
+    main()
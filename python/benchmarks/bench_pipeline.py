@@ -0,0 +1,58 @@
+"""
+Benchmark protocol v1 (one round trip per command) against protocol v2 (pipelined, sequence-numbered replies).
+
+Sends bursts of valve changes and laser on/off commands to the pty-backed TeensySimulator with a simulated
+USB round trip latency, once emulating v1 firmware and once with v2 firmware.
+
+Usage (Linux):
+    cd /path/to/nebPod/python
+    python benchmarks/bench_pipeline.py
+"""
+import os
+import sys
+import time
+from pathlib import Path
+
+sys.path.append(str(Path(__file__).parent.parent))
+os.environ.setdefault("QT_QPA_PLATFORM", "offscreen")
+
+from nebPod import Controller
+from teensy_sim import TeensySimulator
+
+LATENCY_SEC = 0.001  # Full-speed USB polls every 1ms
+N_BURSTS = 100
+
+
+def burst(controller, ii):
+    # A valve change plus a laser command, without waiting for a round trip in between
+    controller.submit("open_valve", valve=ii % 5)
+    return controller.submit("turn_on_laser" if ii % 2 else "turn_off_laser", amp=50)
+
+
+def measure(controller):
+    start = time.perf_counter()
+    for ii in range(N_BURSTS):
+        burst(controller, ii).result()
+    per_burst = (time.perf_counter() - start) / N_BURSTS
+
+    start = time.perf_counter()
+    futures = [burst(controller, ii) for ii in range(N_BURSTS)]
+    futures[-1].result()
+    queued = time.perf_counter() - start
+    return per_burst, queued
+
+
+def main():
+    print(f"{N_BURSTS} bursts of 2 commands, {1000 * LATENCY_SEC:.1f}ms simulated round trip")
+    for version in [1, 2]:
+        with TeensySimulator(protocol_version=version, latency_sec=LATENCY_SEC) as sim:
+            controller = Controller(f"serial://{sim.port}")
+            per_burst, queued = measure(controller)
+            print(
+                f"protocol v{controller.protocol_version}: {1000 * per_burst:6.2f}ms per burst, "
+                f"{1000 * queued:7.1f}ms for all bursts queued at once"
+            )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,78 @@
+"""
+Benchmark recovery from a dropped USB link.
+
+Puts a simulated teensy in a known state (binary cobalt mode, a gas valve, the Hering Breuer valve, olfactometer
+valves, the camera trigger), then yanks its pty out from under the Controller while valve commands are being
+sent. The Controller reconnects, replays the device state and carries on. Reports the time to recover for each
+outage length and checks that the rebooted simulator ends up in the state it was in before.
+
+Usage (Linux):
+    cd /path/to/nebPod/python
+    python benchmarks/bench_reconnect.py
+"""
+import os
+import sys
+import tempfile
+import threading
+import time
+from pathlib import Path
+
+sys.path.append(str(Path(__file__).parent.parent))
+os.environ.setdefault("QT_QPA_PLATFORM", "offscreen")
+
+from nebPod import Controller
+from teensy_sim import TeensySimulator
+
+OUTAGES_SEC = [0.0, 0.2, 1.0, 3.0]
+
+
+def device_state(sim):
+    return (
+        sim.cobalt_mode,
+        round(sim.null_voltage, 2),
+        sim.valve,
+        sim.hering_breuer,
+        sim.olfactometer_valves,
+        sim.camera_fps,
+    )
+
+
+def run(protocol_version, link):
+    sim = TeensySimulator(protocol_version=protocol_version, link=link).start()
+    controller = Controller(f"serial://{link}", cobalt_mode="B")
+    controller.open_valve(3)
+    controller.start_hb()
+    controller.set_all_olfactometer_valves("01000000")
+    controller.open_olfactometer(4)
+    controller.start_camera_trig(fps=90)
+    controller.block_until_read()
+    expected = device_state(sim)
+
+    for outage_sec in OUTAGES_SEC:
+        n_outages = len(controller.supervisor.outages)
+        yank = threading.Timer(0.05, sim.unplug, kwargs=dict(duration_sec=outage_sec))
+        yank.start()
+        # Keep the link busy so that the outage is noticed by a command in flight
+        while len(controller.supervisor.outages) == n_outages:
+            controller.open_valve(3, log_enabled=False)
+        yank.join()
+        outage = controller.supervisor.outages[-1]
+        controller.block_until_read()
+        restored = device_state(sim) == expected
+        print(
+            f"v{controller.protocol_version}, unplugged for {outage_sec:.1f}s: recovered in "
+            f"{outage['time_to_recover']:.2f}s after {outage['n_attempts']} attempts, "
+            f"state {'restored' if restored else f'NOT restored: {device_state(sim)} != {expected}'}"
+        )
+    controller.disconnect()
+    sim.stop()
+
+
+def main():
+    link = os.path.join(tempfile.mkdtemp(), "teensy")
+    for protocol_version in [1, 2, 3]:
+        run(protocol_version, link)
+
+
+if __name__ == "__main__":
+    main()
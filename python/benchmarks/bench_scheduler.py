@@ -0,0 +1,81 @@
+"""
+Onset errors of repeated stimuli, waiting a fixed interval after each one against the scheduled repeater.
+
+A block of opto pulses runs against the teensy simulator three times: once the way repeater used to, calling
+the function and then wait(interval), once with repeater's host loop (on_device=False), which starts every
+repetition on a fixed grid (see scheduler.py), and once with repeater on v4 firmware, which sends the block as
+one stimulus program (see stim_program.py). For all three, the start time of each pulse is compared with the
+grid start + i * interval. Waiting after each pulse drifts by the pulse plus the logging overhead every
+repetition, the schedule does not. The program's start times are device onsets, mapped to the host clock.
+
+The accuracy of SessionClock.sleep_until on its own is measured first, with random deadlines.
+
+Usage:
+    cd /path/to/nebPod/python
+    python benchmarks/bench_scheduler.py [--n 20] [--interval 0.5] [--pulse-ms 50]
+"""
+import argparse
+import os
+import sys
+from pathlib import Path
+
+import numpy as np
+
+sys.path.append(str(Path(__file__).parent.parent))
+os.environ.setdefault("QT_QPA_PLATFORM", "offscreen")
+
+from nebPod import Controller
+from teensy_sim import TeensySimulator
+
+
+def describe(name, errors_sec):
+    errors_ms = 1e3 * np.asarray(errors_sec)
+    p50, p99 = np.percentile(np.abs(errors_ms), [50, 99])
+    print(
+        f"{name:>22}: median abs {p50:8.3f}ms  99% {p99:8.3f}ms  max abs {np.abs(errors_ms).max():8.3f}ms  "
+        f"last {errors_ms[-1]:8.3f}ms"
+    )
+
+
+def onset_errors(controller, n, interval):
+    starts = np.array([entry["start_time"] for entry in controller.log if entry["label"] == "opto_pulse"][-n:])
+    return starts - (starts[0] + interval * np.arange(n))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--n", type=int, default=20, help="Repetitions")
+    parser.add_argument("--interval", type=float, default=0.5)
+    parser.add_argument("--pulse-ms", type=float, default=50)
+    args = parser.parse_args()
+    pulse_sec = args.pulse_ms / 1000
+
+    teensy = TeensySimulator(loopback=True, latency_sec=0.0005, request_latency_sec=0.0005).start()
+    controller = Controller(None, transport=teensy.transport, record_control="ttl")
+    clock = controller.clock
+
+    errors = []
+    rng = np.random.default_rng(0)
+    for delay_sec in rng.uniform(0.001, 0.2, 100):
+        deadline = clock.now() + delay_sec
+        clock.sleep_until(deadline)
+        errors.append(clock.now() - deadline)
+    describe("sleep_until", errors)
+
+    for _ in range(args.n):
+        controller.run_pulse(pulse_sec, 0.5)
+        controller.wait(args.interval, progress=None)
+    describe("pulse, then wait", onset_errors(controller, args.n, args.interval))
+
+    controller.run_pulse(pulse_sec, 0.5, n=args.n, interval=args.interval, on_device=False)
+    describe("scheduled repeater", onset_errors(controller, args.n, args.interval))
+
+    controller.run_pulse(pulse_sec, 0.5, n=args.n, interval=args.interval)
+    describe("device repeater", onset_errors(controller, args.n, args.interval))
+
+    controller.disconnect()
+    teensy.stop()
+
+
+if __name__ == "__main__":
+    main()
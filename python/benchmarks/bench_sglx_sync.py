@@ -0,0 +1,116 @@
+"""
+Check the sample indices in the saved log against the true sample indices of the simulated recording.
+
+A session runs against the teensy simulator and the SpikeGLX stand-in (sglx_sim.py), whose probe clock drifts
+against the host clock. Recording is started via the SpikeGLX API, opto pulses are logged for a while with sync
+pulses in between, and the recording is stopped, which saves the log and the sync map. For every opto and sync
+pulse, the logged sample_index is compared with the stream's sample index at the pulse's true onset.
+
+The map inherits the lag of the counts SpikeGLX reports (--fetch-lag-ms), which shows up as a constant offset:
+the part that the sync pulse edges in the recording are there to remove offline.
+
+The rate is only fitted once the counts span MIN_RATE_SPAN_SEC, so the session lasts several minutes. It runs on a
+virtual clock (see dry_run.py) unless --real-time is given, and fails if the fitted drift is off by more than
+--max-ppm-error or a sample index by more than --max-sample-error (plus the count lag).
+
+Usage:
+    cd /path/to/nebPod/python
+    python benchmarks/bench_sglx_sync.py [--drift-ppm 20] [--fetch-lag-ms 0] [--sync-interval 2] [--duration 300]
+        [--real-time]
+"""
+import argparse
+import json
+import os
+import sys
+import tempfile
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+sys.path.append(str(Path(__file__).parent.parent))
+os.environ.setdefault("QT_QPA_PLATFORM", "offscreen")
+
+from clock import ManualClock
+from nebPod import Controller
+from sglx_sim import SpikeGLXSimulator
+from sglx_sync import MIN_RATE_SPAN_SEC, sync_map_filename
+from teensy_sim import TeensySimulator
+
+PULSE_INTERVAL_SEC = 0.2
+SYNC_PIN = 1  # GP pin the sync pulses are emitted on
+
+
+def describe(name, errors):
+    print(f"{name:>12}: mean {errors.mean():7.2f}  sd {errors.std():6.2f}  max abs {np.abs(errors).max():6.2f} samples")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--drift-ppm", type=float, default=20.0)
+    parser.add_argument("--fetch-lag-ms", type=float, default=0.0)
+    parser.add_argument("--sync-interval", type=float, default=2.0)
+    parser.add_argument("--duration", type=float, default=300.0, help="Seconds of pulses")
+    parser.add_argument("--real-time", action="store_true", help="Run on the host clock instead of a virtual one")
+    parser.add_argument("--max-ppm-error", type=float, default=1.0)
+    parser.add_argument("--max-sample-error", type=float, default=10.0, help="About 0.3ms at 30kHz")
+    args = parser.parse_args()
+
+    clock = None if args.real_time else ManualClock()
+    teensy = TeensySimulator(loopback=True, latency_sec=0.0005, request_latency_sec=0.0005, clock=clock).start()
+    sglx = SpikeGLXSimulator(
+        data_dir=tempfile.mkdtemp(prefix="bench_sglx_"),
+        drift_ppm=args.drift_ppm,
+        fetch_lag_sec=args.fetch_lag_ms / 1000,
+        clock=clock,
+    )
+    controller = Controller(
+        None,
+        transport=teensy.transport,
+        sglx=sglx,
+        clock=clock,
+        sync_pin=SYNC_PIN,
+        sync_interval_sec=args.sync_interval,
+    )
+    controller.start_recording()
+    for _ in range(int(args.duration / PULSE_INTERVAL_SEC)):
+        controller.run_pulse(0.01, 0.5)
+        controller.clock.sleep(PULSE_INTERVAL_SEC)
+    controller.stop_recording(silent=True)
+
+    log_df = pd.read_csv(controller.gate_dest.joinpath(controller.log_filename), sep="\t", index_col=0)
+    map_fn = controller.gate_dest.joinpath(sync_map_filename(controller.log_filename))
+    summary = {key: value for key, value in json.loads(map_fn.read_text()).items() if key != "pulses"}
+    print(f"Sync map: {summary}")
+    estimated_ppm = (summary["rate"] / summary["sample_rate"] - 1) * 1e6
+    lag_samples = args.fetch_lag_ms * summary["sample_rate"] / 1000
+    print(
+        f"Injected drift {args.drift_ppm:.1f}ppm, estimated {estimated_ppm:.1f}ppm. Count lag {args.fetch_lag_ms}ms = "
+        f"{lag_samples:.0f} samples\n"
+    )
+    true_onsets = {command: [] for command in "pm"}
+    for command, onset_ns in teensy.onsets:
+        if command in true_onsets:
+            true_onsets[command].append(sglx.sample_index(onset_ns))
+    failures = []
+    if args.duration < 2 * MIN_RATE_SPAN_SEC:
+        failures.append(f"--duration {args.duration}s is too short to fit the rate, it takes {MIN_RATE_SPAN_SEC}s")
+    elif abs(estimated_ppm - args.drift_ppm) > args.max_ppm_error:
+        failures.append(f"estimated drift is off by {estimated_ppm - args.drift_ppm:.2f}ppm")
+    for label, command in [("opto_pulse", "p"), ("sync_pulse", "m")]:
+        logged = log_df.loc[log_df["label"] == label, "sample_index"].to_numpy()
+        errors = logged - np.array(true_onsets[command][-len(logged):])
+        describe(label, errors)
+        # The map trails the samples by the count lag (see the module docstring)
+        max_error = np.abs(errors + lag_samples).max()
+        if max_error > args.max_sample_error:
+            failures.append(f"{label} sample indices are off by up to {max_error:.1f} samples besides the lag")
+    controller.disconnect()
+    teensy.stop()
+    if failures:
+        raise SystemExit("FAIL: " + "; ".join(failures))
+    print("OK")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,67 @@
+"""
+Inter-stimulus interval jitter of a tagging block run from a host loop against the same block as a stimulus program.
+
+run_tagging runs against the teensy simulator twice: once with v3 firmware, where the host sends every pulse
+and sleeps for the interval in between, and once with v4 firmware, where the whole block is uploaded as a
+stimulus program and the simulated firmware starts every pulse from its own clock (see stim_program.py). The
+USB link gets a latency and a random jitter. For both, the true onsets of the pulses (as the simulator saw them)
+give the intervals, which are compared with the nominal pulse + inter-pulse interval.
+
+Usage:
+    cd /path/to/nebPod/python
+    python benchmarks/bench_stim_program.py [--n 75] [--ipi 0.1] [--pulse-ms 10] [--jitter-ms 1]
+"""
+import argparse
+import os
+import sys
+from pathlib import Path
+
+import numpy as np
+
+sys.path.append(str(Path(__file__).parent.parent))
+os.environ.setdefault("QT_QPA_PLATFORM", "offscreen")
+
+from nebPod import Controller
+from teensy_sim import TeensySimulator
+
+
+def describe(name, errors_sec):
+    errors_ms = 1e3 * np.asarray(errors_sec)
+    p50, p99 = np.percentile(np.abs(errors_ms), [50, 99])
+    print(
+        f"{name:>16}: interval error mean {errors_ms.mean():8.3f}ms  sd {errors_ms.std():7.3f}ms  "
+        f"median abs {p50:7.3f}ms  99% {p99:7.3f}ms"
+    )
+
+
+def interval_errors(protocol_version, args):
+    teensy = TeensySimulator(
+        loopback=True,
+        protocol_version=protocol_version,
+        latency_sec=0.0005,
+        latency_jitter_sec=args.jitter_ms / 1000,
+        request_latency_sec=0.0005,
+    ).start()
+    controller = Controller(None, transport=teensy.transport, record_control="ttl")
+    pulse_sec = args.pulse_ms / 1000
+    controller.run_tagging(n=args.n, pulse_duration_sec=pulse_sec, amp=0.5, ipi_sec=args.ipi, verbose=False)
+    onsets_ns = np.array([onset_ns for command, onset_ns in teensy.onsets if command == "p"])
+    controller.disconnect()
+    teensy.stop()
+    return np.diff(onsets_ns) / 1e9 - (pulse_sec + args.ipi)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--n", type=int, default=75, help="Tagging pulses")
+    parser.add_argument("--ipi", type=float, default=0.1, help="Inter-pulse interval (s)")
+    parser.add_argument("--pulse-ms", type=float, default=10)
+    parser.add_argument("--jitter-ms", type=float, default=1.0, help="Random extra USB reply latency, up to this")
+    args = parser.parse_args()
+
+    describe("host loop (v3)", interval_errors(3, args))
+    describe("program (v4)", interval_errors(4, args))
+
+
+if __name__ == "__main__":
+    main()
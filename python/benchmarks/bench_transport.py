@@ -0,0 +1,70 @@
+"""
+Benchmark the host-side cost of a command round trip over each transport.
+
+Sends short commands (valve changes) to the TeensySimulator over the in-process loopback, a pty opened with
+pyserial, and TCP relayed to that pty. The simulator answers instantly, so the time per command is the
+overhead of the host and the transport.
+
+Usage (Linux):
+    cd /path/to/nebPod/python
+    python benchmarks/bench_transport.py
+"""
+import os
+import sys
+import threading
+import time
+from pathlib import Path
+
+sys.path.append(str(Path(__file__).parent.parent))
+os.environ.setdefault("QT_QPA_PLATFORM", "offscreen")
+
+from nebPod import Controller
+from teensy_sim import TeensySimulator
+from transports import SerialTransport, serve_tcp
+
+N_COMMANDS = 2000
+TCP_PORT = 5599
+PIPELINE_DEPTH = 128  # Commands in flight at once in the pipelined measurement
+
+
+def measure(controller):
+    start = time.perf_counter()
+    for ii in range(N_COMMANDS):
+        controller.submit("open_valve", valve=ii % 5).result()
+    sequential = (time.perf_counter() - start) / N_COMMANDS
+
+    start = time.perf_counter()
+    for batch_start in range(0, N_COMMANDS, PIPELINE_DEPTH):
+        # Sequence numbers wrap at 256, so at most that many commands can be in flight
+        batch = range(batch_start, min(batch_start + PIPELINE_DEPTH, N_COMMANDS))
+        futures = [controller.submit("open_valve", valve=ii % 5) for ii in batch]
+        futures[-1].result()
+    pipelined = (time.perf_counter() - start) / N_COMMANDS
+    return sequential, pipelined
+
+
+def report(name, controller):
+    sequential, pipelined = measure(controller)
+    controller.disconnect()
+    print(f"{name:>9}: {1e6 * sequential:7.1f}us per round trip, {1e6 * pipelined:6.1f}us per pipelined command")
+
+
+def main():
+    print(f"{N_COMMANDS} valve commands per transport")
+    with TeensySimulator(loopback=True) as sim:
+        report("loopback", Controller(None, transport=sim.transport))
+
+    with TeensySimulator() as sim:
+        report("pyserial", Controller(f"serial://{sim.port}"))
+
+    with TeensySimulator() as sim:
+        server = threading.Thread(
+            target=serve_tcp, args=(SerialTransport(sim.port),), kwargs=dict(host="127.0.0.1", port=TCP_PORT), daemon=True
+        )
+        server.start()
+        time.sleep(0.2)
+        report("tcp", Controller(f"tcp://127.0.0.1:{TCP_PORT}"))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,184 @@
+"""
+Checkpoints of a running protocol, so that a session that died can pick up where it stopped.
+
+If a two hour protocol dies at step 140 (an exception, a USB link that did not come back, Ctrl-C, which closes the
+Controller and stops the recording), starting over costs another settle and everything before it. Protocol.run
+saves a checkpoint after every step instead:
+
+    next_step       - index of the first step not done yet, in Protocol.flat_steps() order
+    protocol        - the protocol itself, so resuming does not depend on the file it came from
+    rng_state       - state of numpy's and Python's global random number generators
+    device_state    - the commands that set the device's lasting state (see supervisor.DeviceJournal)
+    odor_map        - the Controller's odor map
+    recording       - whether a recording was running, and its gate, trigger and log filenames
+
+The checkpoint is written atomically, by default to <gate_dest_default>/_cibbrig_checkpoint.<protocol>.json. To
+resume, open a new Controller and:
+
+    Protocol.resume(controller, "D:/sglx_data/_cibbrig_checkpoint.tac_calca.json")
+
+which restores the random state, the odor map and the device state, starts the recording again in the same gate
+as the next trigger (increment_gate=False), and runs the steps after the last one that finished. A step that was
+cut short runs again from its start.
+"""
+
+import datetime
+import json
+import random
+import re
+from pathlib import Path
+
+import numpy as np
+
+from log_store import replace_atomically
+from supervisor import REPLAY_ORDER
+
+# Device state (see supervisor.REPLAY_ORDER) left out of the checkpoint. The recording is started again by
+# start_recording, which also logs rec_start, rather than by setting the record pin.
+NOT_REPLAYED = ["record"]
+LOG_FILENAME_RE = re.compile(r"_cibbrig_log\.table\.(?P<runname>.+)\.g(?P<g>\d+)\.t(?P<t>\d+)\.tsv")
+
+
+def checkpoint_filename(protocol_name):
+    return f"_cibbrig_checkpoint.{protocol_name}.json"
+
+
+def is_recording(controller):
+    """
+    Whether the Controller started a recording that it has not stopped since.
+    """
+    if controller.rec_start_time is None:
+        return False
+    return controller.rec_stop_time is None or controller.rec_stop_time < controller.rec_start_time
+
+
+def _rng_state():
+    numpy_state = np.random.get_state(legacy=False)
+    numpy_state["state"] = {key: np.asarray(value).tolist() for key, value in numpy_state["state"].items()}
+    return dict(numpy=numpy_state, python=random.getstate())
+
+
+def _set_rng_state(rng_state):
+    numpy_state = dict(rng_state["numpy"])
+    numpy_state["state"] = {
+        key: np.array(value, dtype=np.uint32) if isinstance(value, list) else value
+        for key, value in numpy_state["state"].items()
+    }
+    np.random.set_state(numpy_state)
+    version, internal, gauss_next = rng_state["python"]
+    random.setstate((version, tuple(internal), gauss_next))
+
+
+class Checkpoint:
+    """
+    Progress of a protocol and the session state needed to carry on after it (see the module docstring).
+    """
+
+    def __init__(
+        self, protocol, next_step, n_steps, rng_state, device_state, odor_map=None, recording=None, saved_at=None
+    ):
+        self.protocol = protocol
+        self.next_step = next_step
+        self.n_steps = n_steps
+        self.rng_state = rng_state
+        self.device_state = device_state
+        self.odor_map = odor_map
+        self.recording = recording or dict(recording=False)
+        self.saved_at = saved_at
+
+    @classmethod
+    def capture(cls, controller, protocol, next_step):
+        """
+        Take a checkpoint of a protocol running on a Controller.
+
+        Args:
+            controller (Controller): The Controller running it.
+            protocol (Protocol): The protocol.
+            next_step (int): Index of the first step that has not run yet.
+        """
+        recording = dict(
+            recording=is_recording(controller),
+            record_control=controller.record_control,
+            gate_dest=str(controller.gate_dest) if controller.gate_dest is not None else None,
+            log_filename=controller.log_filename,
+            g_suffix=getattr(controller, "g_suffix", None),
+            t_suffix=getattr(controller, "t_suffix", None),
+            recname=str(controller.recname) if controller.recname is not None else None,
+        )
+        return cls(
+            protocol=dict(
+                name=protocol.name, steps=protocol.steps, gas_map=protocol.gas_map, odor_map=protocol.odor_map
+            ),
+            next_step=next_step,
+            n_steps=len(protocol.flat_steps()),
+            rng_state=_rng_state(),
+            device_state=[
+                list(controller.journal.state[key])
+                for key in REPLAY_ORDER
+                if key in controller.journal.state and key not in NOT_REPLAYED
+            ],
+            odor_map=controller.odor_map,
+            recording=recording,
+            saved_at=datetime.datetime.now().isoformat(timespec="seconds"),
+        )
+
+    def to_dict(self):
+        return dict(
+            protocol=self.protocol,
+            next_step=self.next_step,
+            n_steps=self.n_steps,
+            rng_state=self.rng_state,
+            device_state=self.device_state,
+            odor_map=self.odor_map,
+            recording=self.recording,
+            saved_at=self.saved_at,
+        )
+
+    def save(self, path):
+        """
+        Write the checkpoint, replacing the previous one atomically.
+        """
+        path = Path(path)
+        checkpoint_json = json.dumps(self.to_dict())
+        replace_atomically(path, lambda tmp_fn: tmp_fn.write_text(checkpoint_json))
+
+    @classmethod
+    def load(cls, path):
+        spec = json.loads(Path(path).read_text())
+        # JSON keys are strings, the maps are keyed by valve number
+        for map_name in ["gas_map", "odor_map"]:
+            if spec["protocol"].get(map_name) is not None:
+                spec["protocol"][map_name] = {int(key): value for key, value in spec["protocol"][map_name].items()}
+        if spec["odor_map"] is not None:
+            spec["odor_map"] = {int(key): value for key, value in spec["odor_map"].items()}
+        return cls(**spec)
+
+    @property
+    def done(self):
+        return self.next_step >= self.n_steps
+
+    def restore(self, controller, verbose=True):
+        """
+        Put a (new) Controller in the state the checkpoint was taken in: random state, odor map, device state and,
+        if a recording was running, a new trigger of the same gate.
+        """
+        _set_rng_state(self.rng_state)
+        if self.odor_map is not None:
+            controller.odor_map = self.odor_map
+        for name, fields in self.device_state:
+            controller.submit(name, **fields).result()
+        print(f"Restored {len(self.device_state)} device state commands from {self.saved_at}") if verbose else None
+        if not self.recording["recording"]:
+            return
+        if self.recording["record_control"] == "ttl":
+            # The next hardware trigger of the same gate, as start_recording_sglx does with increment_gate=False
+            match = LOG_FILENAME_RE.fullmatch(self.recording["log_filename"] or "")
+            if match is None:
+                raise ValueError(f"Cannot resume the recording of log {self.recording['log_filename']!r}")
+            runname, g_suffix, t_suffix = match["runname"], int(match["g"]), int(match["t"]) + 1
+            controller.gate_dest = Path(self.recording["gate_dest"])
+            controller.log_filename = f"_cibbrig_log.table.{runname}.g{g_suffix}.t{t_suffix}.tsv"
+            controller.odormap_filename = f"_cibbrig_odors.map.{runname}.g{g_suffix}.t{t_suffix}.json"
+            controller._open_log_journal()
+            print(f"Log will save to {controller.gate_dest}/{controller.log_filename}")
+        controller.start_recording(increment_gate=False)
@@ -0,0 +1,144 @@
+"""
+Clocks for event timestamps.
+
+time.time() is coarse on Windows (~16ms on some systems) and jumps when NTP or the user adjusts the system
+clock, which shifts the relative stimulus times of a long session. The SessionClock reads a monotonic
+nanosecond counter instead, and anchors it to wall time once, when it is created:
+
+    now = anchor_wall_ns + (perf_counter_ns() - anchor_monotonic_ns)
+
+so timestamps are still seconds since the epoch (and line up with other files from the same day), but the
+differences between them are exact and never jump. The anchor is written to the log journal's metadata.
+
+Waits for a deadline (sleep_until) sleep most of the way and spin for the last stretch, since time.sleep only
+wakes up to a timer tick late. That gets within microseconds of the deadline (see scheduler.py).
+
+Every timestamp and wait of the Controller goes through its clock, so tests can pass a ManualClock:
+
+    clock = ManualClock()
+    controller = Controller(None, transport=sim.transport, clock=clock)
+    controller.wait(60, progress=None)  # returns at once, clock.now() moved 60s
+"""
+
+import threading
+import time
+
+SPIN_SEC = 0.002  # Least time spun before a deadline instead of slept
+MAX_SPIN_SEC = 0.05
+SPIN_ADAPT = 0.2  # How fast spin_sec follows the oversleep of time.sleep
+
+
+class SessionClock:
+    """
+    Monotonic clock anchored to wall time.
+
+    Attributes:
+        anchor_wall_ns (int): Wall time (ns since the epoch) when the clock was created.
+        anchor_monotonic_ns (int): Monotonic counter (ns) at the same moment.
+    """
+
+    def __init__(self, monotonic_ns=time.perf_counter_ns, wall_ns=time.time_ns):
+        """
+        Args:
+            monotonic_ns (callable, optional): Monotonic counter in ns. Defaults to time.perf_counter_ns, the
+                highest resolution clock on Windows and Linux.
+            wall_ns (callable, optional): Wall clock in ns, only read for the anchor. Defaults to time.time_ns.
+        """
+        self._monotonic_ns = monotonic_ns
+        # Take the anchor between two counter reads, so it is off by at most half the time one read takes
+        before = monotonic_ns()
+        self.anchor_wall_ns = wall_ns()
+        after = monotonic_ns()
+        self.anchor_monotonic_ns = (before + after) // 2
+        # Follows twice the oversleep of time.sleep, e.g. ~30ms with a coarse Windows timer
+        self.spin_sec = SPIN_SEC
+
+    def now_ns(self):
+        """
+        Returns:
+            int: Nanoseconds since the epoch.
+        """
+        return self.anchor_wall_ns + (self._monotonic_ns() - self.anchor_monotonic_ns)
+
+    def now(self):
+        """
+        Returns:
+            float: Seconds since the epoch, like time.time().
+        """
+        return self.now_ns() / 1e9
+
+    def sleep(self, seconds):
+        time.sleep(seconds)
+
+    def sleep_until(self, deadline, tick=None, tick_sec=0.1):
+        """
+        Wait until the clock reads `deadline`: sleep in steps until it is closer than spin_sec, then spin.
+
+        Args:
+            deadline (float): Seconds since the epoch, as returned by now().
+            tick (callable, optional): Called with the seconds left before every sleep step, e.g. to update a
+                progress bar. The wait stops if it returns False. Not called while spinning.
+            tick_sec (float, optional): Longest sleep step. Defaults to 0.1.
+
+        Returns:
+            bool: True once the deadline has passed, False if tick stopped the wait.
+        """
+        deadline_ns = int(deadline * 1e9)
+        while True:
+            remaining_sec = (deadline_ns - self.now_ns()) / 1e9
+            if remaining_sec <= self.spin_sec:
+                break
+            if tick is not None and tick(remaining_sec) is False:
+                return False
+            step_sec = min(tick_sec, remaining_sec - self.spin_sec)
+            before_ns = self.now_ns()
+            time.sleep(step_sec)
+            # A moving average, so that one late wakeup (e.g. the OS running something else) is soon forgotten
+            overslept_sec = (self.now_ns() - before_ns) / 1e9 - step_sec
+            target_sec = min(max(2 * overslept_sec, SPIN_SEC), MAX_SPIN_SEC)
+            self.spin_sec += SPIN_ADAPT * (target_sec - self.spin_sec)
+        while self.now_ns() < deadline_ns:
+            # Yielding here (sleep(0)) would let the OS schedule something else and wake up late
+            pass
+        return True
+
+    def anchor(self):
+        """
+        Returns:
+            dict: The anchor, as recorded in the log journal.
+        """
+        return dict(
+            clock=type(self).__name__,
+            anchor_wall_ns=self.anchor_wall_ns,
+            anchor_monotonic_ns=self.anchor_monotonic_ns,
+        )
+
+
+class ManualClock(SessionClock):
+    """
+    Clock that only moves when told to, for tests. sleep() advances it instead of waiting.
+    """
+
+    def __init__(self, start_sec=1.7e9):
+        """
+        Args:
+            start_sec (float, optional): Time of the anchor, in seconds since the epoch.
+        """
+        self._lock = threading.Lock()
+        self._elapsed_ns = 0
+        super().__init__(monotonic_ns=lambda: self._elapsed_ns, wall_ns=lambda: int(start_sec * 1e9))
+
+    def advance(self, seconds):
+        with self._lock:
+            self._elapsed_ns += int(round(seconds * 1e9))
+
+    def sleep(self, seconds):
+        self.advance(seconds)
+
+    def sleep_until(self, deadline, tick=None, tick_sec=0.1):
+        remaining_sec = deadline - self.now()
+        if remaining_sec > 0:
+            if tick is not None and tick(remaining_sec) is False:
+                return False
+            self.advance(remaining_sec)
+        return True
@@ -0,0 +1,194 @@
+"""
+Map the teensy's clock onto the host's.
+
+Log times are host times taken around a serial round trip, so the real onset of a pulse is somewhere inside
+that window, with USB latency and jitter on top. v3 firmware replies to timed frames with its micros() at the
+moment the command took effect (see commands.py), which only needs converting to host time.
+
+The conversion is estimated NTP style. The host sends clock pings and notes when each was sent and when its
+reply came back. The firmware answers with its micros() as soon as it reads the ping, so the host time of that
+device time is taken as the midpoint of the round trip. A straight line fitted through (device time, host midpoint)
+pairs gives the offset and drift between the two clocks:
+
+    host_time = intercept + slope * device_time
+
+Only pings with short round trips are trusted (a ping sent while the teensy is busy waits in its buffer), and
+the fit uses the most recent `window` of them, so a drift that changes with temperature is followed. Until the
+pings span MIN_DRIFT_SPAN_SEC, only the offset is estimated (slope 1). What is left is the asymmetry of the USB
+link, at most half the shortest round trip.
+
+micros() wraps every 2^32 us (~71.6 min). Device times are unwrapped against the latest one seen, so sessions of
+any length work as long as pings come more often than every half wrap.
+
+    sync = ClockSync()
+    sync.add_ping(reply)                      # Reply of a clock_ping, with sent_time and received_time
+    onset_time = sync.to_host(reply.onset_us)
+"""
+
+import collections
+import threading
+
+import numpy as np
+
+WRAP_US = 2**32
+MIN_PINGS = 4
+MIN_DRIFT_SPAN_SEC = 10.0  # Pings closer together than this give a drift estimate worse than assuming none
+
+
+def fit_line(x, y, round_trip_sec, default_slope=1.0, min_span=MIN_DRIFT_SPAN_SEC):
+    """
+    Fit y against x through the samples of NTP style exchanges, where x was read somewhere inside a round trip.
+
+    Once there are enough samples, only the shorter half of the round trips is used: those have the least
+    queueing in them. Until x spans `min_span`, only the offset is fitted and the slope is `default_slope`.
+    Used for the device clock here and for SpikeGLX sample counts in sglx_sync.py.
+
+    Args:
+        x (np.ndarray): Host or device times of the samples.
+        y (np.ndarray): What was read at those times.
+        round_trip_sec (np.ndarray): Round trip of each sample.
+        default_slope (float, optional): Slope to assume while x spans less than `min_span`. Defaults to 1.
+        min_span (float, optional): Span of x needed to fit the slope. Defaults to MIN_DRIFT_SPAN_SEC.
+
+    Returns:
+        tuple: (slope, x_ref, y_ref), for y = y_ref + slope * (x - x_ref). The reference point is the mean of the
+            samples used, so that epoch-sized values do not cost precision.
+    """
+    if len(x) >= 2 * MIN_PINGS:
+        keep = round_trip_sec <= np.median(round_trip_sec)
+        x, y = x[keep], y[keep]
+    x_ref = float(x.mean())
+    if np.ptp(x) < min_span:
+        return float(default_slope), x_ref, float(np.mean(y - default_slope * (x - x_ref)))
+    y_ref = float(y.mean())
+    slope = np.dot(x - x_ref, y - y_ref) / np.dot(x - x_ref, x - x_ref)
+    return float(slope), x_ref, y_ref
+
+
+class ClockSync:
+    """
+    Running estimate of host time as a linear function of device time.
+
+    Attributes:
+        window (int): Number of recent pings the line is fitted to.
+        max_round_trip_sec (float): Pings with longer round trips are discarded.
+        intercept (float): Host time (s) at device time 0 (unwrapped).
+        slope (float): Host seconds per device second.
+        n_pings (int): Pings accepted so far.
+        n_rejected (int): Pings discarded for their round trip.
+    """
+
+    def __init__(self, window=64, max_round_trip_sec=0.01):
+        self.window = window
+        self.max_round_trip_sec = max_round_trip_sec
+        # Pings are added from the serial I/O thread
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        """
+        Forget every ping, e.g. after the teensy was reset and its micros() started over.
+        """
+        self.intercept = np.nan
+        self.slope = np.nan
+        self.n_pings = 0
+        self.n_rejected = 0
+        self._samples = collections.deque(maxlen=self.window)
+        self._last_us = None
+        self._wraps = 0
+
+    @property
+    def ready(self):
+        """
+        Whether enough pings were accepted to map device times.
+        """
+        return self.n_pings >= MIN_PINGS
+
+    @property
+    def drift_ppm(self):
+        """
+        How much faster the device clock runs than the host clock, in parts per million.
+        """
+        return (1 / self.slope - 1) * 1e6
+
+    def add_ping(self, reply):
+        """
+        Add the reply to a clock ping and update the fit.
+
+        Args:
+            reply (Reply): With onset_us, sent_time and received_time.
+
+        Returns:
+            bool: Whether the ping was accepted.
+        """
+        return self.add_sample(reply.onset_us, reply.sent_time, reply.received_time)
+
+    def add_sample(self, device_us, sent_time, received_time):
+        """
+        Add one ping exchange.
+
+        Args:
+            device_us (int): Device micros() when it read the ping.
+            sent_time (float): Host time the ping was sent.
+            received_time (float): Host time the reply was read.
+
+        Returns:
+            bool: Whether the ping was accepted.
+        """
+        with self._lock:
+            device_sec = self._unwrap(device_us) / 1e6
+            round_trip_sec = received_time - sent_time
+            if round_trip_sec > self.max_round_trip_sec:
+                self.n_rejected += 1
+                return False
+            self._samples.append((device_sec, (sent_time + received_time) / 2, round_trip_sec))
+            self.n_pings += 1
+            self._fit()
+            return True
+
+    def _fit(self):
+        device_sec, host_sec, round_trip_sec = np.array(self._samples).T
+        self.slope, device_ref, host_ref = fit_line(device_sec, host_sec, round_trip_sec)
+        self.intercept = host_ref - self.slope * device_ref
+
+    def to_host(self, device_us):
+        """
+        Args:
+            device_us (int): Device micros(), e.g. Reply.onset_us.
+
+        Returns:
+            float: Host clock time of the device time, or NaN until enough pings were accepted.
+        """
+        if not self.ready or device_us is None:
+            return np.nan
+        with self._lock:
+            return self.intercept + self.slope * self._unwrap(device_us) / 1e6
+
+    def _unwrap(self, device_us):
+        """
+        Device micros() as a count that does not wrap, taking the one closest to the latest seen.
+        """
+        if self._last_us is None:
+            self._last_us = device_us
+        elif device_us - self._last_us < -WRAP_US // 2:
+            self._wraps += 1
+            self._last_us = device_us
+        elif device_us - self._last_us > WRAP_US // 2:
+            # From before the latest wrap
+            return device_us + (self._wraps - 1) * WRAP_US
+        else:
+            self._last_us = max(self._last_us, device_us)
+        return device_us + self._wraps * WRAP_US
+
+    def summary(self):
+        """
+        Returns:
+            dict: Current estimate, as returned by Controller.sync_clock.
+        """
+        return dict(
+            slope=self.slope,
+            intercept=self.intercept,
+            drift_ppm=self.drift_ppm,
+            n_pings=self.n_pings,
+            n_rejected=self.n_rejected,
+        )
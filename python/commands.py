@@ -0,0 +1,384 @@
+"""
+Declarative table of the serial commands understood by the teensy firmware.
+
+Messages from python are `<command><subcommand><param1><param2>...` where command and subcommand are
+characters and params are little-endian integers (or characters) whose wire types both sides agree on.
+Each entry in COMMANDS describes one message:
+
+    "run_train": Command("t", fields=[("duration", "uint16"), ("freq", "uint8"), ...])
+
+A command is packed into a single preallocated buffer and handed to the serial port in one write, so a
+frame can never be split into several USB packets or interleaved with another frame.
+
+Example:
+    n_bytes = COMMANDS["run_train"].pack_into(buffer, duration=2000, freq=10, amp=60, pulse_duration=10)
+    serial_object.write(memoryview(buffer)[:n_bytes])
+
+Protocol v2 wraps the same message in a frame that carries a sequence id, and every reply echoes it:
+
+    frame: FRAME_START <seq> <command><subcommand><param1>...
+    reply: REPLY_START <seq> <status> <n payload bytes> <payload>...
+
+so several commands can be in flight and replies are matched to commands instead of relying on order.
+v1 (legacy) replies are any payload bytes followed by a single ACK byte.
+
+Protocol v3 adds timed frames, whose replies also carry the device's micros() when the command took effect
+(e.g. the start of a pulse):
+
+    frame: FRAME_START_TIMED <seq> <command><subcommand><param1>...
+    reply: REPLY_START_TIMED <seq> <status> <n payload bytes> <onset micros, uint32> <payload>...
+
+clock_ping does nothing but reply, and is what the host uses to map device time to its own (see clock_sync.py).
+
+Protocol v4 adds stimulus programs (see stim_program.py): upload_program carries a whole list of steps in one
+frame, and run_program runs them from the device clock. While it runs, the firmware streams a completion record
+for every step, with the step's onset, and acknowledges once the program's duration is up:
+
+    record: RECORD_START <seq of run_program> <step index, uint16> <onset micros, uint32>
+
+Firmware-timed commands declare how long the firmware is busy as a function of their field values
+(`Command.expected_sec`), which is what the timing monitor holds acknowledgement times against.
+"""
+
+import struct
+
+# Protocol v2 to v4 (see teensy32_firmware.ino)
+PROTOCOL_VERSION = 4
+FRAME_START = 0xA5
+FRAME_START_TIMED = 0xA6  # v3
+FRAME_HEADER_BYTES = 2  # FRAME_START, seq
+REPLY_START = 0x5A
+REPLY_START_TIMED = 0x5B  # v3
+REPLY_HEADER_BYTES = 4  # REPLY_START, seq, status, n payload bytes
+RECORD_START = 0x5C  # v4
+RECORD_BYTES = 8  # RECORD_START, seq, step index, onset micros
+ONSET_BYTES = 4  # Device micros() after the header of a timed reply
+MAX_REPLY_PAYLOAD = 8  # MAX_REPLY_BYTES in the firmware
+STATUS_OK = 0
+STATUS_UNKNOWN_COMMAND = 1
+STATUS_OLFACTOMETER_TIMEOUT = 111  # Also sent before the ACK in v1
+STATUS_NO_PROGRAM = 2  # v4: run_program before any upload_program
+
+# Firmware-timed commands without a duration field
+POLL_LASER_POWER_SEC = 0.2  # Cobalt::poll_laser_power: 100ms settle + 20 reads at 5ms
+SYNCH_SOUND_SEC = 1.45  # Tbox::syncUSV tone sequence
+
+# Stimulus programs (v4). Every step has the same layout, the meaning of the arguments depends on the opcode
+# (see stim_program.py)
+MAX_PROGRAM_STEPS = 256  # MAX_PROGRAM_STEPS in the firmware
+PROGRAM_STEP_FIELDS = [
+    ("onset_us", "uint32"),
+    ("opcode", "char"),
+    ("arg0", "uint16"),
+    ("arg1", "uint16"),
+    ("arg2", "uint8"),
+    ("arg3", "uint8"),
+]
+
+# Gas on each teensy valve, unless the Controller is given a gas_map
+DEFAULT_GAS_MAP = {0: "O2", 1: "room air", 2: "hypercapnia", 3: "hypoxia", 4: "N2"}
+
+# Wire type -> (struct format character, (min, max) or None for characters)
+WIRE_TYPES = {
+    "char": ("c", None),
+    "uint8": ("B", (0, 2**8 - 1)),
+    "uint16": ("H", (0, 2**16 - 1)),
+    "uint32": ("I", (0, 2**32 - 1)),
+}
+
+
+class Command:
+    """
+    One serial command: opcode, optional subcommand characters and typed fields.
+
+    Attributes:
+        name (str): Name of the command in its table.
+        prefix (bytes): The opcode and subcommand characters.
+        fields (list): (name, wire type) pairs in the order the firmware reads them.
+        reply_bytes (int): Number of payload bytes the firmware sends before its acknowledgement.
+        duration (callable): Seconds the firmware is busy before it acknowledges, computed from the field values
+            as sent. None if the firmware acknowledges right away.
+        records (tuple): (name, fields, max count) of a list of records sent after the fields, preceded by their
+            count as a uint16. None for fixed size commands.
+        size (int): Size of the packed frame in bytes, the largest one for commands with records.
+    """
+
+    def __init__(self, opcode, subcommand="", fields=(), reply_bytes=0, duration=None, records=None):
+        """
+        Args:
+            opcode (str): Command class character (e.g. 't').
+            subcommand (str, optional): Subcommand character(s). Defaults to "".
+            fields (list, optional): (name, wire type) pairs. Defaults to ().
+            reply_bytes (int, optional): Payload bytes sent back before the acknowledgement. Defaults to 0.
+            duration (callable, optional): Takes a dict of field values (as returned by `values`, so characters are
+                bytes) and returns the seconds the firmware is busy. Defaults to None.
+            records (tuple, optional): (name, fields, max count) of a variable length list of records that follows
+                the fields, e.g. the steps of a stimulus program. Defaults to None.
+        """
+        self.name = None
+        self.prefix = (opcode + subcommand).encode("utf-8")
+        self.fields = list(fields)
+        self.reply_bytes = reply_bytes
+        self.duration = duration
+        self.records = records
+        for field_name, wire_type in self.fields:
+            assert wire_type in WIRE_TYPES, f"{field_name}: unknown wire type {wire_type}"
+        self._struct = _struct(self.fields)
+        self.size = len(self.prefix) + self._struct.size
+        if records is not None:
+            _, record_fields, max_records = records
+            self._record_struct = _struct(record_fields)
+            self.size += RECORD_COUNT.size + max_records * self._record_struct.size
+
+    def __repr__(self):
+        return f"Command({self.name!r}, prefix={self.prefix!r}, fields={self.fields})"
+
+    def values(self, **fields):
+        """
+        Convert and range check field values in wire order.
+
+        Commands with records take them as a list of dicts under the records' name, and the values end with a
+        list of the records' values.
+
+        Raises:
+            ValueError: If a field is missing, unexpected, or does not fit in its wire type, or if there are too
+                many records.
+        """
+        fields = dict(fields)
+        records = None
+        if self.records is not None:
+            records_name, record_fields, max_records = self.records
+            records = fields.pop(records_name, None)
+            if records is None:
+                raise ValueError(f"{self.name}: missing field '{records_name}'")
+            if len(records) > max_records:
+                raise ValueError(f"{self.name}: {len(records)} {records_name}, at most {max_records} fit")
+        values = _check_fields(self.name, self.fields, fields)
+        if records is not None:
+            values.append(
+                [
+                    _check_fields(f"{self.name} {records_name}[{ii}]", record_fields, record)
+                    for ii, record in enumerate(records)
+                ]
+            )
+        return values
+
+    def expected_sec(self, values):
+        """
+        How long the firmware will be busy with these values, i.e. with what actually goes over the wire.
+
+        Args:
+            values (list): Field values in wire order, as returned by `values`.
+
+        Returns:
+            float: Seconds from the command arriving to its acknowledgement, not counting the link.
+        """
+        if self.duration is None:
+            return 0.0
+        return self.duration({field_name: value for (field_name, _), value in zip(self.fields, values)})
+
+    def pack_into(self, buffer, offset=0, **fields):
+        """
+        Pack the command into a preallocated buffer.
+
+        Args:
+            buffer (bytearray): Buffer to pack into.
+            offset (int, optional): Position in the buffer to start at. Defaults to 0.
+            **fields: Value for every field of the command.
+
+        Returns:
+            int: Number of bytes written.
+        """
+        return self.pack_values_into(buffer, self.values(**fields), offset)
+
+    def pack_values_into(self, buffer, values, offset=0):
+        """
+        Pack values that have already been checked by `values` into a preallocated buffer.
+
+        Args:
+            buffer (bytearray): Buffer to pack into.
+            values (list): Field values in wire order, as returned by `values`.
+            offset (int, optional): Position in the buffer to start at. Defaults to 0.
+
+        Returns:
+            int: Number of bytes written.
+        """
+        n_prefix = len(self.prefix)
+        buffer[offset : offset + n_prefix] = self.prefix
+        if self.records is None:
+            self._struct.pack_into(buffer, offset + n_prefix, *values)
+            return self.size
+        n_fields = len(self.fields)
+        self._struct.pack_into(buffer, offset + n_prefix, *values[:n_fields])
+        position = offset + n_prefix + self._struct.size
+        records = values[n_fields]
+        RECORD_COUNT.pack_into(buffer, position, len(records))
+        position += RECORD_COUNT.size
+        for record in records:
+            self._record_struct.pack_into(buffer, position, *record)
+            position += self._record_struct.size
+        return position - offset
+
+    def pack_frame_into(self, buffer, values, seq, offset=0, timed=False):
+        """
+        Pack checked values into a protocol v2 frame with sequence id `seq`, or a v3 timed frame if `timed`.
+
+        Returns:
+            int: Number of bytes written.
+        """
+        buffer[offset] = FRAME_START_TIMED if timed else FRAME_START
+        buffer[offset + 1] = seq
+        return FRAME_HEADER_BYTES + self.pack_values_into(buffer, values, offset + FRAME_HEADER_BYTES)
+
+    def pack(self, **fields):
+        """
+        Pack the command into a new bytes object.
+        """
+        buffer = bytearray(self.size)
+        n_bytes = self.pack_into(buffer, **fields)
+        return bytes(buffer[:n_bytes])
+
+
+RECORD_COUNT = struct.Struct("<H")  # Number of records, before the records of a command
+
+
+def _struct(fields):
+    return struct.Struct("<" + "".join(WIRE_TYPES[wire_type][0] for _, wire_type in fields))
+
+
+def _check_fields(name, wire_fields, fields):
+    """
+    Convert and range check the values of `wire_fields` in `fields`, for Command.values.
+    """
+    unexpected = set(fields) - {field_name for field_name, _ in wire_fields}
+    if unexpected:
+        raise ValueError(f"{name}: unexpected fields {sorted(unexpected)}")
+    values = []
+    for field_name, wire_type in wire_fields:
+        if field_name not in fields:
+            raise ValueError(f"{name}: missing field '{field_name}'")
+        value = fields[field_name]
+        limits = WIRE_TYPES[wire_type][1]
+        if limits is None:
+            value = value.encode("utf-8") if isinstance(value, str) else bytes(value)
+            if len(value) != 1:
+                raise ValueError(f"{name}: {field_name}={value!r} must be a single character")
+        else:
+            value = int(value)
+            if not limits[0] <= value <= limits[1]:
+                raise ValueError(
+                    f"{name}: {field_name}={value} does not fit in {wire_type} ({limits[0]}-{limits[1]})"
+                )
+        values.append(value)
+    return values
+
+
+def _phasic_fields(mode, amp=True):
+    fields = [
+        ("phase", "char"),
+        ("mode", "char"),
+        ("n", "uint8"),
+        ("duration", "uint16"),
+        ("intertrain_interval", "uint16"),
+    ]
+    if amp:
+        fields.append(("amp", "uint8"))
+    if mode in ["p", "t"]:
+        fields.append(("pulse_duration", "uint8"))
+    if mode == "t":
+        fields.append(("freq", "uint8"))
+    return fields
+
+
+def _ms_field(field_name):
+    return lambda fields: fields[field_name] / 1000
+
+
+def _phasic_sec(fields):
+    return fields["n"] * (fields["duration"] + fields["intertrain_interval"]) / 1000
+
+
+def _gpio_sec(fields):
+    return fields["duration"] / 1000 if fields["mode"] == b"p" else 0.0
+
+
+def _name_table(table):
+    for name, command in table.items():
+        command.name = name
+    return table
+
+
+# Commands for teensy32_firmware
+COMMANDS = _name_table(
+    {
+        # Valves
+        "open_valve": Command("v", fields=[("valve", "uint8")]),
+        # Opto
+        "run_pulse": Command("p", fields=[("duration", "uint16"), ("amp", "uint8")], duration=_ms_field("duration")),
+        "run_train": Command(
+            "t",
+            fields=[
+                ("duration", "uint16"),
+                ("freq", "uint8"),
+                ("amp", "uint8"),
+                ("pulse_duration", "uint8"),
+            ],
+            duration=_ms_field("duration"),
+        ),
+        "phasic_stim_h": Command("a", "p", _phasic_fields("h"), duration=_phasic_sec),
+        "phasic_stim_p": Command("a", "p", _phasic_fields("p"), duration=_phasic_sec),
+        "phasic_stim_t": Command("a", "p", _phasic_fields("t"), duration=_phasic_sec),
+        "turn_on_laser": Command("o", "o", [("amp", "uint8")]),
+        "turn_off_laser": Command("o", "x", [("amp", "uint8")]),
+        "poll_laser_power": Command(
+            "o", "p", [("amp", "uint8")], reply_bytes=2, duration=lambda fields: POLL_LASER_POWER_SEC
+        ),
+        "init_cobalt": Command(
+            "c",
+            "m",
+            [("mode", "char"), ("power_meter_pin", "uint8"), ("null_voltage", "uint8")],
+        ),
+        # Manual GPIO
+        "set_gpio": Command(
+            "m", fields=[("mode", "char"), ("duration", "uint16"), ("pin", "uint8")], duration=_gpio_sec
+        ),
+        # Hering Breuer
+        "start_hb": Command("h", "b"),
+        "end_hb": Command("h", "e"),
+        "phasic_hb_h": Command("a", "h", _phasic_fields("h", amp=False), duration=_phasic_sec),
+        "phasic_hb_p": Command("a", "h", _phasic_fields("p", amp=False), duration=_phasic_sec),
+        "phasic_hb_t": Command("a", "h", _phasic_fields("t", amp=False), duration=_phasic_sec),
+        # Auxiliary
+        "play_tone": Command("a", "a", [("freq", "uint16"), ("duration", "uint16")], duration=_ms_field("duration")),
+        "play_synch": Command("a", "s", duration=lambda fields: SYNCH_SOUND_SEC),
+        "start_camera_trig": Command("a", "vb", [("fps", "uint8")]),
+        "stop_camera_trig": Command("a", "ve", [("fps", "uint8")]),
+        # v2 firmware sends its protocol version before the ACK; v1 firmware only acks
+        "protocol_version": Command("a", "V"),
+        # v3 firmware replies with its micros() and does nothing else
+        "clock_ping": Command("a", "C"),
+        # Stimulus programs (v4)
+        "upload_program": Command("x", "u", records=("steps", PROGRAM_STEP_FIELDS, MAX_PROGRAM_STEPS)),
+        "run_program": Command("x", "r", [("duration", "uint32")], duration=_ms_field("duration")),
+        # Record control
+        "start_recording_ttl": Command("r", "b"),
+        "stop_recording_ttl": Command("r", "e"),
+        # Olfactometer ([S]mell), forwarded by the teensy
+        "open_olfactometer": Command("s", "o", [("valve", "uint8")]),
+        "close_olfactometer": Command("s", "c", [("valve", "uint8")]),
+        "set_olfactometer_valves": Command("s", "b", [("valves", "uint8")]),
+    }
+)
+
+# Commands for the olfactometer firmware when it is connected directly over USB
+OLFACTOMETER_COMMANDS = _name_table(
+    {
+        "open_olfactometer": Command("o", fields=[("valve", "uint8")]),
+        "close_olfactometer": Command("c", fields=[("valve", "uint8")]),
+        "set_olfactometer_valves": Command("b", fields=[("valves", "uint8")]),
+    }
+)
+
+MAX_FRAME_BYTES = FRAME_HEADER_BYTES + max(
+    command.size for table in [COMMANDS, OLFACTOMETER_COMMANDS] for command in table.values()
+)
@@ -0,0 +1,218 @@
+"""
+Dry runs: an experiment script or protocol fast-forwarded on a virtual clock, without hardware.
+
+Checking a script by running it against the simulator still means sitting through every wait, settle and
+firmware-timed train. A dry run puts a ManualClock (see clock.py) under every timing path instead:
+
+    - the Controller's timestamps, waits, settle, the wait dialogs and the repeater/sweep schedules (controller.clock)
+    - the firmware: a simulated teensy on the same clock (teensy_sim.py), where a 15s train moves the clock 15s
+      instead of sleeping, and the device onset times follow it
+    - SpikeGLX: a simulated API (sglx_sim.py) that writes the gates and triggers and counts samples off the clock
+
+Nothing sleeps, so a three hour protocol runs in seconds, and the log table has the times it would have for real.
+Host and USB overheads are not simulated, so those times are the ideal ones, without latency. Two dry runs from the
+same start_sec write identical log tables (benchmarks/bench_dry_run.py checks that).
+
+Run the main(controller) function of a script, or a protocol file, from the command line:
+
+    python dry_run.py scripts/test_experiment_script.py --data-dir /tmp/dry_run
+    python dry_run.py examples/tac_calca_protocol.yaml
+
+or from Python:
+
+    dry_run = DryRun(data_dir="/tmp/dry_run")
+    dry_run.run(main)
+    print(dry_run.report())
+
+Dialogs that wait for the user (user_delay, the laser amplitude and odor map dialogs, preroll's prompts in ttl
+mode) still wait for the user.
+"""
+
+import argparse
+import runpy
+import tempfile
+import time
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+from clock import ManualClock
+from commands import PROTOCOL_VERSION
+from nebPod import Controller
+from protocol import Protocol
+from sglx_sim import SpikeGLXSimulator
+from teensy_sim import TeensySimulator
+
+
+def _format_sec(seconds):
+    minutes, seconds = divmod(seconds, 60)
+    hours, minutes = divmod(int(minutes), 60)
+    return f"{hours}h{minutes:02d}m{seconds:06.3f}s"
+
+
+class DryRun:
+    """
+    A Controller on a virtual clock, with a simulated teensy and SpikeGLX.
+
+    Attributes:
+        clock (ManualClock): The virtual clock.
+        teensy (TeensySimulator): Simulated firmware on the clock.
+        sglx (SpikeGLXSimulator): Simulated SpikeGLX API on the clock, writing to data_dir.
+        controller (Controller): The Controller to run the script on.
+        data_dir (Path): Where the gates, logs and checkpoints go.
+        real_sec (float): Wall time the last run took.
+        virtual_sec (float): Time the last run took on the virtual clock, i.e. how long it would take for real.
+    """
+
+    def __init__(
+        self,
+        data_dir=None,
+        run_name="dry_run",
+        record_control="sglx",
+        protocol_version=PROTOCOL_VERSION,
+        start_sec=None,
+        **controller_kwargs,
+    ):
+        """
+        Args:
+            data_dir (str or Path, optional): Where the gates, logs and checkpoints go. Defaults to a new
+                temporary directory.
+            run_name (str, optional): SpikeGLX run name, in the log filenames. Defaults to "dry_run".
+            record_control (str, optional): "sglx" or "ttl", as for the Controller. Defaults to "sglx".
+            protocol_version (int, optional): Protocol of the simulated firmware. Defaults to the latest.
+            start_sec (float, optional): Time the virtual clock starts at, in seconds since the epoch. Two dry runs
+                from the same start write identical logs. Defaults to now, to the second.
+            **controller_kwargs: Passed to the Controller, e.g. gas_map.
+        """
+        self.data_dir = Path(data_dir or tempfile.mkdtemp(prefix="dry_run_"))
+        self.data_dir.mkdir(parents=True, exist_ok=True)
+        self.clock = ManualClock(start_sec=int(time.time()) if start_sec is None else start_sec)
+        self.teensy = TeensySimulator(loopback=True, protocol_version=protocol_version, clock=self.clock).start()
+        self.sglx = SpikeGLXSimulator(data_dir=self.data_dir, run_name=run_name, latency_sec=0.0, clock=self.clock)
+        self.controller = Controller(
+            None,
+            transport=self.teensy.transport,
+            record_control=record_control,
+            clock=self.clock,
+            sglx=self.sglx,
+            **controller_kwargs,
+        )
+        self.controller.gate_dest_default = self.data_dir
+        if record_control == "ttl":
+            # What get_logname_from_user would ask for
+            self.controller.gate_dest = self.data_dir
+            self.controller.log_filename = f"_cibbrig_log.table.{run_name}.g0.t0.tsv"
+            self.controller.odormap_filename = f"_cibbrig_odors.map.{run_name}.g0.t0.json"
+            self.controller._open_log_journal()
+        self.real_sec = np.nan
+        self.virtual_sec = np.nan
+
+    def run(self, main):
+        """
+        Run main(controller), e.g. the main function of an experiment script.
+
+        Returns:
+            DryRun: self, with real_sec and virtual_sec set.
+        """
+        real_start = time.perf_counter()
+        virtual_start = self.clock.now()
+        try:
+            main(self.controller)
+        finally:
+            self.real_sec = time.perf_counter() - real_start
+            self.virtual_sec = self.clock.now() - virtual_start
+        return self
+
+    def run_protocol(self, protocol):
+        """
+        Run a Protocol, or the protocol file at a path.
+        """
+        if not isinstance(protocol, Protocol):
+            protocol = Protocol.load(protocol)
+        return self.run(protocol.run)
+
+    def timeline(self):
+        """
+        Returns:
+            pd.DataFrame: One row per log label, in order of first onset: category, n, first_onset_sec (from the
+                first entry), total_sec (summed duration of the entries that have one).
+        """
+        log_df = self.controller.log.to_pandas()
+        if len(log_df) == 0:
+            return pd.DataFrame(columns=["label", "category", "n", "first_onset_sec", "total_sec"])
+        log_df["onset_sec"] = log_df["start_time"] - log_df["start_time"].min()
+        log_df["duration_sec"] = log_df["end_time"] - log_df["start_time"]
+        timeline = log_df.groupby("label", sort=False).agg(
+            category=("category", "first"),
+            n=("onset_sec", "size"),
+            first_onset_sec=("onset_sec", "min"),
+            total_sec=("duration_sec", "sum"),
+        )
+        return timeline.sort_values("first_onset_sec").reset_index()
+
+    def report(self):
+        """
+        Returns:
+            str: How long the run would take for real and took here, where the log is, and the timeline.
+        """
+        speedup = self.virtual_sec / self.real_sec if self.real_sec > 0 else np.inf
+        lines = [
+            f"Dry run: {_format_sec(self.virtual_sec)} of experiment in {self.real_sec:.2f}s ({speedup:.0f}x), "
+            f"{len(self.controller.log)} log entries, {len(self.teensy.commands)} commands"
+        ]
+        controller = self.controller
+        if controller.gate_dest is not None and controller.log_filename is not None:
+            lines.append(f"Log: {Path(controller.gate_dest).joinpath(controller.log_filename)}")
+        timeline = self.timeline()
+        for row in timeline.itertuples():
+            lines.append(
+                f"  {_format_sec(row.first_onset_sec)}  {row.label:<24} {row.category:<8} {row.n:>5}x  "
+                f"{row.total_sec:>10.3f}s"
+            )
+        return "\n".join(lines)
+
+    def close(self):
+        """
+        Disconnect the Controller and stop the simulated teensy.
+        """
+        self.controller.disconnect()
+        self.teensy.stop()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Fast-forward an experiment script or protocol on a virtual clock.")
+    parser.add_argument("path", type=Path, help="Script with a main(controller) function, or a protocol file")
+    parser.add_argument("--data-dir", type=Path, help="Where the gates and logs go. Defaults to a temporary directory")
+    parser.add_argument("--run-name", default="dry_run", help="SpikeGLX run name")
+    parser.add_argument("--record-control", default="sglx", choices=["sglx", "ttl"])
+    parser.add_argument("--protocol-version", type=int, default=PROTOCOL_VERSION, help="Simulated firmware protocol")
+    parser.add_argument("--start-sec", type=float, help="Virtual clock start (s since the epoch). Defaults to now")
+    args = parser.parse_args()
+
+    dry_run = DryRun(
+        data_dir=args.data_dir,
+        run_name=args.run_name,
+        record_control=args.record_control,
+        protocol_version=args.protocol_version,
+        start_sec=args.start_sec,
+    )
+    try:
+        if args.path.suffix in [".yaml", ".yml", ".json"]:
+            dry_run.run_protocol(args.path)
+        else:
+            # Runs the script without its __main__ block, which would open the real port
+            script = runpy.run_path(str(args.path), run_name="__dry_run__")
+            if "main" not in script:
+                raise SystemExit(f"{args.path} has no main(controller) function")
+            dry_run.run(script["main"])
+    finally:
+        # Also when the script failed, to show how far it got
+        dry_run.controller.flush_log()
+        dry_run.controller.save_log()
+        print(dry_run.report())
+        dry_run.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -108,9 +108,10 @@ class UserDelay(QDialog):
         continue_button.clicked.connect(self.close)
 
 class WaitDialog(QDialog):
-    def __init__(self, wait_time_sec, msg=None, close_on_finish=True):
+    def __init__(self, wait_time_sec, msg=None, close_on_finish=True, clock=None):
         super().__init__()
         self.wait_time_sec = wait_time_sec
+        self.clock = clock  # e.g. the Controller's, see clock.py. time.time() and time.sleep() if None
         self.msg = msg or "Waiting"
         self.cancelled = False
         self.close_on_finish = close_on_finish
@@ -149,32 +150,44 @@ class WaitDialog(QDialog):
     def wait(self):
         """Execute the wait operation. Returns True if completed, False if cancelled."""
         self.show()
+        if self.clock is not None:
+            completed = self.clock.sleep_until(self.clock.now() + self.wait_time_sec, tick=self.update_remaining)
+            self.finish()
+            return completed
         t_start = time.time()
         
         while time.time() - t_start < self.wait_time_sec:
-            if self.cancelled:
+            if not self.update_remaining(self.wait_time_sec - (time.time() - t_start)):
                 return False
-            remaining = self.wait_time_sec - (time.time() - t_start)
-            progress = int(((time.time() - t_start) / self.wait_time_sec) * 100)
-            self.progress_bar.setValue(progress)
-            # Update remaining time in label
-            minutes = int(remaining // 60)
-            seconds = int(remaining % 60)
-            if minutes > 0:
-                self.label.setText(f"{self.msg}\nRemaining: {minutes:02d}:{seconds:02d}")
-            else:
-                self.label.setText(f"{self.msg}\nRemaining: {remaining:0.0f}s")
-            
-            QApplication.processEvents()
             time.sleep(0.1)
             
+        self.finish()
+        return True
+
+    def update_remaining(self, remaining):
+        """Show the time remaining and process GUI events. Returns False if the wait was cancelled."""
+        if self.cancelled:
+            return False
+        progress = int((1 - remaining / self.wait_time_sec) * 100) if self.wait_time_sec > 0 else 100
+        self.progress_bar.setValue(progress)
+        # Update remaining time in label
+        minutes = int(remaining // 60)
+        seconds = int(remaining % 60)
+        if minutes > 0:
+            self.label.setText(f"{self.msg}\nRemaining: {minutes:02d}:{seconds:02d}")
+        else:
+            self.label.setText(f"{self.msg}\nRemaining: {remaining:0.0f}s")
+
+        QApplication.processEvents()
+        return not self.cancelled
+
+    def finish(self):
+        """Close the dialog, or show the wait as completed if close_on_finish is False."""
         if self.close_on_finish:
             self.close()
         else:
             self.label.setText(f"{self.msg}\nCompleted!")
             self.progress_bar.setValue(100)
-            
-        return True
 
 
 class LaserAmpDialog(QDialog):
@@ -0,0 +1,210 @@
+"""
+Look up the experimental condition at any time from the experiment log.
+
+Labelling spike times with the gas, odor and opto condition active at each one only needs the log. LogIndex
+turns it into sorted interval arrays once, and answers queries for whole arrays of times with np.searchsorted.
+Sorted query times (e.g. spike times) are looked up the other way around, by finding where each interval
+starts in the times, which is much faster for very long queries:
+
+    index = LogIndex.from_tsv(gate_dir / "_cibbrig_log.table.run.g0.t0.tsv")
+    state = index.state_at(spike_times)  # DataFrame with gas, odor, opto and opto_event columns
+
+Conditions follow the rules of Controller.save_log:
+    gas   - every "gas" entry lasts until the next one. The last one lasts until its end_time if it has one
+            (save_log sets it to the save time), otherwise indefinitely.
+    odor  - every "odor" entry that names an odor (present_odor) lasts until the next one. Entries that only
+            switch valves (open/close_olfactometer_valve, set_all_valves) do not say which odor is presented and
+            are skipped.
+    opto  - every "opto" entry covers [start_time, end_time). Entries logged with only a start time (e.g.
+            opto_pulse) last for their duration parameter. Where entries overlap, the one that started last.
+
+Times before the first entry of a kind, or outside every interval, get NaN (gas, odor, opto) and -1 (opto_event).
+Times must be on the same clock as the log: from_tsv and from_controller use times relative to the recording
+start, as in the saved table.
+"""
+
+import numpy as np
+import pandas as pd
+
+QUERY_CHUNK = 2**22  # Bounds the temporary index arrays for very long queries
+
+
+class _Steps:
+    """
+    Piecewise constant categorical state: each value holds from its start until the next start.
+    """
+
+    def __init__(self, starts, names, last_end):
+        order = np.argsort(starts, kind="stable")
+        self.starts = np.asarray(starts, dtype=np.float64)[order]
+        self.categories = pd.unique(np.asarray(names, dtype=object)[order])
+        codes = pd.Categorical(np.asarray(names, dtype=object)[order], categories=self.categories).codes
+        # Code -1 (no state) for times before the first start
+        self._codes = np.concatenate([[-1], codes]).astype(np.int32)
+        self.last_end = last_end
+
+    def codes_at(self, times):
+        if _is_sorted(times):
+            # Find where each step starts in the times instead of looking up every time
+            bounds = np.searchsorted(times, self.starts, side="left")
+            counts = np.diff(np.concatenate([[0], bounds, [len(times)]]))
+            codes = np.repeat(self._codes, counts)
+        else:
+            codes = np.empty(len(times), dtype=np.int32)
+            for offset in range(0, len(times), QUERY_CHUNK):
+                chunk = times[offset : offset + QUERY_CHUNK]
+                codes[offset : offset + QUERY_CHUNK] = self._codes[np.searchsorted(self.starts, chunk, side="right")]
+        if np.isfinite(self.last_end):
+            codes[times >= self.last_end] = -1
+        return codes
+
+    def at(self, times):
+        return pd.Categorical.from_codes(self.codes_at(times), categories=self.categories)
+
+
+class LogIndex:
+    """
+    Interval index over an experiment log.
+
+    Attributes:
+        gas (_Steps): Gas presented over time.
+        odor (_Steps): Odor presented over time.
+        opto (pd.DataFrame): Opto entries sorted by start time, with the end time used for lookups. opto_at returns
+            row numbers of this frame.
+    """
+
+    def __init__(self, log_df):
+        """
+        Args:
+            log_df (pd.DataFrame): Log with label, category, start_time, end_time and parameter columns, as built
+                by LogStore.to_pandas or read from a saved table.
+        """
+        gasses = log_df[log_df["category"] == "gas"]
+        self.gas = _Steps(gasses["start_time"].values, gasses["label"].values, _last_end(gasses))
+
+        odors = log_df[log_df["category"] == "odor"]
+        if "odor" in odors:
+            odors = odors[odors["odor"].notna()]
+            # present_odor's end_time is when the call returned, not when the odor was switched off
+            self.odor = _Steps(odors["start_time"].values, odors["odor"].values, np.nan)
+        else:
+            self.odor = _Steps([], [], np.nan)
+
+        opto = log_df[log_df["category"] == "opto"].sort_values("start_time", kind="stable").reset_index(drop=True)
+        end_time = opto["end_time"].values.astype(np.float64)
+        if "duration" in opto:
+            duration = pd.to_numeric(opto["duration"], errors="coerce").fillna(0.0).values
+        else:
+            duration = np.zeros(len(opto))
+        end_time = np.where(np.isnan(end_time), opto["start_time"].values + duration, end_time)
+        self.opto = opto.assign(end_time=end_time)
+        self._opto_starts = self.opto["start_time"].values.astype(np.float64)
+        self._opto_ends = end_time
+        self._opto_labels = pd.Categorical(self.opto["label"].values)
+
+    @classmethod
+    def from_tsv(cls, path):
+        """
+        Build the index from a saved _cibbrig_log table (times relative to the recording start).
+        """
+        return cls(pd.read_csv(path, sep="\t", index_col=0))
+
+    @classmethod
+    def from_controller(cls, controller):
+        """
+        Build the index from a Controller's log, with times relative to the recording start as in save_log.
+        """
+        log_df = controller.log.to_pandas()
+        base_time = controller.rec_start_time or controller.init_time
+        log_df["start_time"] -= base_time
+        log_df["end_time"] -= base_time
+        return cls(log_df)
+
+    def gas_at(self, times):
+        """
+        Args:
+            times (array-like): Query times in seconds.
+
+        Returns:
+            pd.Categorical: Gas presented at each time.
+        """
+        return self.gas.at(np.asarray(times, dtype=np.float64))
+
+    def odor_at(self, times):
+        """
+        Args:
+            times (array-like): Query times in seconds.
+
+        Returns:
+            pd.Categorical: Odor presented at each time.
+        """
+        return self.odor.at(np.asarray(times, dtype=np.float64))
+
+    def opto_at(self, times):
+        """
+        Args:
+            times (array-like): Query times in seconds.
+
+        Returns:
+            np.ndarray: Row of self.opto for the opto event covering each time, or -1. Where events overlap, the
+                one that started last.
+        """
+        times = np.asarray(times, dtype=np.float64)
+        events = np.full(len(times), -1, dtype=np.int64)
+        if len(self._opto_starts) == 0:
+            return events
+        if not _is_sorted(times):
+            # Overlapping events make the answer depend on every earlier event, so look up the sorted times
+            order = np.argsort(times)
+            events[order] = self.opto_at(times[order])
+            return events
+        # One slice per event, in start order: where events overlap, the one that started last wins
+        first = np.searchsorted(times, self._opto_starts, side="left")
+        last = np.searchsorted(times, self._opto_ends, side="left")
+        for event, (start, stop) in enumerate(zip(first, last)):
+            events[start:stop] = event
+        return events
+
+    def state_at(self, times):
+        """
+        Args:
+            times (array-like): Query times in seconds.
+
+        Returns:
+            pd.DataFrame: gas, odor and opto (label of the opto event) as categoricals, and opto_event (row of
+                self.opto, or -1), one row per time.
+        """
+        times = np.asarray(times, dtype=np.float64)
+        if _is_sorted(times):
+            gas = self.gas.codes_at(times)
+            odor = self.odor.codes_at(times)
+            events = self.opto_at(times)
+        else:
+            # Sort once and use the fast path for every column
+            order = np.argsort(times)
+            sorted_times = times[order]
+            gas, odor, events = (np.empty(len(times), dtype=dtype) for dtype in [np.int32, np.int32, np.int64])
+            gas[order] = self.gas.codes_at(sorted_times)
+            odor[order] = self.odor.codes_at(sorted_times)
+            events[order] = self.opto_at(sorted_times)
+        opto_codes = np.where(events >= 0, self._opto_labels.codes[events], -1)
+        return pd.DataFrame(
+            dict(
+                gas=pd.Categorical.from_codes(gas, categories=self.gas.categories),
+                odor=pd.Categorical.from_codes(odor, categories=self.odor.categories),
+                opto=pd.Categorical.from_codes(opto_codes, categories=self._opto_labels.categories),
+                opto_event=events,
+            )
+        )
+
+def _is_sorted(times):
+    return len(times) < 2 or bool(np.all(times[1:] >= times[:-1]))
+
+
+def _last_end(entries):
+    """
+    End of the last entry of a kind, or NaN if it is open-ended.
+    """
+    if len(entries) == 0:
+        return np.nan
+    return float(entries.sort_values("start_time", kind="stable")["end_time"].values[-1])
@@ -0,0 +1,342 @@
+"""
+Append-only journal of the Controller's log.
+
+Every log entry is written as one line of JSON, so the cost of logging an event does not grow with the length
+of the session. Each line starts with the CRC32 of its JSON, so a line that was only partly written, or that was
+damaged, is recognised and dropped when the journal is read back:
+
+    1a2b3c4d {"label": "opto_pulse", "category": "opto", "start_time": ..., ...}
+
+The derived table (times relative to the recording start, gas presentations extended to the next gas change) is
+only built from the in-memory log when the recording stops or the controller closes (see Controller.save_log).
+
+Entries are written by a LogWriter thread, so a slow disk never holds up the next stimulus. The logging call
+only puts the entry on a bounded queue. A DurabilityPolicy says how often the writer hands what it wrote to the
+operating system (flush) and to the disk (fsync):
+
+    DurabilityPolicy()                                   # flush every 50 entries or 1s, no fsync
+    DurabilityPolicy(flush_every_n=1, write_ahead=True)  # every entry flushed before the logging call returns
+    DurabilityPolicy(flush_every_n=1, fsync=True)        # every entry on disk before the next one is written
+    DurabilityPolicy(write_ahead=True, fsync=True)       # every entry on disk before the logging call returns
+
+The Controller uses WRITE_AHEAD_POLICY unless it is given another policy: an event is logged only after it
+happened, so an entry still queued when the program crashes is an event that happened and left no record. The
+flush hands the entry to the operating system, which survives the program crashing but not the computer losing
+power; it costs a round trip to the writer thread per event (see benchmarks/bench_log.py). Add fsync=True to also
+survive a power cut, or pass DurabilityPolicy() to batch the writes when logging many events per second matters
+more than keeping the last of them.
+
+Controller.flush_log blocks until everything logged so far is written under the policy, and is called by
+stop_recording, close and the excepthook.
+
+The journal sits next to the table, e.g.:
+
+    _cibbrig_log.table.<run>.g0.t0.tsv      - derived table, written at stop_recording/close
+    _cibbrig_log.journal.<run>.g0.t0.jsonl  - raw entries, absolute times, written as they happen
+
+Besides the entries, the journal records what is needed to build the table without the Controller (the
+recording start time, the odor map and the output filenames) as metadata lines. Read a journal back with
+read_journal, or load_journal for the metadata too. recover_log.py rebuilds the table and odor map from a journal
+after a crash:
+
+    python recover_log.py <gate_dir>
+"""
+
+import atexit
+import json
+import os
+import queue
+import threading
+import time
+import zlib
+from pathlib import Path
+
+MAX_QUEUED_ENTRIES = 10000
+META_KEY = "_meta"  # Key of metadata lines. Later values replace earlier ones.
+
+
+def journal_filename(log_filename):
+    """
+    Name of the journal that goes with a log table filename.
+    """
+    return str(Path(log_filename.replace("_log.table.", "_log.journal.")).with_suffix(".jsonl"))
+
+
+def _to_json(value):
+    """
+    Convert the numpy scalars and paths that end up in log entries.
+    """
+    if hasattr(value, "item"):
+        return value.item()
+    return str(value)
+
+
+def encode_record(record):
+    """
+    One journal line: CRC32 of the JSON, a space, the JSON and a newline.
+    """
+    payload = json.dumps(record, default=_to_json)
+    return f"{zlib.crc32(payload.encode('utf-8')):08x} {payload}\n"
+
+
+def decode_record(line):
+    """
+    Inverse of encode_record. Lines without a checksum (journals written before checksums were added) are read as
+    plain JSON.
+
+    Returns:
+        dict: The record, or None if the line is incomplete or does not match its checksum.
+    """
+    if line.startswith("{"):
+        payload = line
+    else:
+        checksum, _, payload = line.partition(" ")
+        payload = payload.rstrip("\n")
+        try:
+            if int(checksum, 16) != zlib.crc32(payload.encode("utf-8")):
+                return None
+        except ValueError:
+            return None
+    try:
+        return json.loads(payload)
+    except json.JSONDecodeError:
+        return None
+
+
+class LogJournal:
+    """
+    Append-only JSON Lines file of log entries.
+
+    Attributes:
+        path (Path): Path of the journal.
+        n_entries (int): Number of entries written by this object.
+    """
+
+    def __init__(self, path):
+        """
+        Args:
+            path (str or Path): Journal to append to. Created if it does not exist.
+        """
+        self.path = Path(path)
+        self.n_entries = 0
+        self._file = open(self.path, "a", encoding="utf-8")
+
+    def append(self, entry):
+        """
+        Write one entry to the file buffer.
+
+        Args:
+            entry (dict): Log entry.
+        """
+        self._file.write(encode_record(entry))
+        self.n_entries += 1
+
+    def append_meta(self, **fields):
+        """
+        Write a metadata line (e.g. rec_start_time, odor_map).
+        """
+        self._file.write(encode_record({META_KEY: fields}))
+
+    def flush(self, fsync=False):
+        """
+        Hand the buffered entries to the operating system, and to the disk if fsync is True.
+        """
+        self._file.flush()
+        if fsync:
+            os.fsync(self._file.fileno())
+
+    def close(self):
+        self._file.close()
+
+
+class DurabilityPolicy:
+    """
+    When the LogWriter flushes the journal. Whichever of flush_every_n and flush_every_sec comes first applies.
+
+    Attributes:
+        flush_every_n (int): Flush after this many entries.
+        flush_every_sec (float): Flush entries that have waited this long.
+        fsync (bool): Also force every flush to the disk.
+        write_ahead (bool): The logging call waits until its entry is written and flushed (and fsynced, if fsync),
+            so every event that was acknowledged is in the journal. Costs a disk round trip per event.
+    """
+
+    def __init__(self, flush_every_n=50, flush_every_sec=1.0, fsync=False, write_ahead=False):
+        assert flush_every_n >= 1, "flush_every_n must be at least 1"
+        self.flush_every_n = flush_every_n
+        self.flush_every_sec = flush_every_sec
+        self.fsync = fsync
+        self.write_ahead = write_ahead
+
+    def __repr__(self):
+        return (
+            f"DurabilityPolicy(flush_every_n={self.flush_every_n}, flush_every_sec={self.flush_every_sec}, "
+            f"fsync={self.fsync}, write_ahead={self.write_ahead})"
+        )
+
+
+WRITE_AHEAD_POLICY = DurabilityPolicy(flush_every_n=1, write_ahead=True)  # The Controller's default
+
+
+class LogWriter(threading.Thread):
+    """
+    Thread that writes log entries to a LogJournal, so that logging never waits on the disk.
+
+    Has the same append/append_meta/close interface as LogJournal, plus flush.
+
+    Attributes:
+        journal (LogJournal): The journal written to.
+        policy (DurabilityPolicy): When entries are flushed.
+        path (Path): Path of the journal.
+        error (Exception): The last write error, or None. Entries are still kept in the Controller's log.
+    """
+
+    def __init__(self, journal, policy=None, max_queued=MAX_QUEUED_ENTRIES):
+        """
+        Args:
+            journal (LogJournal): The journal to write to. Owned by the writer from now on.
+            policy (DurabilityPolicy, optional): Defaults to DurabilityPolicy().
+            max_queued (int, optional): Entries that can wait for the writer before logging blocks. Defaults to 10000.
+        """
+        super().__init__(name="LogWriter", daemon=True)
+        self.journal = journal
+        self.policy = policy or DurabilityPolicy()
+        self.path = journal.path
+        self.error = None
+        self._queue = queue.Queue(maxsize=max_queued)
+        self._closed = False
+        self._warned_full = False
+        self.start()
+        # Entries still queued when the interpreter exits are written out
+        atexit.register(self.close)
+
+    def append(self, entry):
+        """
+        Queue an entry. Blocks only if max_queued entries are already waiting, or until the entry is written if the
+        policy is write_ahead.
+        """
+        self._put(entry)
+        if self.policy.write_ahead:
+            self.flush()
+
+    def append_meta(self, **fields):
+        """
+        Queue a metadata line (see LogJournal.append_meta).
+        """
+        self._put({META_KEY: fields})
+
+    def _put(self, entry):
+        try:
+            self._queue.put_nowait(entry)
+        except queue.Full:
+            if not self._warned_full:
+                print(f"Log writer is {self._queue.maxsize} entries behind, logging waits for the disk")
+                self._warned_full = True
+            self._queue.put(entry)
+
+    def flush(self):
+        """
+        Block until every entry appended so far is written and flushed (and fsynced, if the policy says so).
+        """
+        if self._closed or not self.is_alive():
+            return
+        done = threading.Event()
+        self._queue.put(done)
+        done.wait()
+
+    def close(self):
+        """
+        Write out every queued entry, flush and close the journal. Safe to call more than once.
+        """
+        if self._closed:
+            return
+        self._closed = True
+        self._queue.put(None)
+        self.join()
+        atexit.unregister(self.close)
+
+    def run(self):
+        n_unflushed = 0
+        flush_due = None
+        while True:
+            timeout = None if flush_due is None else max(0.0, flush_due - time.monotonic())
+            try:
+                item = self._queue.get(timeout=timeout)
+            except queue.Empty:
+                item = "flush_every_sec"
+            if isinstance(item, dict):
+                self._write(item)
+                n_unflushed += 1
+                if flush_due is None:
+                    flush_due = time.monotonic() + self.policy.flush_every_sec
+                if n_unflushed < self.policy.flush_every_n and time.monotonic() < flush_due:
+                    continue
+            # Flush on the entry count, the timer, a flush request or close
+            if n_unflushed:
+                self._flush()
+                n_unflushed = 0
+                flush_due = None
+            if isinstance(item, threading.Event):
+                item.set()
+            elif item is None:
+                self.journal.close()
+                return
+
+    def _write(self, entry):
+        try:
+            self.journal.append(entry)
+        except Exception as e:
+            self._report(e)
+
+    def _flush(self):
+        try:
+            self.journal.flush(fsync=self.policy.fsync)
+        except Exception as e:
+            self._report(e)
+
+    def _report(self, error):
+        if self.error is None:
+            print(f"Could not write the log journal {self.path}: {error}. The table is still saved at stop_recording")
+        self.error = error
+
+
+def load_journal(path):
+    """
+    Read the entries and metadata of a journal. Lines that fail their checksum (a partly written last line after a
+    crash, or damage) are skipped.
+
+    Args:
+        path (str or Path): Journal to read.
+
+    Returns:
+        list: Log entries (dicts) in the order they were written.
+        dict: Metadata, the latest value of each field.
+    """
+    entries = []
+    meta = {}
+    n_bad = 0
+    with open(path, encoding="utf-8", errors="replace") as f:
+        for line in f:
+            record = decode_record(line)
+            if record is None:
+                n_bad += 1
+            elif META_KEY in record:
+                meta.update(record[META_KEY])
+            else:
+                entries.append(record)
+    if n_bad:
+        print(f"Skipped {n_bad} damaged or partly written line(s) in {path}")
+    return entries, meta
+
+
+def read_journal(path):
+    """
+    Read the entries of a journal (see load_journal).
+
+    Args:
+        path (str or Path): Journal to read.
+
+    Returns:
+        list: Log entries (dicts) in the order they were written.
+    """
+    return load_journal(path)[0]
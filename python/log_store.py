@@ -0,0 +1,299 @@
+"""
+Columnar in-memory store for the Controller's log.
+
+Log entries are dicts with label, category, start_time and end_time, plus whatever parameters the logged call
+returned. Kept as a list of dicts, every entry carries its own key set and pandas has to infer a sparse,
+object-typed frame from scratch on every save. The LogStore keeps the fixed columns in typed, preallocated
+chunks instead:
+
+    label, category  - int32 codes into a table of the distinct strings (categorical encoding)
+    start_time, end_time - float64
+
+and the parameters in a long side table of (row, key code, value). Appending never copies what is already
+stored, and building a frame is a handful of vectorized operations however long the session.
+
+The store still behaves like the list it replaces for the code that logs: append a dict, len(), iterate over
+(or index) entries as dicts. Export with to_pandas (the same wide frame pd.DataFrame(list_of_dicts) gives),
+to_arrow or to_parquet (pyarrow is only needed for those two).
+"""
+
+import os
+
+import numpy as np
+import pandas as pd
+
+CHUNK_ROWS = 4096
+FIXED_COLUMNS = ["label", "category", "start_time", "end_time"]
+
+
+class _ChunkedColumn:
+    """
+    Growable column of a fixed dtype, stored in preallocated chunks so that appending never copies.
+    """
+
+    def __init__(self, dtype, chunk_rows=CHUNK_ROWS):
+        self.dtype = dtype
+        self.chunk_rows = chunk_rows
+        self._chunks = []
+        self._n = 0
+
+    def append(self, value):
+        offset = self._n % self.chunk_rows
+        if offset == 0:
+            self._chunks.append(np.empty(self.chunk_rows, dtype=self.dtype))
+        self._chunks[-1][offset] = value
+        self._n += 1
+
+    def __getitem__(self, index):
+        return self._chunks[index // self.chunk_rows][index % self.chunk_rows]
+
+    def __len__(self):
+        return self._n
+
+    def values(self):
+        """
+        Returns:
+            np.ndarray: The column as one array.
+        """
+        if not self._chunks:
+            return np.empty(0, dtype=self.dtype)
+        return np.concatenate(self._chunks)[: self._n]
+
+    @property
+    def nbytes(self):
+        return sum(chunk.nbytes for chunk in self._chunks)
+
+
+class _Categories:
+    """
+    Table of distinct strings and their integer codes.
+    """
+
+    def __init__(self):
+        self.names = []
+        self._codes = {}
+
+    def code(self, name):
+        code = self._codes.get(name)
+        if code is None:
+            code = len(self.names)
+            self._codes[name] = code
+            self.names.append(name)
+        return code
+
+
+class LogStore:
+    """
+    Columnar log. Use like the list of entry dicts it replaces.
+
+    Attributes:
+        labels (_Categories): Distinct labels.
+        categories (_Categories): Distinct categories.
+        param_keys (_Categories): Distinct parameter names.
+    """
+
+    def __init__(self, entries=()):
+        """
+        Args:
+            entries (iterable, optional): Entry dicts to start with (e.g. from log_journal.read_journal).
+        """
+        self.clear()
+        for entry in entries:
+            self.append(entry)
+
+    def clear(self):
+        """
+        Remove every entry.
+        """
+        self.labels = _Categories()
+        self.categories = _Categories()
+        self.param_keys = _Categories()
+        self._label = _ChunkedColumn(np.int32)
+        self._category = _ChunkedColumn(np.int32)
+        self._start = _ChunkedColumn(np.float64)
+        self._end = _ChunkedColumn(np.float64)
+        self._param_row = _ChunkedColumn(np.int64)
+        self._param_key = _ChunkedColumn(np.int32)
+        self._param_values = []
+        # First parameter of each entry in the side table, so single entries can be read back without a scan
+        self._param_start = _ChunkedColumn(np.int64)
+
+    def append(self, entry):
+        """
+        Add an entry.
+
+        Args:
+            entry (dict): Must have label and category. start_time and end_time default to NaN. Every other key
+                is a parameter.
+        """
+        row = len(self._label)
+        self._label.append(self.labels.code(entry["label"]))
+        self._category.append(self.categories.code(entry["category"]))
+        start_time = entry.get("start_time")
+        end_time = entry.get("end_time")
+        self._start.append(np.nan if start_time is None else start_time)
+        self._end.append(np.nan if end_time is None else end_time)
+        self._param_start.append(len(self._param_values))
+        for key, value in entry.items():
+            if key in FIXED_COLUMNS:
+                continue
+            self._param_row.append(row)
+            self._param_key.append(self.param_keys.code(key))
+            self._param_values.append(value)
+
+    def __len__(self):
+        return len(self._label)
+
+    def __getitem__(self, index):
+        """
+        Returns:
+            dict: The entry at `index`, as it was appended.
+        """
+        n = len(self)
+        if index < 0:
+            index += n
+        if not 0 <= index < n:
+            raise IndexError("log index out of range")
+        entry = dict(
+            label=self.labels.names[self._label[index]],
+            category=self.categories.names[self._category[index]],
+            start_time=float(self._start[index]),
+            end_time=float(self._end[index]),
+        )
+        stop = self._param_start[index + 1] if index + 1 < n else len(self._param_values)
+        for ii in range(self._param_start[index], stop):
+            entry[self.param_keys.names[self._param_key[ii]]] = self._param_values[ii]
+        return entry
+
+    def __iter__(self):
+        for index in range(len(self)):
+            yield self[index]
+
+    @property
+    def nbytes(self):
+        """
+        Bytes held by the typed columns (parameter values are Python objects and not counted).
+        """
+        columns = [self._label, self._category, self._start, self._end, self._param_row, self._param_key]
+        return sum(column.nbytes for column in columns)
+
+    def to_pandas(self, categorical=False):
+        """
+        Build a frame with one row per entry and one column per fixed field and parameter name. Parameters an
+        entry does not have are NaN, as with pd.DataFrame(list_of_dicts).
+
+        Args:
+            categorical (bool, optional): Return label and category as pandas Categoricals instead of strings.
+                Defaults to False.
+
+        Returns:
+            pd.DataFrame: The log.
+        """
+        n = len(self)
+        label = pd.Categorical.from_codes(
+            self._label.values(), categories=pd.Index(self.labels.names, dtype=object)
+        )
+        category = pd.Categorical.from_codes(
+            self._category.values(), categories=pd.Index(self.categories.names, dtype=object)
+        )
+        columns = dict(
+            label=label if categorical else np.asarray(label, dtype=object),
+            category=category if categorical else np.asarray(category, dtype=object),
+            start_time=self._start.values(),
+            end_time=self._end.values(),
+        )
+        rows = self._param_row.values()
+        keys = self._param_key.values()
+        # fromiter keeps list or tuple parameters as single objects
+        values = np.fromiter(self._param_values, dtype=object, count=len(self._param_values))
+        for code, key in enumerate(self.param_keys.names):
+            mask = keys == code
+            column = np.full(n, np.nan, dtype=object)
+            column[rows[mask]] = values[mask]
+            columns[key] = column
+        return pd.DataFrame(columns).infer_objects()
+
+    def to_arrow(self):
+        """
+        Returns:
+            pyarrow.Table: The log (see frame_to_arrow).
+        """
+        return frame_to_arrow(self.to_pandas(categorical=True))
+
+    def to_parquet(self, path):
+        """
+        Write the log to a Parquet file.
+
+        Args:
+            path (str or Path): File to write.
+        """
+        import pyarrow.parquet as pq
+
+        pq.write_table(self.to_arrow(), path)
+
+
+def log_table(log_df, base_time, end_time):
+    """
+    Derive the saved table from the raw log: times relative to the recording start, and every gas presentation
+    extended until the next gas change (the last one until end_time).
+
+    Args:
+        log_df (pd.DataFrame): Raw log with absolute times (LogStore.to_pandas).
+        base_time (float): Recording start (or init) time.
+        end_time (float): Absolute time the last gas presentation lasts until (e.g. the save time).
+
+    Returns:
+        pd.DataFrame: The table. log_df is modified in place.
+    """
+    log_df["start_time"] -= base_time
+    log_df["end_time"] -= base_time
+
+    # Make gasses extend until next gas change
+    gasses = log_df.query('category=="gas"')
+    end_times = np.concatenate([gasses["start_time"][1:].values, [end_time - base_time]])
+    gasses.loc[:, "end_time"] = end_times
+    log_df.loc[gasses.index, :] = gasses
+    return log_df
+
+
+def replace_atomically(path, write):
+    """
+    Write a file next to `path` and move it into place, so that a crash while writing leaves the previous
+    version of the file, never a truncated one.
+
+    Args:
+        path (Path): File to write.
+        write (callable): Called with the temporary path to write to.
+    """
+    tmp_path = path.with_name(path.name + ".tmp")
+    write(tmp_path)
+    with open(tmp_path, "rb+") as f:
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+
+def frame_to_arrow(log_df):
+    """
+    Convert a log frame (e.g. the derived table built by Controller.save_log) to Arrow.
+
+    Label and category are dictionary encoded. Parameters holding values of several types are stored as strings.
+
+    Args:
+        log_df (pd.DataFrame): Log frame with label, category, start_time, end_time and parameter columns.
+
+    Returns:
+        pyarrow.Table: The log.
+    """
+    import pyarrow as pa
+
+    log_df = log_df.astype({"label": "category", "category": "category"})
+    for key in log_df.columns:
+        if key in FIXED_COLUMNS:
+            continue
+        if pd.api.types.infer_dtype(log_df[key], skipna=True) in ["mixed", "mixed-integer"]:
+            log_df[key] = log_df[key].map(lambda value: None if _is_missing(value) else str(value))
+    return pa.Table.from_pandas(log_df, preserve_index=False)
+
+
+def _is_missing(value):
+    return value is None or (isinstance(value, float) and np.isnan(value))
@@ -19,7 +19,8 @@ Methods for the controller can have decoraters to automatically get start (and o
 e.g.:
     @interval_timer: appends start and stop times to the output of the function
     @event_timer: appends only the start time to the output of the function
-    @logger: appends the output of the function to the log. Optionally (and by default) saves the log to a .tsv file on each call.
+    @logger: appends the output of the function to the log, and writes it to the log journal (see log_journal.py).
+    @saves_log: writes the log table to a .tsv file once the function has returned (e.g. at stop_recording).
 
 Example:
     @logger
@@ -39,7 +40,6 @@ curr_dir = Path(os.getcwd())
 sys.path.append(str(curr_dir))
 sys.path.append(str(curr_dir.parent.joinpath("ArCOM/Python3")))
 
-from ArCOM import ArCOMObject
 import time
 import matplotlib.pyplot as plt
 import numpy as np
@@ -51,6 +51,9 @@ import re
 import os
 import sys
 from functools import wraps
+import inspect
+from concurrent.futures import CancelledError, TimeoutError as FutureTimeoutError
+from collections import Counter
 from pathlib import Path
 from PyQt5.QtWidgets import (
     QApplication,
@@ -63,6 +66,27 @@ from PyQt5.QtWidgets import (
     QMessageBox,
 )
 from gui import UserDelay, WaitDialog, LaserAmpDialog,OdorMapDialog,NumericalInputDialog
+from commands import (
+    COMMANDS,
+    DEFAULT_GAS_MAP,
+    MAX_PROGRAM_STEPS,
+    POLL_LASER_POWER_SEC,
+    PROTOCOL_VERSION,
+    STATUS_NO_PROGRAM,
+    SYNCH_SOUND_SEC,
+)
+from serial_io import SerialIOThread, PipelinedSerialIO, AckTimeoutError
+from transports import open_transport
+from supervisor import DeviceJournal, LinkSupervisor
+from timing_monitor import TimingMonitor
+from clock import SessionClock
+from clock_sync import ClockSync
+from scheduler import LATE_SEC, Schedule
+from stim_program import STEP_TYPES, StimulusProgram
+from sweep import sweep_filename
+from log_journal import WRITE_AHEAD_POLICY, LogJournal, LogWriter, journal_filename
+from log_store import LogStore, frame_to_arrow, log_table, replace_atomically
+from sglx_sync import SYNC_CODES, SampleMap, event_times, sync_map, sync_map_filename, sync_pulse_sec
 
 # Import qwidget
 from PyQt5.QtWidgets import QWidget
@@ -77,17 +101,28 @@ from matplotlib.backends.backend_qt5agg import FigureCanvasQTAgg
 
 SUBJECT_DIR = Path(r"D:\sglx_data")
 
+# Extra time allowed on top of a command's expected firmware duration before an acknowledgement is considered lost
+ACK_TIMEOUT_MARGIN_SEC = 2.0
+OLFACTOMETER_TIMEOUT_SEC = 1.0  # Firmware waits this long for the olfactometer to respond
+OLFACTOMETER_MISSING = 111  # Status byte the firmware sends if the olfactometer did not respond
+CLOCK_SYNC_PINGS = 16  # Clock pings sent when connecting to v3 firmware
+CLOCK_PING_INTERVAL_SEC = 5.0  # Then one ping at most this often, after logged calls
+SCHEDULE_MARGIN_SEC = 0.05  # Progress dialogs finish this long before a scheduled onset (closing one takes ~1ms)
+
+SYNC_COUNT_READS = 4  # SpikeGLX sample counts read around every sync pulse
+
+SGLX_ADDR = "localhost"
+SGLX_PORT = 4142
 sglx_api_path = Path(r"C:\helpers\SpikeGLX-CPP-SDK\Windows\Python\sglx_pkg")
 if not sglx_api_path.exists():
     print(f"SpikeGLX API not found!")
+    sglx_api = None
 else:
     os.environ["PATH"] = str(sglx_api_path) + os.pathsep + os.environ["PATH"]
 
     sys.path.append(str(sglx_api_path))
-    SGLX_ADDR = "localhost"
-    SGLX_PORT = 4142
-    from sglx import *
-    from ctypes import byref, POINTER, c_int, c_short, c_bool, c_char_p
+    import sglx as sglx_api
+from ctypes import byref, c_int, c_bool, c_char_p, c_double
 
 
 def interval_timer(func):
@@ -105,6 +140,8 @@ def interval_timer(func):
     end_time: time the function returned
     params: dictionary of parameters that the function was called with
 
+    Times are read from the controller's clock (see clock.py).
+
     Args:
         func (function): The function to be decorated.
 
@@ -112,10 +149,10 @@ def interval_timer(func):
         function: The wrapped function with start and stop time appended to its output.
     """
     @wraps(func)
-    def wrapper(*args, **kwargs):
-        start_time = time.time()
-        label, category, params = func(*args, **kwargs)
-        end_time = time.time()
+    def wrapper(self, *args, **kwargs):
+        start_time = self.clock.now()
+        label, category, params = func(self, *args, **kwargs)
+        end_time = self.clock.now()
 
         output = dict(
             label=label,
@@ -154,9 +191,9 @@ def event_timer(func):
 
     """
     @wraps(func)
-    def wrapper(*args, **kwargs):
-        start_time = time.time()
-        label, category, params = func(*args, **kwargs)
+    def wrapper(self, *args, **kwargs):
+        start_time = self.clock.now()
+        label, category, params = func(self, *args, **kwargs)
         output = dict(
             label=label,
             category=category,
@@ -171,7 +208,12 @@ def event_timer(func):
 
 def logger(func):
     """
-    Decorator that appends output of a function call to the controller's "log" object.
+    Decorator that appends output of a function call to the controller's "log" object and its journal, followed
+    by any commands the timing monitor flagged in the meantime.
+
+    With v3 firmware, the entry also gets device_onset_time: when the first command sent during the call took
+    effect on the teensy, in host clock time (see clock_sync.py). Repetitions run by repeater and trials run by
+    run_sweep also get their scheduled_time and onset_error (see scheduler.py).
 
     Args:
         func (function): The function to be decorated.
@@ -181,19 +223,73 @@ def logger(func):
     """
     @wraps(func)
     def wrapper(self, *args, log_enabled=True, **kwargs):
-        result = func(self, *args, **kwargs)
+        # Collect the commands submitted during the call, including those of nested calls
+        outer_futures = self._call_futures
+        self._call_futures = []
+        try:
+            result = func(self, *args, **kwargs)
+        finally:
+            futures, self._call_futures = self._call_futures, outer_futures
+            if outer_futures is not None:
+                outer_futures.extend(futures)
         if log_enabled:
-            self.log.append(result)
-            self.save_log(verbose=False)
+            onset_time = self._device_onset_time(futures)
+            if not np.isnan(onset_time):
+                result["device_onset_time"] = onset_time
+            if self._onset is not None and outer_futures is None:
+                # A scheduled repetition or sweep trial (see repeater and run_sweep)
+                schedule, scheduled_time, fields = self._onset
+                self._onset = None
+                result.update(schedule.record(scheduled_time, result["start_time"]), **fields)
+            self._append_log(result)
+            # Commands the timing monitor flagged since the last entry
+            for flag in self.timing.pop_flags():
+                self._append_log(flag)
+        if outer_futures is None:
+            # Between calls the teensy is idle, so a ping gets a short round trip
+            self._ping_if_due()
+            self._sync_if_due()
         return result
 
     return wrapper
 
+def saves_log(func):
+    """
+    Decorator that flushes the log journal and writes the log table (save_log) once the function has returned and
+    been logged. Logged calls only go to the journal, so this is where the derived table gets materialized.
+
+    Args:
+        func (function): The function to be decorated. Put this decorator above @logger.
+
+    Returns:
+        function: The wrapped function.
+    """
+    @wraps(func)
+    def wrapper(self, *args, **kwargs):
+        result = func(self, *args, **kwargs)
+        self.flush_log()
+        self.save_log()
+        return result
+
+    return wrapper
+
+
 def repeater(func):
     """
     Decorator that repeats a function call a specified number of times.
     This needs to be the top level decorator to work properly.
 
+    Repetitions start on a fixed grid, `interval` apart from the first (see scheduler.py), so the time each call
+    takes does not add up over the block. Skipping a wait in its dialog starts the next repetition at once, and
+    the grid moves with it. Each logged repetition gets its scheduled_time and onset_error, and the
+    onset errors are printed at the end. The block ends one interval after the last onset.
+
+    With v4 firmware, n > 1 repetitions of the methods in REPETITION_STEPS are sent as one stimulus program
+    instead (see run_program): the teensy runs the whole block from its own clock and streams back the onset of
+    every repetition, which is logged as its own entry. There is no dialog between repetitions then, so the
+    block cannot be skipped. Pass on_device=False to run it from the host anyway. Blocks that do not fit in a
+    program (more than MAX_PROGRAM_STEPS repetitions, an interval shorter than a repetition) run from the host.
+
     Args:
         func (function): The function to be decorated.
 
@@ -201,7 +297,7 @@ def repeater(func):
         function: The wrapped function with repetition functionality.
     """
     @wraps(func)
-    def wrapper(self, *args, n=None, interval=5, **kwargs):
+    def wrapper(self, *args, n=None, interval=5, on_device=True, **kwargs):
         if n is None:
             func(self, *args, **kwargs)
             return
@@ -213,13 +309,72 @@ def repeater(func):
             msg += f"  - {key}: {value}\n"
         print(msg)
 
+        repetitions = self._repetition_program(func.__name__, n, interval, args, kwargs) if on_device else None
+        if repetitions is not None:
+            program, step_fields = repetitions
+            # The caller's verbose, positional or not (log_enabled belongs to logger)
+            call = inspect.signature(func).bind(
+                self, *args, **{key: value for key, value in kwargs.items() if key != "log_enabled"}
+            )
+            call.apply_defaults()
+            print(f"Running the repetitions from the teensy's clock, {program.duration_sec:.1f}s")
+            # Only the repetitions are logged, as on the host
+            self.run_program(
+                program, verbose=call.arguments.get("verbose", False), step_fields=step_fields, log_enabled=False
+            )
+            return
+
+        schedule = Schedule(self.clock, interval)
         for ii in range(n):
             close_on_finish = True if ii == n-1 else False
             rep_msg = msg + f"\nRepetition {ii+1} of {n}"
-            func(self, *args, **kwargs)
-            self.wait(interval, msg=rep_msg, progress="gui",close_on_finish=close_on_finish)
+            # Picked up by the logger of the call
+            self._onset = (schedule, schedule.onset(ii), {})
+            try:
+                func(self, *args, **kwargs)
+            finally:
+                self._onset = None
+            self._wait_for_onset(schedule, ii + 1, msg=rep_msg, close_on_finish=close_on_finish)
+        self._print_onset_errors(schedule, "repetitions")
 
     return wrapper
+
+
+def _pulse_repetition(program, onset_sec, pulse_duration_sec, amp, verbose=False):
+    program.pulse(onset_sec, pulse_duration_sec, amp)
+
+
+def _train_repetition(program, onset_sec, duration_sec, freq, amp, pulse_duration_sec, verbose=False):
+    program.train(onset_sec, duration_sec, freq, amp, pulse_duration_sec)
+
+
+def _hb_repetition(program, onset_sec, duration, verbose=False):
+    program.hering_breuer(onset_sec, duration)
+
+
+def _gpio_repetition(program, onset_sec, pin, mode, category="event", pulse_duration_sec=0.1, verbose=True):
+    # The checks of set_gpio, the firmware ignores steps on pins it does not have
+    modes = ["pulse", "high", "low"]
+    pins = list(range(8))
+    assert mode in modes, f"Mode must be one of {modes}"
+    assert pin in pins, f"Pin must be one of {pins}"
+    if mode == "pulse":
+        program.gpio_pulse(onset_sec, pin, pulse_duration_sec)
+    else:
+        program.gpio(onset_sec, pin, high=mode == "high")
+    return dict(category=category)
+
+
+# Methods whose repetitions repeater can run as a stimulus program. Each adds one repetition to a program from the
+# method's arguments, and returns the fields to set on the log entries, if any.
+REPETITION_STEPS = {
+    "run_pulse": _pulse_repetition,
+    "run_train": _train_repetition,
+    "timed_hb": _hb_repetition,
+    "set_gpio": _gpio_repetition,
+}
+
+
 class Controller:
     """
     Controller class to manage the communication and control of the NPX rig.
@@ -227,26 +382,50 @@ class Controller:
     Represents a Teensy (or other microcontroller) that is used to control the NPX rig.
 
     Attributes:
-        serial_port (ArCOMObject): The serial port object for communication.
+        serial_port (Transport): The transport to the teensy (see transports.py). ArCOMTransport by default.
         IS_CONNECTED (bool): Connection status.
         gas_map (dict): Mapping of teensy pin to gas.
         ADC_RANGE (int): ADC range.
         V_REF (float): Reference voltage.
         MAX_MILLIWATTAGE (float): Maximum milliwattage for the light meter.
         settle_time_sec (int): Default settle time in seconds.
-        log (list): Log list to store function call outputs.
+        log (LogStore): Columnar log of function call outputs (see log_store.py). Append dicts as to a list.
         rec_start_time (float): Recording start time.
         rec_stop_time (float): Recording stop time.
         gate_dest (Path): Destination path for gate data.
         gate_dest_default (str): Default destination path for gate data.
         log_filename (str): Log filename.
+        log_journal (LogWriter): Writer thread of the append-only log journal, started once log_filename is set.
+        log_policy (DurabilityPolicy): How often the log journal is flushed and fsynced.
         init_time (float): Initialization time.
+        clock (SessionClock): Monotonic clock anchored to wall time at initialization. Every timestamp comes from it.
         laser_command_amps (list): List of Voltages to send to laser command amplitude.
         odor_map (dict): Mapping of odors.
         record_control (str): May be 'sglx' or 'ttl'. If 'sglx', the controller will use the SpikeGLX API to control recording. If 'ttl', the controller will use a TTL pulse to control recording.
         laser_calibration_data (dict): Dictionary to store laser calibration data.
+        commands (dict): Table of serial commands (see commands.py) used to pack messages to the teensy.
+        protocol_version (int): Serial protocol spoken with the teensy. 2 if the firmware supports sequence-numbered
+            frames, 3 if its replies also carry device onset times, 4 if it also runs stimulus programs.
+        desync_bytes (Counter): Stale bytes discarded from the input buffer, by the command they were found at.
+            Stray acknowledgements mean the host and the firmware got out of step.
+        port (str): The port the controller was opened on, reopened if the link drops.
+        journal (DeviceJournal): Last device state set by the commands sent so far (see supervisor.py).
+        supervisor (LinkSupervisor): Reconnects if the link to the teensy drops. None if reconnecting is disabled.
+        timing (TimingMonitor): Acknowledgement times against expected firmware durations (see timing_monitor.py).
+        clock_sync (ClockSync): Device to host clock mapping, from clock pings (v3 firmware, see clock_sync.py).
+        clock_ping_interval_sec (float): Least time between the clock pings sent after logged calls.
+        sglx: The SpikeGLX API, the sglx module of the SpikeGLX-CPP-SDK or a stand-in (see sglx_sim.py). None if
+            neither is available.
+        sample_map (SampleMap): Host time to SpikeGLX sample index mapping, from sync pulses (see sglx_sync.py).
+        sync_method (str): How sync pulses are emitted: 'gpio' (a coded pulse on sync_pin) or 'audio' (play_synch).
+        sync_pin (int): GP pin wired to a sync input of the recording, for the 'gpio' method. None if not wired.
+        sync_interval_sec (float): Least time between the sync pulses emitted after logged calls while recording
+            via SpikeGLX. None to only emit them with emit_sync.
+        _io (SerialIOThread or PipelinedSerialIO): Owns the serial port and runs submitted commands.
     """
 
+    commands = COMMANDS
+
     def __init__(
         self,
         port,
@@ -254,55 +433,103 @@ class Controller:
         cobalt_mode="S",
         null_voltage=0.4,
         record_control="sglx",
+        transport=None,
+        reconnect=True,
+        log_policy=None,
+        clock=None,
+        sglx=None,
+        sync_pin=None,
+        sync_interval_sec=None,
     ):
         """
         Initialize the Controller object.
 
         Args:
-            port (str): The serial port for communication (e.g. COM11).
+            port (str): The serial port for communication (e.g. COM11). Also accepts "tcp://host:port" and
+                "serial://<port>" (pyserial without ArCOM), see transports.open_transport.
             gas_map (dict, optional): Mapping of teensy pin to gas. Defaults to None.
             cobalt_mode (str, optional): Mode for cobalt control. Defaults to "S".
             null_voltage (float, optional): Null voltage for cobalt control. Defaults to 0.4.
-        """
+            transport (Transport, optional): Already open transport to use instead of opening `port`. Defaults to None.
+            reconnect (bool, optional): Reopen `port` and restore the device state if the link drops. Defaults to True.
+            log_policy (DurabilityPolicy, optional): How often the log journal is flushed and fsynced (see
+                log_journal.py). Defaults to WRITE_AHEAD_POLICY: every entry is flushed before the logging call
+                returns. Pass DurabilityPolicy() to batch the writes instead.
+            clock (SessionClock, optional): Clock for every timestamp and wait, e.g. a ManualClock in tests (see
+                clock.py). Defaults to a SessionClock anchored now.
+            sglx (optional): SpikeGLX API to use instead of the sglx module, e.g. a SpikeGLXSimulator (see
+                sglx_sim.py). Defaults to the sglx module if it was found.
+            sync_pin (int, optional): GP pin wired to a sync input of the recording. Pin 0 drives the laser, GP pin 1
+                is teensy pin 11. Defaults to None: no pin is pulsed unless one is given.
+            sync_interval_sec (float, optional): Emit a sync pulse after logged calls at least this often while
+                recording via SpikeGLX, e.g. 30. Needs sync_pin, or sync_method set to 'audio'. Defaults to None:
+                sync pulses are only emitted with emit_sync.
+        """
+        self.clock = clock or SessionClock()
+        self.clock_sync = ClockSync()
+        self.clock_ping_interval_sec = CLOCK_PING_INTERVAL_SEC
+        self._call_futures = None
+        self._onset = None
+        self._last_ping_time = -np.inf
+        self.sglx = sglx or sglx_api
+        self.sample_map = SampleMap()
+        self.sync_method = "gpio"
+        self.sync_pin = sync_pin
+        self.sync_interval_sec = sync_interval_sec
+        self._syncing = False
+        self._last_sync_time = -np.inf
+        self._sync_index = 0
+        self.port = port
+        self.protocol_version = 1
+        self.desync_bytes = Counter()
+        self.journal = DeviceJournal()
+        self.timing = TimingMonitor(clock=self.clock)
+        self.supervisor = LinkSupervisor(self) if reconnect and port is not None else None
+        self.IS_CONNECTED = False
         try:
-            self.serial_port = ArCOMObject(
-                port, 115200
+            self.serial_port = transport or open_transport(
+                port
             )  # Replace 'COM11' with the actual port of your Arduino
-            self.IS_CONNECTED = True
-            print("Connected!")
-        except:
-            self.IS_CONNECTED = False
+        except Exception:
             print(
                 f"No Serial port found on {port}. GUI will show up but not do anything"
             )
+        else:
+            # All serial traffic goes through self._io from now on
+            self._start_io()
+            try:
+                self._negotiate_protocol()
+            except Exception:
+                # The port opened but the teensy did not answer: release the port, don't pretend it is missing
+                print(f"Opened {port} but protocol negotiation with the teensy failed")
+                self.disconnect()
+                raise
+            self.IS_CONNECTED = True
+            print("Connected!")
 
         # If an uncaught error occurs, close the controller
         sys.excepthook = self.handle_exception
         
         # Initialize the GUI
-        self.app = QApplication(sys.argv)
+        self.app = QApplication.instance() or QApplication(sys.argv)
 
         # Set the gas map if supplied. This maps the teensy pin to the gas
-        self.gas_map = gas_map or {
-            0: "O2",
-            1: "room air",
-            2: "hypercapnia",
-            3: "hypoxia",
-            4: "N2",
-        }
+        self.gas_map = gas_map or dict(DEFAULT_GAS_MAP)
         self.ADC_RANGE = 8191  # 13bit adc range (TODO: read from teeensy)
         self.V_REF = 3.3  # Teensy 3.2 vref
         self.MAX_MILLIWATTAGE = (
             310.0  # Thorlabs light meter max range to scale the photometer calibration
         )
         self.settle_time_sec = 15 * 60  # Default settle time
-        self.log = []  # Initialize the log list
+        self.log = LogStore()  # Initialize the log
         self.rec_start_time = None
         self.rec_stop_time = None
         self.gate_dest = None
         self.gate_dest_default = SUBJECT_DIR
         self.log_filename = None
-        self.init_time = time.time()
+        self.log_journal = None
+        self.log_policy = WRITE_AHEAD_POLICY if log_policy is None else log_policy
+        self.init_time = self.clock.now()
         if cobalt_mode == "B":
             null_voltage = 0
         self.init_cobalt(
@@ -321,8 +548,11 @@ class Controller:
         """
         Connect to the SpikeGLX server.
         """
-        self.sglx_handle = c_sglx_createHandle()
-        ok = c_sglx_connect(self.sglx_handle, SGLX_ADDR.encode(), SGLX_PORT)
+        if self.sglx is None:
+            print("SpikeGLX API not found, cannot connect to SpikeGLX")
+            return False
+        self.sglx_handle = self.sglx.c_sglx_createHandle()
+        ok = self.sglx.c_sglx_connect(self.sglx_handle, SGLX_ADDR.encode(), SGLX_PORT)
         if ok:
             print("Connected to SpikeGLX")
         else:
@@ -336,6 +566,8 @@ class Controller:
         Handle uncaught exceptions.
         """
         print("Uncaught exception:", exc_type, exc_value)
+        # Whatever close manages to do, the entries logged so far are on disk
+        self.flush_log()
         self.close()
 
     @logger
@@ -351,9 +583,7 @@ class Controller:
         Returns:
             dict: Output dictionary with function call details.
         """
-        self.serial_port.serialObject.write("v".encode("utf-8"))
-        self.serial_port.write(valve_number, "uint8")
-        self.block_until_read()
+        self._command("open_valve", valve=valve_number)
         # Write to log as either the gas presented or the valve number opened.
         if log_style == "gas":
             label = f"{self.gas_map[valve_number]}"
@@ -401,9 +631,7 @@ class Controller:
         print("End hering breuer") if verbose else None
 
         # Send the command to the teensy
-        self.serial_port.serialObject.write("h".encode("utf-8"))
-        self.serial_port.serialObject.write("e".encode("utf-8"))
-        self.block_until_read()
+        self._command("end_hb")
 
         return ("end_heringbreuer", "event", {})
 
@@ -418,9 +646,7 @@ class Controller:
         print("start hering breuer") if verbose else None
 
         # Send the command to the teensy
-        self.serial_port.serialObject.write("h".encode("utf-8"))
-        self.serial_port.serialObject.write("b".encode("utf-8"))
-        self.block_until_read()
+        self._command("start_hb")
         return ("start_heringbreuer", "event", {})
 
     @repeater
@@ -435,7 +661,7 @@ class Controller:
         print(f"Run hering breuer for {duration}s") if verbose else None
 
         self.start_hb(log_enabled=False)
-        time.sleep(duration)
+        self.clock.sleep(duration)
         self.end_hb(log_enabled=False)
         return ("hering_breuer", "event", {"duration": duration})
 
@@ -507,22 +733,24 @@ class Controller:
         intertrain_interval_ms = sec2ms(intertrain_interval_sec)
         duration_ms = sec2ms(duration_sec)
 
-        self.empty_read_buffer()
-        self.serial_port.serialObject.write("a".encode("utf-8"))
-        self.serial_port.serialObject.write("h".encode("utf-8"))
-        self.serial_port.serialObject.write(phase.encode("utf-8"))
-        self.serial_port.serialObject.write(mode.encode("utf-8"))
-        self.serial_port.write(n, "uint8")
-        self.serial_port.write(duration_ms, "uint16")
-        self.serial_port.write(intertrain_interval_ms, "uint16")
+        fields = dict(
+            phase=phase,
+            mode=mode,
+            n=n,
+            duration=duration_ms,
+            intertrain_interval=intertrain_interval_ms,
+        )
         if mode == "t":
-            self.serial_port.write(pulse_dur_ms, "uint8")
-            self.serial_port.write(int(freq), "uint8")
-
+            fields.update(pulse_duration=pulse_dur_ms, freq=freq)
         if mode == "p":
-            self.serial_port.write(pulse_dur_ms, "uint8")
+            fields.update(pulse_duration=pulse_dur_ms)
 
-        self.block_until_read()
+        self._command(
+            f"phasic_hb_{mode}",
+            expected_sec=n * (duration_sec + intertrain_interval_sec),
+            drain=True,
+            **fields,
+        )
 
         label = "hering_breuer_phasic"
         params_out = dict(
@@ -553,12 +781,12 @@ class Controller:
             None
         """
         null_voltage_uint8 = int(255 * null_voltage)
-        self.serial_port.serialObject.write("c".encode("utf-8"))
-        self.serial_port.serialObject.write("m".encode("utf-8"))
-        self.serial_port.serialObject.write(mode.encode("utf-8"))
-        self.serial_port.write(power_meter_pin, "uint8")
-        self.serial_port.write(null_voltage_uint8, "uint8")
-        self.block_until_read()
+        self._command(
+            "init_cobalt",
+            mode=mode,
+            power_meter_pin=power_meter_pin,
+            null_voltage=null_voltage_uint8,
+        )
         print(
             f"initialized cobalt with mode {mode} and power meter pin {power_meter_pin}"
         ) if verbose else None
@@ -584,10 +812,9 @@ class Controller:
         amp_int = self._amp2int(amp)
 
         # Send the command to the teensy
-        self.serial_port.serialObject.write("p".encode("utf-8"))
-        self.serial_port.write(duration, "uint16")
-        self.serial_port.write(amp_int, "uint8")
-        self.block_until_read()
+        self._command(
+            "run_pulse", expected_sec=pulse_duration_sec, duration=duration, amp=amp_int
+        )
 
         label = "opto_pulse"
         params_out = dict(amplitude=amp, duration=pulse_duration_sec)
@@ -619,16 +846,18 @@ class Controller:
             f"Running opto train:\n\tAmplitude:{amp:.2f}V\n\tFrequency:{freq:.1f}Hz\n\tPulse duration:{pulse_duration}ms\n\tTrain duration:{duration_sec:.3f}s"
         ) if verbose else None
 
-        self.empty_read_buffer()
         amp_int = self._amp2int(amp)
 
         # Send the command to the teensy
-        self.serial_port.serialObject.write("t".encode("utf-8"))
-        self.serial_port.write(duration, "uint16")
-        self.serial_port.write(freq, "uint8")
-        self.serial_port.write(amp_int, "uint8")
-        self.serial_port.write(pulse_duration, "uint8")
-        self.block_until_read()
+        self._command(
+            "run_train",
+            expected_sec=duration_sec,
+            drain=True,
+            duration=duration,
+            freq=freq,
+            amp=amp_int,
+            pulse_duration=pulse_duration,
+        )
 
         label = "opto_train"
         params_out = dict(
@@ -639,6 +868,138 @@ class Controller:
         )
         return (label, "opto", params_out)
 
+    @logger
+    @interval_timer
+    def run_program(self, program, verbose=False, step_fields=None, log_steps=True):
+        """
+        Upload a stimulus program and run it from the teensy's own clock (v4 firmware, see stim_program.py).
+
+        Blocks until the program's duration is up. Every step is logged as its own entry, with the label and params
+        of the Controller method that does the same (e.g. opto_pulse), the device onset in host clock time as
+        start_time and device_onset_time, and its scheduled_time and onset_error against the start of the program.
+        The onset errors are measured on the device clock, so they do not include the link. log_enabled=False only
+        leaves out the entry of the program itself, log_steps=False those of the steps.
+
+        Args:
+            program (StimulusProgram): The steps to run.
+            verbose (bool, optional): Print the onset errors. Defaults to False.
+            step_fields (dict, optional): Fields to set on the entry of every step, e.g. its category.
+            log_steps (bool, optional): Log every step as its own entry. Defaults to True.
+
+        Raises:
+            ValueError: If the program does not compile, or the firmware does not run programs.
+
+        Returns:
+            tuple: A tuple containing:
+                - label (str): 'stim_program'
+                - category (str): 'event'
+                - params_out (dict): Number of steps, duration, and the number of steps that started late.
+        """
+        if self.protocol_version < 4:
+            raise ValueError(f"Stimulus programs need v4 firmware, the teensy speaks v{self.protocol_version}")
+        records = program.compile()
+        steps = program.ordered_steps()
+        duration_sec = program.duration_sec
+        self.submit("upload_program", steps=records)
+        reply = self._command("run_program", expected_sec=duration_sec, duration=round(duration_sec * 1000))
+        if reply.status == bytes([STATUS_NO_PROGRAM]):
+            raise ValueError("The teensy has no program to run")
+
+        start_time = self.clock_sync.to_host(reply.onset_us)
+        errors = []
+        for index, onset_us, _ in reply.records:
+            step = steps[index]
+            step_type = STEP_TYPES[step[0]]
+            # micros() wraps every 71 minutes
+            onset_error = ((onset_us - reply.onset_us) % 2**32) / 1e6 - step[1]
+            errors.append(onset_error)
+            onset_time = self.clock_sync.to_host(onset_us)
+            busy_sec = program.busy_sec(step)
+            entry = dict(
+                label=step_type.label,
+                category=step_type.category,
+                start_time=onset_time,
+                end_time=onset_time + busy_sec if busy_sec > 0 else np.nan,
+                device_onset_time=onset_time,
+                scheduled_time=start_time + step[1],
+                onset_error=onset_error,
+                program_step=index,
+                **step_type.params(step[2]),
+            )
+            entry.update(step_fields or {})
+            if log_steps:
+                self._append_log(entry)
+        errors = np.array(errors)
+        n_late = int((errors > LATE_SEC).sum())
+        if len(errors) < len(steps):
+            print(f"Only {len(errors)} of {len(steps)} program steps reported back")
+        if verbose and len(errors) > 0:
+            print(
+                f"Program of {len(steps)} steps: onset error mean {1e3 * errors.mean():.3f}ms, "
+                f"max {1e3 * np.abs(errors).max():.3f}ms, {n_late} late"
+            )
+        params_out = dict(n_steps=len(steps), duration=duration_sec, n_reported=len(errors), n_late=n_late)
+        return ("stim_program", "event", params_out)
+
+    def run_sweep(self, sweep, verbose=True):
+        """
+        Run a parameter sweep (see sweep.py): every trial of its schedule, in order, on a fixed grid.
+
+        The sweep is checked against the gas and odor maps before anything is sent. Its definition, seed and
+        schedule are saved next to the log (sweep_filename), with the clock time of the first onset. Every trial is
+        logged by the method it calls, with its scheduled_time, onset_error, and the sweep and sweep_trial it
+        belongs to. Skipping a wait starts the next trial at once, and the grid moves with it.
+
+        Args:
+            sweep (Sweep): The sweep to run.
+            verbose (bool, optional): Print the sweep report and every trial. Defaults to True.
+
+        Raises:
+            ProtocolError: If a condition does not compile or does not fit the interval.
+        """
+        sweep.check(self.gas_map, self.odor_map, self.settle_time_sec)
+        print(sweep.report()) if verbose else None
+        trials = sweep.trials()
+        schedule = Schedule(self.clock, sweep.interval_sec, start=self.clock.now() + SCHEDULE_MARGIN_SEC)
+        self.save_sweep(sweep, start_time=schedule.start)
+        self.clock.sleep_until(schedule.onset(0))
+        for ii, kwargs in enumerate(trials):
+            if verbose:
+                print(f"Sweep {sweep.name} trial {ii + 1} of {len(trials)}: {sweep.method}({kwargs})")
+            # Picked up by the logger of the call
+            self._onset = (schedule, schedule.onset(ii), dict(sweep=sweep.name, sweep_trial=ii))
+            try:
+                getattr(self, sweep.method)(**kwargs)
+            finally:
+                self._onset = None
+            self._wait_for_onset(
+                schedule,
+                ii + 1,
+                msg=f"Sweep {sweep.name}: trial {ii + 1} of {len(trials)} done",
+                close_on_finish=ii == len(trials) - 1,
+            )
+        self._print_onset_errors(schedule, "trials")
+        self.flush_log()
+        self.save_log(verbose=verbose)
+
+    def save_sweep(self, sweep, start_time=None, path=None):
+        """
+        Save a sweep's definition, seed and schedule next to the log, so that Sweep.load rebuilds it exactly.
+
+        Args:
+            sweep (Sweep): The sweep.
+            start_time (float, optional): Clock time of its first onset.
+            path (str or Path, optional): Directory to save to. Defaults to the gate destination or SUBJECT_DIR.
+        """
+        if self.log_filename is None:
+            print(f"Sweep {sweep.name} NOT SAVED!!! No log filename is set")
+            return
+        path = Path(self.gate_dest or path or SUBJECT_DIR)
+        save_fn = path.joinpath(sweep_filename(self.log_filename, sweep.name))
+        sweep_json = json.dumps(sweep.to_dict(start_time=start_time), indent=1)
+        replace_atomically(save_fn, lambda tmp_fn: tmp_fn.write_text(sweep_json))
+        print(f"Sweep {sweep.name} saved to {save_fn}")
+
     @logger
     @interval_timer
     def run_tagging(
@@ -647,7 +1008,8 @@ class Controller:
         """
         Run a preset train that is specific for opto-tagging.
 
-        Passes the parameters to the run_pulse function which sends the command to the teensy.
+        With v4 firmware, the pulses run as a stimulus program on the teensy's clock (see run_program). Otherwise
+        each pulse is sent by run_pulse from a host loop. Either way only the opto_tagging entry is logged.
 
         Args:
             n (int, optional): Number of tagging stimulations. Defaults to 75.
@@ -664,11 +1026,20 @@ class Controller:
         if verbose:
             print("running opto tagging")
         self.empty_read_buffer()
-        for ii in range(n):
+        if self.protocol_version >= 4 and n <= MAX_PROGRAM_STEPS:
+            period_sec = pulse_duration_sec + ipi_sec
+            program = StimulusProgram(duration_sec=n * period_sec)
+            for ii in range(n):
+                program.pulse(ii * period_sec, pulse_duration_sec, amp)
             if verbose:
-                print(f"\ttag {pulse_duration_ms}ms stim: {ii + 1} of {n}. amp: {amp} ")
-            self.run_pulse(pulse_duration_sec, amp, log_enabled=False)
-            time.sleep(ipi_sec)
+                print(f"\t{n} tags of {pulse_duration_ms}ms, amp: {amp}, on the teensy clock")
+            self.run_program(program, verbose=verbose, log_steps=False, log_enabled=False)
+        else:
+            for ii in range(n):
+                if verbose:
+                    print(f"\ttag {pulse_duration_ms}ms stim: {ii + 1} of {n}. amp: {amp} ")
+                self.run_pulse(pulse_duration_sec, amp, log_enabled=False)
+                self.clock.sleep(ipi_sec)
 
         label = "opto_tagging"
         params_out = dict(
@@ -743,25 +1114,24 @@ class Controller:
         intertrain_interval_ms = sec2ms(intertrain_interval_sec)
         duration_ms = sec2ms(duration_sec)
 
-        # Send the command to the teensy
-        self.empty_read_buffer()
         amp_int = self._amp2int(amp)
-        self.serial_port.serialObject.write("a".encode("utf-8"))
-        self.serial_port.serialObject.write("p".encode("utf-8"))
-        self.serial_port.serialObject.write(phase.encode("utf-8"))
-        self.serial_port.serialObject.write(mode.encode("utf-8"))
-        self.serial_port.write(1, "uint8") # this is leftover from some unfixed teensy code which allowed user to set the number of stimulations
-        self.serial_port.write(duration_ms, "uint16")
-        self.serial_port.write(intertrain_interval_ms, "uint16")
-        self.serial_port.write(amp_int, "uint8")
+        fields = dict(
+            phase=phase,
+            mode=mode,
+            n=1,  # this is leftover from some unfixed teensy code which allowed user to set the number of stimulations
+            duration=duration_ms,
+            intertrain_interval=intertrain_interval_ms,
+            amp=amp_int,
+        )
         if mode == "t":
-            self.serial_port.write(pulse_dur_ms, "uint8")
-            self.serial_port.write(int(freq), "uint8")
-
+            fields.update(pulse_duration=pulse_dur_ms, freq=freq)
         if mode == "p":
-            self.serial_port.write(pulse_dur_ms, "uint8")
+            fields.update(pulse_duration=pulse_dur_ms)
 
-        self.block_until_read()
+        # Send the command to the teensy
+        self._command(
+            f"phasic_stim_{mode}", expected_sec=duration_sec, drain=True, **fields
+        )
 
         label = f"opto_phasic"
         params_out = dict(
@@ -785,10 +1155,7 @@ class Controller:
         """
         print(f"Turning on laser at amp: {amp}") if verbose else None
         amp_int = self._amp2int(amp)
-        self.serial_port.serialObject.write("o".encode("utf-8"))
-        self.serial_port.serialObject.write("o".encode("utf-8"))
-        self.serial_port.write(amp_int, "uint8")
-        self.block_until_read()
+        self._command("turn_on_laser", amp=amp_int)
 
     def turn_off_laser(self, amp, verbose=False):
         """
@@ -800,10 +1167,7 @@ class Controller:
         """
         print(f"Turning off laser from amp: {amp}") if verbose else None
         amp_int = self._amp2int(amp)
-        self.serial_port.serialObject.write("o".encode("utf-8"))
-        self.serial_port.serialObject.write("x".encode("utf-8"))
-        self.serial_port.write(amp_int, "uint8")
-        self.block_until_read()
+        self._command("turn_off_laser", amp=amp_int)
 
     def set_max_milliwattage(self, val):
         """
@@ -840,20 +1204,18 @@ class Controller:
         print(f"Testing amplitude: {amp}") if verbose else None
 
         # Send the command to the teensy
-        self.empty_read_buffer()
+        reply = self._command(
+            "poll_laser_power",
+            expected_sec=POLL_LASER_POWER_SEC,
+            drain=True,
+            amp=amp_int,
+        )
 
-        self.serial_port.serialObject.write("o".encode("utf-8"))
-        self.serial_port.serialObject.write("p".encode("utf-8"))
-        self.serial_port.write(amp_int, "uint8")
-        while self.serial_port.bytesAvailable() < 2:
-            time.sleep(0.005)
-        
         # Convert the serial uint16 read to a voltage or power
-        power_int = self.serial_port.read(1, "uint16")  # Power as a 10bit integer
+        power_int = int.from_bytes(reply.payload, "little")  # Power as a 10bit integer
         print(power_int)
         power_v = power_int / self.ADC_RANGE * self.V_REF  # Powerr as a voltage
         power_mw = (power_v / 2.0) * self.MAX_MILLIWATTAGE  # power in milliwatts
-        self.block_until_read()
 
         if output == "v":
             return power_v
@@ -940,15 +1302,17 @@ class Controller:
                 - category (str): 'event'
                 - params_out (dict): Dictionary with 'frequency' and 'duration' of the tone.
         """
-        self.empty_read_buffer()
         duration_ms = sec2ms(duration_sec)
         print(
             f"Playing audio tone: frequency{freq}, duration:{duration_sec:.3f} (s)"
         ) if verbose else None
-        self.serial_port.serialObject.write("aa".encode("utf-8"))
-        self.serial_port.write(int(freq), "uint16")
-        self.serial_port.write(int(duration_ms), "uint16")
-        self.block_until_read()
+        self._command(
+            "play_tone",
+            expected_sec=duration_sec,
+            drain=True,
+            freq=freq,
+            duration=duration_ms,
+        )
 
         label = "tone"
         params_out = dict(frequency=freq, duration=duration_sec)
@@ -1010,8 +1374,16 @@ class Controller:
         ]
         durations = np.array([1, 1, 1, 1, 1, 1, 2, 1, 1, 1, 1, 1, 1, 2]) * 0.25
         print("Playing twinkle twinkle little star :)") if verbose else None
-        for note, duration in zip(melody, durations):
-            self.play_tone(note, duration, verbose=False, log_enabled=False)
+        if self.protocol_version >= 4:
+            # Notes back to back on the teensy clock, tones play in the background
+            onsets = np.cumsum(durations) - durations
+            program = StimulusProgram(duration_sec=durations.sum())
+            for onset, note, duration in zip(onsets, melody, durations):
+                program.tone(onset, note, duration)
+            self.run_program(program, log_enabled=False)
+        else:
+            for note, duration in zip(melody, durations):
+                self.play_tone(note, duration, verbose=False, log_enabled=False)
         return ("audio_alert_ttls", "event", {})
 
     @logger
@@ -1030,9 +1402,7 @@ class Controller:
                 - params_out (dict): Empty dictionary.
         """
         print("Running audio synch sound") if verbose else None
-        self.serial_port.serialObject.write("a".encode("utf-8"))
-        self.serial_port.serialObject.write("s".encode("utf-8"))
-        self.block_until_read()
+        self._command("play_synch", expected_sec=SYNCH_SOUND_SEC)
 
         return ("audio_synch", "event", {})
 
@@ -1064,12 +1434,14 @@ class Controller:
         print(
             "=" * 50 + f"\nStarting recording via {self.record_control}!\n" + "=" * 50
         ) if verbose else None
-        self.rec_start_time = time.time()
+        self.rec_start_time = self.clock.now()
+        self._journal_meta()
 
         self.play_alert() if not silent else None
 
         return ("rec_start", "event", {})
 
+    @saves_log
     @logger
     @event_timer
     def stop_recording(self, silent=False, reset_to_O2=False, verbose=True):
@@ -1104,8 +1476,7 @@ class Controller:
         if reset_to_O2:
             self.present_gas("O2", 1, verbose=False, progress=False)
 
-        self.rec_stop_time = time.time()
-        self.save_log()
+        self.rec_stop_time = self.clock.now()
         return ("rec_stop", "event", {})
 
     def start_recording_TTL(self):
@@ -1124,10 +1495,7 @@ class Controller:
                 - params_out (dict): Empty dictionary.
         """
 
-        self.empty_read_buffer()
-        self.serial_port.serialObject.write("r".encode("utf-8"))
-        self.serial_port.serialObject.write("b".encode("utf-8"))
-        self.block_until_read()
+        self._command("start_recording_ttl", drain=True)
 
     def check_is_running(self):
         """
@@ -1142,7 +1510,7 @@ class Controller:
                 self.connect_to_sglx()
             except:
                 raise ValueError("Could not connect to spikeGLX")
-        ok = c_sglx_isRunning(byref(running), self.sglx_handle)
+        ok = self.sglx.c_sglx_isRunning(byref(running), self.sglx_handle)
         if not running.value:
             raise ValueError(
                 "SpikeGLX is not running. Start a run (i.e. active spikeglx window)."
@@ -1160,11 +1528,11 @@ class Controller:
 
         self.check_is_running()
 
-        self.log = []  # Reset the log.
+        self.log.clear()  # Reset the log.
         self.generate_recording_names(increment_gate=increment_gate)
 
         fn = c_char_p(str(self.recname).encode())
-        c_sglx_setNextFileName(self.sglx_handle, fn)
+        self.sglx.c_sglx_setNextFileName(self.sglx_handle, fn)
 
         # If laser_calibration data exists, save it to the opto_calibration.json in the gate folder
         if self.laser_calibration_data is not None:
@@ -1175,16 +1543,19 @@ class Controller:
                 json.dump(self.laser_calibration_data, f)
 
         # Enable recording
-        ok = c_sglx_setRecordingEnable(self.sglx_handle, c_bool(True))
+        ok = self.sglx.c_sglx_setRecordingEnable(self.sglx_handle, c_bool(True))
 
         gates, gate_nums = self.get_gates()
         n_gates = len(gates)
 
         # Send command to start recording
         if n_gates == 0 or increment_gate:
-            ok = c_sglx_triggerGT(self.sglx_handle, c_int(1), c_int(1))
+            ok = self.sglx.c_sglx_triggerGT(self.sglx_handle, c_int(1), c_int(1))
         else:
-            ok = c_sglx_triggerGT(self.sglx_handle, c_int(-1), c_int(1))
+            ok = self.sglx.c_sglx_triggerGT(self.sglx_handle, c_int(-1), c_int(1))
+
+        # Sync pulses from now until the recording stops, the first one after rec_start is logged
+        self.start_sync()
 
     def stop_recording_TTL(self, verbose=True, reset_to_O2=False, silent=True):
         """
@@ -1203,23 +1574,24 @@ class Controller:
                 - params_out (dict): Empty dictionary.
         """
 
-        self.empty_read_buffer()
-        self.serial_port.serialObject.write("r".encode("utf-8"))
-        self.serial_port.serialObject.write("e".encode("utf-8"))
-        self.block_until_read()
+        self._command("stop_recording_ttl", drain=True)
 
     def stop_recording_sglx(self, verbose=True):
         """
         Stop recording using the spikeGLX API
         """
-        ok = c_sglx_triggerGT(
+        # One last sync pulse, so the pulses bracket every event of the recording
+        if self._syncing:
+            self.emit_sync()
+            self._syncing = False
+        ok = self.sglx.c_sglx_triggerGT(
             self.sglx_handle, c_int(-1), c_int(0)
         )  # Do not increment gate number here. Let that happen at recording start
 
         #  Set dataDir to the subject directory
         try:
             c_root_dir = c_char_p(str(self.root_data_dir).encode())
-            ok = c_sglx_setDataDir(self.sglx_handle, c_int(0), c_root_dir)
+            ok = self.sglx.c_sglx_setDataDir(self.sglx_handle, c_int(0), c_root_dir)
         except:
             print("Could not set data directory")
 
@@ -1229,13 +1601,62 @@ class Controller:
         """
         try:
             print('Disabling spikeglx recording, setting gate and trigger to low')
-            ok = c_sglx_triggerGT(
+            ok = self.sglx.c_sglx_triggerGT(
                 self.sglx_handle, c_int(0), c_int(0)
             )  # Do not increment gate number here. Let that happen at recording start
-            ok = c_sglx_setRecordingEnable(self.sglx_handle, c_bool(False))
+            ok = self.sglx.c_sglx_setRecordingEnable(self.sglx_handle, c_bool(False))
         except Exception as e:
             print(f"Error shutting down spikeglx recording {e}")
 
+    def start_sync(self):
+        """
+        Start mapping host times to sample indices of the sample_map's SpikeGLX stream: if sync_interval_sec is set,
+        emit a sync pulse after the next logged call, then one every sync_interval_sec. SpikeGLX counts samples
+        from the start of its run, so the map starts over.
+        """
+        srate = c_double()
+        ok = self.sglx.c_sglx_getStreamSampleRate(
+            byref(srate), self.sglx_handle, c_int(self.sample_map.js), c_int(self.sample_map.ip)
+        )
+        if not ok:
+            print("Could not get the stream sample rate from SpikeGLX, not syncing")
+            return
+        self.sample_map.reset(srate.value)
+        self._sync_index = 0
+        self._syncing = self.sync_interval_sec is not None
+        self._last_sync_time = -np.inf
+
+    def _sync_if_due(self):
+        """
+        Emit a sync pulse if the last one was at least sync_interval_sec ago.
+        """
+        if not self._syncing or not self.IS_CONNECTED:
+            return
+        now = self.clock.now()
+        if now - self._last_sync_time < self.sync_interval_sec:
+            return
+        # Set first: emit_sync is logged itself and comes back here
+        self._last_sync_time = now
+        self.emit_sync()
+
+    def _read_sample_count(self):
+        """
+        Read the stream's sample count SYNC_COUNT_READS times and add them to the sample map.
+
+        Returns:
+            tuple: (count, host time, round trip) of the read with the shortest round trip.
+        """
+        reads = []
+        for _ in range(SYNC_COUNT_READS):
+            sent_time = self.clock.now()
+            count = self.sglx.c_sglx_getStreamSampleCount(
+                self.sglx_handle, c_int(self.sample_map.js), c_int(self.sample_map.ip)
+            )
+            received_time = self.clock.now()
+            self.sample_map.add_sample(count, sent_time, received_time)
+            reads.append((count, (sent_time + received_time) / 2, received_time - sent_time))
+        return min(reads, key=lambda read: read[2])
+
 
 
     @logger
@@ -1255,10 +1676,8 @@ class Controller:
                 - category (str): 'event'
                 - params_out (dict): Dictionary with 'fps' (frames per second).
         """
-        self.serial_port.serialObject.write("a".encode("utf-8"))  # Auxiliary
-        self.serial_port.serialObject.write("v".encode("utf-8"))  # Video
-        self.serial_port.serialObject.write("b".encode("utf-8"))  # begin
-        self.serial_port.write(int(fps), "uint8")
+        # The camera pulser is not waited on; the I/O thread still consumes its acknowledgement
+        self.submit("start_camera_trig", fps=fps)
         print(f"Start camera trigger at {fps}fps") if verbose else None
         return ("start_camera", "event", {"fps": fps})
 
@@ -1278,32 +1697,191 @@ class Controller:
                 - category (str): 'event'
                 - params_out (dict): Empty dictionary.
         """
-        self.serial_port.serialObject.write("a".encode("utf-8"))  # Auxiliary
-        self.serial_port.serialObject.write("v".encode("utf-8"))  # Video
-        self.serial_port.serialObject.write("e".encode("utf-8"))  # end
-        self.serial_port.write(int(0), "uint8")
+        self.submit("stop_camera_trig", fps=0)
         print(f"Stop camera") if verbose else None
         return ("stop_camera", "event", {})
 
+    def submit(self, name, expected_sec=0.0, timeout=None, drain=False, monitor=True, **fields):
+        """
+        Queue a command for the serial I/O thread without waiting for the teensy.
+
+        The command is not logged. Use the stimulus methods (run_train, open_valve, ...) for logged commands.
+
+        Args:
+            name (str): Name of the command in self.commands (see commands.py).
+            expected_sec (float, optional): How long the command is expected to run on the teensy. Defaults to 0.
+            timeout (float, optional): Seconds to wait for the acknowledgement once sent. Defaults to expected_sec + ACK_TIMEOUT_MARGIN_SEC.
+            drain (bool, optional): Discard stale bytes from the input buffer before sending. Defaults to False.
+            monitor (bool, optional): Time the acknowledgement in the timing monitor. False for the controller's own
+                housekeeping commands (clock pings, protocol negotiation), which are not experiment events.
+                Defaults to True.
+            **fields: Value for every field of the command.
+
+        Returns:
+            concurrent.futures.Future: Resolves to the teensy's Reply, or raises AckTimeoutError.
+
+        Raises:
+            ValueError: If a field value does not fit in its wire type.
+        """
+        future, timeout = self._submit_to(self._io, name, expected_sec, timeout, drain, fields, monitor=monitor)
+        if self._call_futures is not None:
+            self._call_futures.append((future, timeout))
+        return future
+
+    def _submit_to(self, io, name, expected_sec, timeout, drain, fields, monitor=True):
+        """
+        Submit a command to a serial I/O (the Controller's, or an AsyncController's), recording the device state it
+        sets in the journal and timing its acknowledgement.
+
+        Returns:
+            tuple: (the future of the reply, the ack timeout in seconds)
+        """
+        command = self.commands[name]
+        values = command.values(**fields)
+        self.journal.record(name, fields)
+        if timeout is None:
+            timeout = expected_sec + ACK_TIMEOUT_MARGIN_SEC
+        submitted = self.clock.now()
+        future = io.submit(command, values, timeout, drain=drain)
+        if monitor:
+            self.timing.watch(command, values, expected_sec, future, submitted=submitted)
+        return future, timeout
+
+    def _negotiate_protocol(self):
+        """
+        Switch to protocol v2 (pipelined, sequence-numbered replies) or v3 (v2 with device onset times) if the
+        firmware supports it. With v3, also synchronize the clocks.
+        """
+        if "protocol_version" not in self.commands:
+            return
+        reply = self._command("protocol_version", drain=True, monitor=False)
+        # v1 firmware only acks, v2 and later send their version first
+        if len(reply.status) > 0 and reply.status[0] >= 2:
+            self._io.stop()
+            self.protocol_version = min(reply.status[0], PROTOCOL_VERSION)
+            self._start_io()
+        if self.protocol_version >= 3:
+            # micros() starts over whenever the teensy resets, e.g. after a reconnect
+            self.clock_sync.reset()
+            self.sync_clock()
+
+    def sync_clock(self, n_pings=CLOCK_SYNC_PINGS):
+        """
+        Send clock pings back to back and update the device to host clock mapping (v3 firmware only).
+
+        Args:
+            n_pings (int, optional): Number of pings. Defaults to CLOCK_SYNC_PINGS.
+
+        Returns:
+            dict: The clock_sync estimate.
+        """
+        for _ in range(n_pings):
+            self.clock_sync.add_ping(self.submit("clock_ping", monitor=False).result())
+        self._last_ping_time = self.clock.now()
+        return self.clock_sync.summary()
+
+    def _ping_if_due(self):
+        """
+        Keep the clock mapping current with one ping every clock_ping_interval_sec. Does not wait for the reply.
+        """
+        if self.protocol_version < 3 or not self.IS_CONNECTED:
+            return
+        now = self.clock.now()
+        if now - self._last_ping_time < self.clock_ping_interval_sec:
+            return
+        self._last_ping_time = now
+        self.submit("clock_ping", monitor=False).add_done_callback(self._add_ping)
+
+    def _add_ping(self, future):
+        """
+        Runs in the serial I/O thread when a ping is acknowledged.
+        """
+        if not future.cancelled() and future.exception() is None:
+            self.clock_sync.add_ping(future.result())
+
+    def _device_onset_time(self, futures):
+        """
+        Host clock time the first acknowledged command among `futures` took effect on the teensy, or NaN.
+
+        Waits for the acknowledgements of commands the call did not wait for (e.g. start_camera_trig), at most as
+        long as their ack timeout, so the entry does not depend on whether the I/O thread got to them first.
+
+        Args:
+            futures (list): (future, ack timeout in seconds) of the commands submitted during the call, in order.
+        """
+        for future, timeout in futures:
+            try:
+                if future.exception(timeout=timeout) is not None:
+                    continue
+            except (CancelledError, FutureTimeoutError):
+                continue
+            onset_us = future.result().onset_us
+            if onset_us is not None:
+                return self.clock_sync.to_host(onset_us)
+        return np.nan
+
+    def _start_io(self):
+        """
+        Start the serial I/O for the current protocol version.
+        """
+        if self.protocol_version >= 2:
+            self._io = PipelinedSerialIO(
+                self.serial_port, self.desync_bytes, timed=self.protocol_version >= 3, clock=self.clock
+            )
+        else:
+            self._io = SerialIOThread(self.serial_port, self.desync_bytes)
+        self._io.start()
+
+    def disconnect(self):
+        """
+        Stop the serial I/O and close the transport.
+        """
+        self._io.stop()
+        self.serial_port.close()
+        self.IS_CONNECTED = False
+
+    def _command(self, name, expected_sec=0.0, drain=False, monitor=True, **fields):
+        """
+        Blocking wrapper to submit. Returns the teensy's Reply once the command has been acknowledged.
+
+        If the link to the teensy drops, the supervisor reconnects and restores the device state, and the
+        command is sent again.
+        """
+        try:
+            reply = self.submit(name, expected_sec=expected_sec, drain=drain, monitor=monitor, **fields).result()
+        except Exception as e:
+            if self.supervisor is None or not self.supervisor.should_recover(e):
+                raise
+            self.supervisor.recover(e, name)
+            reply = self.submit(name, expected_sec=expected_sec, drain=drain, monitor=monitor, **fields).result()
+        return reply
+
     def block_until_read(self, verbose=False):
         """
         Wait to hear back from the teensy controller before continuing. This prevents multiple commands from
         being sent to the teensy and creating a backlog.
+
+        Waits until every command submitted so far has been acknowledged. The wait blocks in the serial driver,
+        so no CPU is used while the teensy runs a firmware-timed command.
+
+        Raises:
+            AckTimeoutError: If the last acknowledgement does not arrive in time.
         """
-        reply = []
         if verbose:
             print("Waiting for reply")
-        while True:
-            if self.serial_port.bytesAvailable() > 0:
-                self.serial_port.read(1, "uint8")
-                break
+        if self._io.last_future is not None:
+            self._io.last_future.result()
 
     def empty_read_buffer(self):
         """
         Clear any remaining serial messages
+
+        Discarded bytes are counted in desync_bytes.
+
+        Returns:
+            int: Number of bytes discarded.
         """
-        while self.serial_port.bytesAvailable() > 0:
-            self.serial_port.serialObject.read()
+        return self._io.drain().result()
 
     def reset(self):
         """
@@ -1339,14 +1917,20 @@ class Controller:
             pass
         return int(amp * 100)
 
-    def save_log(self, path=None, filename=None, verbose=True):
+    def save_log(self, path=None, filename=None, verbose=True, file_format="tsv"):
         """
         Save the log to a tab-separated file.
 
+        Once sync pulses were emitted (see emit_sync), every entry also gets the SpikeGLX sample index of its
+        device_onset_time (start_time if the teensy did not report one), and the sample map is saved next to the
+        log (see sglx_sync.py).
+
         Args:
             path (str or Path, optional): Path to save the log file. Defaults to the gate destination or SUBJECT_DIR
             filename (str, optional): Filename to save the log as. Defaults to self.log_filename.
             verbose (bool, optional): Verbosity flag. If True, prints the save location. Defaults to True.
+            file_format (str, optional): "tsv", or "parquet" to write the same table as Parquet (needs pyarrow),
+                with the .parquet suffix. Defaults to "tsv".
 
         Returns:
             None
@@ -1358,40 +1942,95 @@ class Controller:
             print("NO LOG SAVED!!! NO filename is passed")
             return
         save_fn = path.joinpath(filename)
-        log_df = pd.DataFrame(self.log)
-
-        # make times relative to recording start
-        base_time = self.rec_start_time or self.init_time
-
-        log_df["start_time"] -= base_time
-        log_df["end_time"] -= base_time
+        log_df = self.log.to_pandas()
+        if self.sample_map.ready:
+            log_df["sample_index"] = self.sample_map.to_sample(event_times(log_df))
+            sync_save_fn = path.joinpath(sync_map_filename(filename))
+            sync_json = json.dumps(sync_map(self.sample_map, log_df))
+            replace_atomically(sync_save_fn, lambda tmp_fn: tmp_fn.write_text(sync_json))
+            if verbose:
+                print(f"Sync map saved to {sync_save_fn}")
+        log_df = log_table(log_df, self.rec_start_time or self.init_time, self.clock.now())
 
-        # Make gasses extend until next gas change
-        gasses = log_df.query('category=="gas"')
-        end_times = np.concatenate(
-            [gasses["start_time"][1:].values, [time.time() - base_time]]
-        )
-        gasses.loc[:, "end_time"] = end_times
-        log_df.loc[gasses.index, :] = gasses
+        # Written to a temporary file and moved into place, so a crash never leaves a truncated table
+        if file_format == "parquet":
+            import pyarrow.parquet as pq
 
-        log_df.to_csv(save_fn, sep="\t")
+            save_fn = save_fn.with_suffix(".parquet")
+            replace_atomically(save_fn, lambda tmp_fn: pq.write_table(frame_to_arrow(log_df), tmp_fn))
+        else:
+            replace_atomically(save_fn, lambda tmp_fn: log_df.to_csv(tmp_fn, sep="\t"))
         if self.odor_map is not None:
             odor_save_fn = path.joinpath(self.odormap_filename)
-            with open(odor_save_fn, "w") as f:
-                json.dump(self.odor_map, f)
+            replace_atomically(odor_save_fn, lambda tmp_fn: tmp_fn.write_text(json.dumps(self.odor_map)))
             if verbose:
                 print(f"Odor map saved to {self.odormap_filename}")
 
         if verbose:
             print(f"Log saved to {save_fn}")
 
+    def _append_log(self, entry):
+        """
+        Add an entry to the log and queue it for the journal. The table is only rebuilt by save_log.
+        """
+        self.log.append(entry)
+        if self.log_journal is not None:
+            self.log_journal.append(entry)
+
+    def flush_log(self):
+        """
+        Block until every entry logged so far is written to the journal under the durability policy.
+        """
+        if self.log_journal is not None:
+            self.log_journal.flush()
+
+    def _open_log_journal(self):
+        """
+        Start the journal that goes with log_filename, with the entries logged so far.
+        """
+        if self.log_journal is not None:
+            self.log_journal.close()
+        journal = LogJournal(self.gate_dest.joinpath(journal_filename(self.log_filename)))
+        self.log_journal = LogWriter(journal, self.log_policy)
+        self._journal_meta()
+        for entry in self.log:
+            self.log_journal.append(entry)
+        print(f"Log journal at {self.log_journal.path}")
+
+    @property
+    def odor_map(self):
+        return self._odor_map
+
+    @odor_map.setter
+    def odor_map(self, odor_map):
+        # Set by set_odor_map, the GUI and scripts. Kept in the journal so a crashed session keeps its odor map.
+        self._odor_map = odor_map
+        self._journal_meta()
+
+    def _journal_meta(self):
+        """
+        Record in the journal what recover_log.py needs to rebuild the table, odor map and sync map without the
+        Controller, and the clock anchor every timestamp is relative to.
+        """
+        if self.log_journal is None:
+            return
+        self.log_journal.append_meta(
+            **self.clock.anchor(),
+            init_time=self.init_time,
+            rec_start_time=self.rec_start_time,
+            odor_map=self.odor_map,
+            log_filename=self.log_filename,
+            odormap_filename=self.odormap_filename,
+            sample_stream=dict(js=self.sample_map.js, ip=self.sample_map.ip, sample_rate=self.sample_map.sample_rate),
+        )
+
     @logger
     def make_log_entry(self, label, category, start_time=None, end_time=None, **kwargs):
         """
         Formats a custom log entry to be added to the log
         """
-        start_time = time.time() or start_time
-        end_time = np.nan or end_time
+        start_time = self.clock.now() if start_time is None else start_time
+        end_time = np.nan if end_time is None else end_time
         output = dict(
             label=label,
             category=category,
@@ -1402,28 +2041,38 @@ class Controller:
         return output
 
     @interval_timer
-    def wait(self, wait_time_sec, msg=None, progress="bar",close_on_finish = True):
+    def wait(self, wait_time_sec=None, msg=None, progress="bar", close_on_finish=True, deadline=None):
         """
-        Pause the experiment for a predetermined amount of time.
+        Pause the experiment for a predetermined amount of time, or until a deadline.
+
+        Sleeps most of the way and spins for the last stretch (see SessionClock.sleep_until), so the wait ends
+        within a fraction of a millisecond of its deadline, whatever the progress indicator.
 
         Args:
-            wait_time_sec (float): Wait time in seconds.
+            wait_time_sec (float, optional): Wait time in seconds.
             msg (str, optional): Custom message to print in the command line. Defaults to None.
-            progress (str, optional): Type of progress indicator. Can be 'bar' for a progress bar or any other value for no progress indicator. Defaults to 'bar'.
+            progress (str, optional): Type of progress indicator. Can be 'bar' for a progress bar, 'gui' for a dialog that can skip the wait, or any other value for no progress indicator. Defaults to 'bar'.
             close_on_finish (bool, optional): If True, close the dialog when the wait is finished. Defaults to True.
+            deadline (float, optional): Clock time to wait until instead of wait_time_sec from now, e.g. an onset of a
+                Schedule (see scheduler.py). Returns at once if it has passed.
         Returns:
             tuple: A tuple containing:
                 - label (str): 'wait'
                 - category (str): 'event'
-                - params_out (dict): Dictionary containing wait duration and whether it was cancelled.
+                - params_out (dict): Dictionary containing wait duration, elapsed time, how late the wait ended
+                  (deadline_error) and whether it was cancelled.
         """
         msg = msg or "Waiting"
-        start_time = time.time()
+        start_time = self.clock.now()
+        if deadline is None:
+            assert wait_time_sec is not None, "Pass wait_time_sec or deadline"
+            deadline = start_time + wait_time_sec
+        else:
+            wait_time_sec = max(deadline - start_time, 0.0)
         if wait_time_sec<5:
             update_step = 0.1
         else:
             update_step = 1
-        cancelled = False
 
         if progress == "bar":
             # Create progress bar with custom format
@@ -1433,30 +2082,80 @@ class Controller:
             )
             pbar.set_description(msg)
 
-            while get_elapsed_time(start_time) <= wait_time_sec:
-                time.sleep(update_step)
-                pbar.update(update_step)
+            def tick(remaining):
+                pbar.update(min(int(wait_time_sec - remaining), pbar.total) - pbar.n)
 
+            completed = self.clock.sleep_until(deadline, tick=tick, tick_sec=update_step)
+            pbar.update(pbar.total - pbar.n)
             pbar.close()
         elif progress == "gui":
-            dialog = WaitDialog(wait_time_sec, msg, close_on_finish=close_on_finish)
-            completed = dialog.wait()
-            cancelled = not completed
-
+            dialog = WaitDialog(wait_time_sec, msg, close_on_finish=close_on_finish, clock=self.clock)
+            dialog.show()
+            completed = self.clock.sleep_until(deadline, tick=dialog.update_remaining)
+            dialog.finish()
         else:
-            time.sleep(wait_time_sec)
+            completed = self.clock.sleep_until(deadline)
 
-        elapsed = get_elapsed_time(start_time)
+        end_time = self.clock.now()
+        elapsed = end_time - start_time
         params = {
             "duration": wait_time_sec,
             "elapsed": elapsed,
+            "deadline_error": end_time - deadline,
+            "cancelled": not completed,
         }
         
-        if cancelled:
+        if not completed:
             print(f"Wait cancelled after {elapsed:.1f} seconds")
         
         return ("wait", "event", params)
 
+    def _wait_for_onset(self, schedule, index, msg=None, close_on_finish=True):
+        """
+        Wait in a dialog that can skip the wait until onset `index` of a Schedule. Skipping starts the grid again
+        from now.
+        """
+        # Leave time to close the dialog before the onset, then wait for the onset itself
+        waited = self.wait(
+            deadline=schedule.onset(index) - SCHEDULE_MARGIN_SEC,
+            msg=msg,
+            progress="gui",
+            close_on_finish=close_on_finish,
+        )
+        if waited["cancelled"]:
+            schedule.restart(index)
+        else:
+            self.clock.sleep_until(schedule.onset(index))
+
+    def _repetition_program(self, method, n, interval, args, kwargs):
+        """
+        Stimulus program that runs n repetitions of a method `interval` apart, and the fields to set on their log
+        entries (see repeater). None if they have to run from the host: older firmware, a single repetition, a
+        method that is not in REPETITION_STEPS, unlogged repetitions, or repetitions that do not fit in a program.
+        """
+        if n <= 1 or self.protocol_version < 4 or method not in REPETITION_STEPS:
+            return None
+        if not kwargs.get("log_enabled", True):
+            return None
+        kwargs = {key: value for key, value in kwargs.items() if key != "log_enabled"}
+        program = StimulusProgram(duration_sec=n * interval)
+        try:
+            for ii in range(n):
+                step_fields = REPETITION_STEPS[method](program, ii * interval, *args, **kwargs)
+            program.compile()
+        except ValueError as error:
+            print(f"Running the repetitions from the host: {error}")
+            return None
+        return program, step_fields
+
+    @staticmethod
+    def _print_onset_errors(schedule, what):
+        summary = schedule.summary()
+        print(
+            f"Onset error over {summary['n']} {what}: mean {summary['mean_ms']:.3f}ms, "
+            f"max {summary['max_abs_ms']:.3f}ms, {summary['n_late']} late"
+        )
+
     @interval_timer
     def settle(self, settle_time_sec=None, verbose=True, progress="gui"):
         """
@@ -1488,7 +2187,7 @@ class Controller:
         """
         Create a graphical representation of the expriment events.
         """
-        log_df = pd.DataFrame(self.log)
+        log_df = self.log.to_pandas()
         f = plt.figure(figsize=(12, 4))
         categories = log_df["category"].unique()
         for ii, cat in enumerate(categories):
@@ -1557,6 +2256,7 @@ class Controller:
         print(f"Log will save to {self.gate_dest}/{self.log_filename}")
         if self.odor_map is not None:
             print(f"Log will save to {self.gate_dest}/{self.log_filename}")
+        self._open_log_journal()
 
 
     def get_gates(self):
@@ -1607,6 +2307,7 @@ class Controller:
         )
         print(f"Log will save to {self.gate_dest}/{self.log_filename}")
         print(f"Odor map will save to {self.gate_dest}/{self.odormap_filename}")
+        self._open_log_journal()
         print(f"Recording name is {self.recname}")
 
     def get_last_trigger(self, gate_num):
@@ -1630,7 +2331,7 @@ class Controller:
         Get the run name from the spikeGLX API
         """
         run = c_char_p()
-        ok = c_sglx_getRunName(byref(run), self.sglx_handle)
+        ok = self.sglx.c_sglx_getRunName(byref(run), self.sglx_handle)
         self.runname = run.value.decode()
         return self.runname
 
@@ -1643,7 +2344,7 @@ class Controller:
 
         # Get the data directory from sglx
         data_dir = c_char_p()
-        ok = c_sglx_getDataDir(byref(data_dir), self.sglx_handle, c_int(0))
+        ok = self.sglx.c_sglx_getDataDir(byref(data_dir), self.sglx_handle, c_int(0))
         data_dir = Path(data_dir.value.decode())
         self.root_data_dir = data_dir
         runname = self.get_runname()
@@ -1655,7 +2356,7 @@ class Controller:
 
             # Set the data directory for sglx
             c_subject_dir = c_char_p(str(subject_dir).encode())
-            ok = c_sglx_setDataDir(self.sglx_handle, c_int(0), c_subject_dir)
+            ok = self.sglx.c_sglx_setDataDir(self.sglx_handle, c_int(0), c_subject_dir)
         else:
             subject_dir = data_dir
 
@@ -1702,12 +2403,12 @@ class Controller:
                 - category (str): 'odor'
                 - params_out (dict): Dictionary with 'valve' key and the valve number as value.
         """
-        self.serial_port.serialObject.write("s".encode("utf-8"))  # smell
-        self.serial_port.serialObject.write("o".encode("utf-8"))  # open
-        self.serial_port.write(int(valve), "uint8")
+        reply = self._command(
+            "open_olfactometer", expected_sec=OLFACTOMETER_TIMEOUT_SEC, valve=valve
+        )
 
         print(f"Open olfactometer valve {valve}") if verbose else None
-        self.block_until_read()
+        self._check_olfactometer(reply)
         return ("open_olfactometer_valve", "odor", {"valve": valve})
 
     @logger
@@ -1726,12 +2427,12 @@ class Controller:
                 - category (str): 'odor'
                 - params_out (dict): Dictionary with 'valve' key and the valve number as value.
         """
-        self.serial_port.serialObject.write("s".encode("utf-8"))  # smell
-        self.serial_port.serialObject.write("c".encode("utf-8"))  # close
-        self.serial_port.write(int(valve), "uint8")
+        reply = self._command(
+            "close_olfactometer", expected_sec=OLFACTOMETER_TIMEOUT_SEC, valve=valve
+        )
 
         print(f"Close olfactometer valve {valve}") if verbose else None
-        self.block_until_read()
+        self._check_olfactometer(reply)
         return ("close_olfactometer_valve", "odor", {"valve": valve})
 
     @logger
@@ -1757,12 +2458,14 @@ class Controller:
         assert len(binary_string) == 8, "Binary string must be 8 characters long."
         binary_string_revr = binary_string[::-1]
         decimal_value = int(binary_string_revr, 2)
-        self.serial_port.serialObject.write("s".encode("utf-8"))  # smell
-        self.serial_port.serialObject.write("b".encode("utf-8"))  # binary
-        self.serial_port.write(decimal_value, "uint8")
+        reply = self._command(
+            "set_olfactometer_valves",
+            expected_sec=OLFACTOMETER_TIMEOUT_SEC,
+            valves=decimal_value,
+        )
 
         print(f"Set all valves to {binary_string}") if verbose else None
-        self.wait_for_response()
+        self._check_olfactometer(reply)
         return ("set_all_valves", "odor", {"valve": binary_string})
     
     def get_user_input_number(self,prompt, default_value=0,min_value=None, max_value=None):
@@ -1773,23 +2476,12 @@ class Controller:
             print(f"User input: {value}")
             return value
 
-    def wait_for_response(self,timeout=10,verbose=False):
+    def _check_olfactometer(self, reply):
         """
-        Wait for a response from the teensy controller
+        Warn if the teensy reported that the olfactometer did not respond to a forwarded command.
         """
-        start_time = time.time()
-        while (time.time()-start_time)<timeout:
-            if self.serial_port.bytesAvailable()>0:
-                read_byte = self.serial_port.read(1,'uint8')
-                print(f"Received byte {read_byte}") if verbose else None
-                if read_byte==111:
-                    print('No Olfactometer found!')
-                    break
-                if read_byte==255:
-                    print('Handshake recieved') if verbose else None
-                    break
-                
-                
+        if OLFACTOMETER_MISSING in reply.status:
+            print('No Olfactometer found!')
 
 
     @repeater
@@ -1867,12 +2559,23 @@ class Controller:
         """
         Stop the recordings, close the camera trigger, and save the log.
         """
-        self.stop_recording()
+        # If the link to the teensy could not be recovered, only the host side is left to shut down
+        if self.IS_CONNECTED:
+            self.stop_recording()
         self.set_all_sglx_low()
         print("Shutting down gracefully")
         self.make_log_entry("Killed", "event")
-        self.stop_camera_trig()
+        if self.IS_CONNECTED:
+            self.stop_camera_trig()
+            self.block_until_read()
+        if self.desync_bytes:
+            print(f"Stale bytes discarded during the session: {dict(self.desync_bytes)}")
+        if self.timing.latencies:
+            print(f"Command latencies (s):\n{self.timing.percentiles().round(4)}")
         self.save_log()
+        if self.log_journal is not None:
+            self.log_journal.close()
+            self.log_journal = None
 
     def preroll(
         self,
@@ -1945,7 +2648,7 @@ class Controller:
         self.settle()
         self.start_recording(increment_gate=increment_gate)
         if use_camera:
-            time.sleep(0.5)
+            self.clock.sleep(0.5)
             self.start_camera_trig()
 
     @repeater
@@ -1984,16 +2687,68 @@ class Controller:
             else:
                 print(f"Setting GPIO pin {pin} to {mode}")
 
-        self.serial_port.serialObject.write("m".encode("utf-8"))
-        self.serial_port.serialObject.write(mode.encode("utf-8"))
-        self.serial_port.write(dur_int, "uint16")
-        self.serial_port.write(pin, "uint8")
-        self.block_until_read()
+        self._command(
+            "set_gpio",
+            expected_sec=pulse_duration_sec or 0.0,
+            mode=mode,
+            duration=dur_int,
+            pin=pin,
+        )
 
         label = "gpio"
         params_out = dict(pin=pin, mode=mode, duration=pulse_duration_sec)
         return (label, category, params_out)
 
+    @logger
+    @event_timer
+    def emit_sync(self, method=None, verbose=False):
+        """
+        Emit a sync pulse and read the SpikeGLX stream's sample count around it, which updates the host time to
+        sample index map (see sglx_sync.py).
+
+        With the 'gpio' method, the pulse on sync_pin is coded: its width encodes the sync index modulo
+        SYNC_CODES (see sglx_sync.sync_pulse_sec). With 'audio', the play_synch tones are the pulse.
+
+        Args:
+            method (str, optional): 'gpio' or 'audio'. Defaults to sync_method.
+            verbose (bool, optional): Verbosity flag. If True, prints the sync index. Defaults to False.
+
+        Returns:
+            tuple: A tuple containing:
+                - label (str): 'sync_pulse'
+                - category (str): 'sync'
+                - params_out (dict): sync_index, method, code, pulse_sec, and the sample count read closest to
+                  the pulse: sample_count, sample_count_time and sample_count_round_trip (NaN without SpikeGLX).
+        """
+        method = method or self.sync_method
+        assert method in ["gpio", "audio"], "Sync method must be gpio or audio"
+        if method == "gpio":
+            assert self.sync_pin is not None, "Set sync_pin to the GP pin wired to the recording's sync input"
+        sync_index = self._sync_index
+        self._sync_index += 1
+        code, pulse_sec = np.nan, np.nan
+        count = count_time = round_trip = np.nan
+        if self.sglx_handle is not None:
+            count, count_time, round_trip = self._read_sample_count()
+        print(f"Sync pulse {sync_index} via {method}") if verbose else None
+        if method == "gpio":
+            code = sync_index % SYNC_CODES
+            pulse_sec = sync_pulse_sec(code)
+            self.set_gpio(self.sync_pin, "pulse", pulse_duration_sec=pulse_sec, verbose=False, log_enabled=False)
+        else:
+            self.play_synch(log_enabled=False)
+
+        params_out = dict(
+            sync_index=sync_index,
+            method=method,
+            code=code,
+            pulse_sec=pulse_sec,
+            sample_count=count,
+            sample_count_time=count_time,
+            sample_count_round_trip=round_trip,
+        )
+        return ("sync_pulse", "sync", params_out)
+
     @repeater
     @logger
     @event_timer
@@ -2081,17 +2836,18 @@ def sec2ms(val):
     return int(val * 1000)
 
 
-def get_elapsed_time(start_time):
+def get_elapsed_time(start_time, clock=None):
     """
     Convenience function to compute the time that has elapsed since a given start time.
 
     Args:
         start_time (float): The start time in seconds since the epoch.
+        clock (SessionClock, optional): Clock start_time was read from. Defaults to time.time().
 
     Returns:
         float: The elapsed time in seconds.
     """
-    curr_time = time.time()
+    curr_time = time.time() if clock is None else clock.now()
     elapsed_time = curr_time - start_time
     return elapsed_time
 
@@ -19,7 +19,6 @@ import sys
 sys.path.append(str(Path(__file__).parent.parent / 'python'))
 
 import nebPod
-from nebPod import ArCOMObject # Import ArCOMObject
 
 try:
     import qdarktheme
@@ -479,7 +478,7 @@ class ArduinoController(QWidget):
     def disconnect(self):
         if self.IS_CONNECTED:
             self.setStyleSheet('background-color: #AA1111')
-            self.controller.serial_port.close()
+            self.controller.disconnect()
             self.port_connect_button.setStyleSheet('background-color: #FFFFFF; font-weight: bold;font-size: 16px')
             self.IS_CONNECTED=False
             self.setWindowTitle(self.default_title + " (DISCONNECTED)")
@@ -997,7 +996,7 @@ class ArduinoController(QWidget):
     # Shutdown
     def closeEvent(self, event):
         # Close the ArCOM port when the application is closed
-        self.controller.serial_port.serialObject.read_all()
+        self.controller.empty_read_buffer()
         try:
             self.stop_record()
         except:
@@ -1005,7 +1004,7 @@ class ArduinoController(QWidget):
         self.open_valve(0)
         self.init_olfactometer()
         if self.IS_CONNECTED:
-            self.controller.serial_port.close()
+            self.controller.disconnect()
             self.IS_CONNECTED = False
         event.accept()
 
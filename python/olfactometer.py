@@ -31,6 +31,7 @@ import sys
 from pathlib import Path
 
 from nebPod import Controller, event_timer, logger
+from commands import OLFACTOMETER_COMMANDS
 
 curr_dir = Path(os.getcwd())
 sys.path.append(str(curr_dir))
@@ -55,10 +56,18 @@ class Olfactometer(Controller):
             Close an olfactometer valve.
     """
 
-    def __init__(self, port):
-        super().__init__(port)
+    commands = OLFACTOMETER_COMMANDS
+
+    def __init__(self, port, transport=None):
+        super().__init__(port, transport=transport)
         self.set_all_olfactometer_valves("00000000")
 
+    def init_cobalt(self, *args, **kwargs):
+        """
+        The olfactometer has no cobalt laser controller, so there is nothing to initialize.
+        """
+        pass
+
     @logger
     @event_timer
     def open_olfactometer(self, valve, verbose=True):
@@ -74,11 +83,9 @@ class Olfactometer(Controller):
                 - label (str): 'open_olfactometer_valve'
                 - params_out (dict): Dictionary with 'valve' key and the valve number as value.
         """
-        self.serial_port.serialObject.write("o".encode("utf-8"))  # open
-        self.serial_port.write(int(valve), "uint8")
+        self._command("open_olfactometer", valve=valve)
 
         print(f"Opens olfactometer valve {valve}") if verbose else None
-        self.block_until_read()
         return ("open_olfactometer_valve", "odor", {"valve": valve})
 
     @logger
@@ -96,11 +103,9 @@ class Olfactometer(Controller):
                 - label (str): 'close_olfactometer_valve'
                 - params_out (dict): Dictionary with 'valve' key and the valve number as value.
         """
-        self.serial_port.serialObject.write("c".encode("utf-8"))  # close
-        self.serial_port.write(int(valve), "uint8")
+        self._command("close_olfactometer", valve=valve)
 
         print(f"Closes olfactometer valve {valve}") if verbose else None
-        self.block_until_read()
         return ("close_olfactometer_valve", "odor", {"valve": valve})
 
     @logger
@@ -126,9 +131,7 @@ class Olfactometer(Controller):
         assert len(binary_string) == 8, "Binary string must be 8 characters long."
         binary_string_revr = binary_string[::-1]
         decimal_value = int(binary_string_revr, 2)
-        self.serial_port.serialObject.write("b".encode("utf-8"))  # open
-        self.serial_port.write(decimal_value, "uint8")
+        self._command("set_olfactometer_valves", valves=decimal_value)
 
         print(f"Sets all valves to {binary_string}") if verbose else None
-        self.block_until_read()
         return ("set_all_valves", "odor", {"valve": binary_string})
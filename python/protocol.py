@@ -0,0 +1,529 @@
+"""
+Declarative experiment protocols, compiled to a flat timeline and checked before anything runs.
+
+A protocol is a list of steps, each a Controller method with its arguments, in YAML or JSON:
+
+    name: tac_calca
+    steps:
+      - present_gas: {gas: room air, presentation_time: 600}
+      - settle: {settle_time_sec: 900}
+      - start_recording: {}
+      - repeat:
+          n: 10
+          steps:
+            - play_tone: {freq: 1000, duration_sec: 0.5}
+            - wait: {wait_time_sec: 30}
+      - run_train: {duration_sec: 15, freq: 4, amp: 0.8, pulse_duration_sec: 0.025, n: 5, interval: 30}
+      - stop_recording: {}
+
+or built in Python:
+
+    protocol = Protocol("tac_calca").add("present_gas", gas="room air", presentation_time=600)
+
+compile() checks every step without a Controller: the arguments against the method's signature (a misspelled
+keyword is caught up front instead of hours into a session), the stimulus parameters against each other (e.g. a
+pulse longer than the train period), and every field the step would send against its wire type in commands.py
+(e.g. a 70s train does not fit the uint16 ms duration). The result is a Timeline of every command with its onset
+and duration in ms, the total duration and the stimulus counts. run() only touches the hardware if the protocol
+compiles without errors.
+
+Steps with n and interval run through the Controller's repeater, on a fixed grid (see scheduler.py), as one stimulus
+program on the teensy's clock where the firmware and the method allow it (see nebPod.repeater). The timeline
+counts the firmware-timed commands and the waits. Host and link overheads are not included.
+
+run() saves a checkpoint after every step, and resume() carries on from it after a crash (see checkpoint.py).
+
+To check a protocol file without hardware:
+
+    python protocol.py <protocol.yaml or .json>
+"""
+
+import argparse
+import collections
+import inspect
+import json
+import math
+from pathlib import Path
+
+from checkpoint import Checkpoint, checkpoint_filename
+from commands import COMMANDS, DEFAULT_GAS_MAP
+
+DEFAULT_SETTLE_SEC = 15 * 60  # Controller.settle_time_sec
+ALERT_TONE = dict(freq=1000, duration=500)  # Controller.play_alert
+BLANK_ODOR = "H20"  # present_odor goes back to it after its duration
+
+STEPS = {}
+
+
+class ProtocolError(ValueError):
+    """
+    The protocol does not compile. Every problem found is listed in the message and in `errors`.
+    """
+
+    def __init__(self, errors):
+        self.errors = errors
+        super().__init__("Protocol has errors:\n" + "\n".join(f"  - {error}" for error in errors))
+
+
+def step(repeatable=False):
+    """
+    Register a step compiler under the name of the Controller method it stands for.
+
+    The compiler has the method's signature, with the compile context first, and returns (duration_sec,
+    commands, n_stimuli), where commands are (offset_sec, command name, wire fields). It raises ValueError for
+    arguments that the method would reject or that make no sense together.
+
+    Args:
+        repeatable (bool, optional): Whether the method is decorated with repeater and takes n and interval.
+    """
+
+    def register(compiler):
+        compiler.repeatable = repeatable
+        STEPS[compiler.__name__] = compiler
+        return compiler
+
+    return register
+
+
+def _ms(sec):
+    """
+    Seconds as the integer ms the Controller sends (nebPod.sec2ms).
+    """
+    return int(float(sec) * 1000)
+
+
+def _amp(amp):
+    # The Controller clips amplitudes to 0-1, which in a protocol is a mistake rather than an intent
+    if not 0 <= amp <= 1:
+        raise ValueError(f"amp={amp} must be between 0 and 1")
+    return int(amp * 100)
+
+
+def _freq(freq):
+    if freq <= 0 or freq != int(freq):
+        raise ValueError(f"freq={freq} must be a whole number of Hz, it is sent as an integer")
+    return int(freq)
+
+
+def _check_pulse_fits(pulse_duration_sec, freq):
+    if pulse_duration_sec >= 1 / freq:
+        raise ValueError(
+            f"pulse_duration_sec={pulse_duration_sec} is not shorter than the period at {freq}Hz ({1 / freq:.4f}s)"
+        )
+
+
+def _valve_mask(odor_map, odor):
+    valves = [int(valve) for valve, name in odor_map.items() if name == odor]
+    if not valves:
+        raise ValueError(f"odor {odor!r} is not in the odor map {sorted(set(odor_map.values()))}")
+    return 1 << valves[0]
+
+
+@step()
+def present_gas(context, gas, presentation_time=None, verbose=False, progress="gui"):
+    valves = [valve for valve, name in context["gas_map"].items() if name == gas]
+    if not valves:
+        raise ValueError(f"gas {gas!r} is not in the gas map {sorted(context['gas_map'].values())}")
+    return presentation_time or 0.0, [(0.0, "open_valve", dict(valve=int(valves[0])))], 1
+
+
+@step(repeatable=True)
+def run_pulse(context, pulse_duration_sec, amp, verbose=False):
+    return 0.0, [(0.0, "run_pulse", dict(duration=_ms(pulse_duration_sec), amp=_amp(amp)))], 1
+
+
+@step(repeatable=True)
+def run_train(context, duration_sec, freq, amp, pulse_duration_sec, verbose=False):
+    _check_pulse_fits(pulse_duration_sec, freq)
+    fields = dict(
+        duration=_ms(duration_sec), freq=_freq(freq), amp=_amp(amp), pulse_duration=_ms(pulse_duration_sec)
+    )
+    return 0.0, [(0.0, "run_train", fields)], 1
+
+
+@step()
+def run_tagging(context, n=75, pulse_duration_sec=0.050, amp=1.0, ipi_sec=3, verbose=True):
+    fields = dict(duration=_ms(pulse_duration_sec), amp=_amp(amp))
+    period_sec = pulse_duration_sec + ipi_sec
+    return n * period_sec, [(ii * period_sec, "run_pulse", fields) for ii in range(n)], n
+
+
+@step(repeatable=True)
+def phasic_stim(context, phase, mode, amp, duration_sec, freq=None, pulse_duration_sec=None, verbose=False):
+    if phase not in ["e", "i"]:
+        raise ValueError(f"phase={phase!r} must be 'e' or 'i'")
+    if mode not in ["h", "t", "p"]:
+        raise ValueError(f"mode={mode!r} must be 'h', 't' or 'p'")
+    fields = dict(phase=phase, mode=mode, n=1, duration=_ms(duration_sec), intertrain_interval=0, amp=_amp(amp))
+    if mode in ["t", "p"]:
+        if pulse_duration_sec is None:
+            raise ValueError(f"pulse_duration_sec is needed in mode {mode!r}")
+        fields.update(pulse_duration=_ms(pulse_duration_sec))
+    if mode == "t":
+        if freq is None:
+            raise ValueError("freq is needed in mode 't'")
+        _check_pulse_fits(pulse_duration_sec, freq)
+        fields.update(freq=_freq(freq))
+    return 0.0, [(0.0, f"phasic_stim_{mode}", fields)], 1
+
+
+@step()
+def present_odor(context, odor, duration_sec=None):
+    odor_map = context["odor_map"]
+    if odor_map is None:
+        context["warnings"].append(f"no odor map, {odor!r} and {BLANK_ODOR!r} are not checked")
+        return duration_sec or 0.0, [], 1
+    commands = [(0.0, "set_olfactometer_valves", dict(valves=_valve_mask(odor_map, odor)))]
+    if duration_sec is not None:
+        commands.append((duration_sec, "set_olfactometer_valves", dict(valves=_valve_mask(odor_map, BLANK_ODOR))))
+    return duration_sec or 0.0, commands, 1
+
+
+@step()
+def play_tone(context, freq, duration_sec, verbose=False):
+    return 0.0, [(0.0, "play_tone", dict(freq=freq, duration=_ms(duration_sec)))], 1
+
+
+@step()
+def play_synch(context, verbose=False):
+    return 0.0, [(0.0, "play_synch", {})], 1
+
+
+@step()
+def wait(context, wait_time_sec, msg=None, progress="bar", close_on_finish=True):
+    if wait_time_sec < 0:
+        raise ValueError(f"wait_time_sec={wait_time_sec} is negative")
+    return wait_time_sec, [], 0
+
+
+@step()
+def settle(context, settle_time_sec=None, verbose=True, progress="gui"):
+    settle_time_sec = context["settle_time_sec"] if settle_time_sec is None else settle_time_sec
+    alert_sec = ALERT_TONE["duration"] / 1000
+    return alert_sec + settle_time_sec, [(0.0, "play_tone", ALERT_TONE)], 0
+
+
+@step()
+def start_recording(context, increment_gate=True, silent=True, verbose=True):
+    return 0.0, [] if silent else [(0.0, "play_tone", ALERT_TONE)], 0
+
+
+@step()
+def stop_recording(context, silent=False, reset_to_O2=False, verbose=True):
+    commands = [] if silent else [(0.0, "play_tone", ALERT_TONE)]
+    if reset_to_O2:
+        commands += present_gas(context, "O2")[1]
+    return 0.0, commands, 0
+
+
+@step()
+def start_camera_trig(context, fps=120, verbose=False):
+    return 0.0, [(0.0, "start_camera_trig", dict(fps=fps))], 0
+
+
+@step()
+def stop_camera_trig(context, verbose=False):
+    return 0.0, [(0.0, "stop_camera_trig", dict(fps=0))], 0
+
+
+class Timeline:
+    """
+    A compiled protocol.
+
+    Attributes:
+        name (str): Name of the protocol.
+        steps (list): Every step in the order it runs, as dicts with where (its place in the protocol), step,
+            kwargs, onset_ms and duration_ms.
+        events (list): Every command sent, as dicts with onset_ms, duration_ms (how long the firmware is busy),
+            step, command and fields (the wire values).
+        total_ms (int): Duration of the whole protocol.
+        counts (Counter): Stimuli by step, e.g. tagging pulses under run_tagging.
+        errors (list): Problems that stop the protocol from running.
+        warnings (list): Things that could not be checked.
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self.steps = []
+        self.events = []
+        self.total_ms = 0
+        self.counts = collections.Counter()
+        self.errors = []
+        self.warnings = []
+
+    def to_pandas(self):
+        """
+        Returns:
+            pd.DataFrame: One row per command.
+        """
+        import pandas as pd
+
+        return pd.DataFrame(self.events)
+
+    def report(self):
+        """
+        Returns:
+            str: Total duration and stimulus counts, then any errors and warnings.
+        """
+        lines = [
+            f"Protocol {self.name}: {len(self.steps)} steps, {len(self.events)} commands, "
+            f"{self.total_ms} ms ({_format_duration(self.total_ms)})"
+        ]
+        for step_name, count in sorted(self.counts.items()):
+            if count:
+                duration_ms = sum(step["duration_ms"] for step in self.steps if step["step"] == step_name)
+                lines.append(f"  {step_name:<18} {count:>5} stimuli  {duration_ms:>10} ms")
+        lines += [f"ERROR: {error}" for error in self.errors]
+        lines += [f"Warning: {warning}" for warning in self.warnings]
+        return "\n".join(lines)
+
+
+def _format_duration(duration_ms):
+    minutes, seconds = divmod(duration_ms / 1000, 60)
+    hours, minutes = divmod(int(minutes), 60)
+    return f"{hours}h{minutes:02d}m{seconds:06.3f}s"
+
+
+class Protocol:
+    """
+    An experiment protocol: a name and a list of steps, each a {method name: kwargs} dict or a
+    {"repeat": {"n": n, "steps": [...]}} block.
+    """
+
+    def __init__(self, name="protocol", steps=None, gas_map=None, odor_map=None):
+        """
+        Args:
+            name (str, optional): Name for reports. Defaults to "protocol".
+            steps (list, optional): Steps as in a protocol file. Defaults to none.
+            gas_map (dict, optional): Gas on each valve, if the Controller will not use DEFAULT_GAS_MAP.
+            odor_map (dict, optional): Odor on each olfactometer valve, to check present_odor steps.
+        """
+        self.name = name
+        self.steps = list(steps or [])
+        self.gas_map = gas_map
+        self.odor_map = odor_map
+
+    def add(self, step_name, **kwargs):
+        """
+        Append a step. Returns the protocol, so calls can be chained.
+        """
+        self.steps.append({step_name: kwargs})
+        return self
+
+    def repeat(self, n, block):
+        """
+        Append another protocol's steps, repeated n times. Returns the protocol.
+        """
+        self.steps.append({"repeat": dict(n=n, steps=list(block.steps))})
+        return self
+
+    @classmethod
+    def load(cls, path):
+        """
+        Read a protocol from a .json, .yaml or .yml file (YAML needs pyyaml).
+        """
+        path = Path(path)
+        if path.suffix in [".yaml", ".yml"]:
+            import yaml
+
+            spec = yaml.safe_load(path.read_text())
+        else:
+            spec = json.loads(path.read_text())
+        return cls(
+            spec.get("name", path.stem),
+            spec.get("steps", []),
+            gas_map=spec.get("gas_map"),
+            odor_map=spec.get("odor_map"),
+        )
+
+    def flat_steps(self):
+        """
+        Returns:
+            list: (where, step name, kwargs) of every step in the order it runs, with repeat blocks unrolled.
+        """
+        return list(_flatten(self.steps, "steps"))
+
+    def compile(self, gas_map=None, odor_map=None, settle_time_sec=DEFAULT_SETTLE_SEC):
+        """
+        Check every step and lay out the timeline.
+
+        Args:
+            gas_map (dict, optional): Overrides the protocol's gas map, e.g. the Controller's.
+            odor_map (dict, optional): Overrides the protocol's odor map, e.g. the Controller's.
+            settle_time_sec (float, optional): For settle steps without one. Defaults to DEFAULT_SETTLE_SEC.
+
+        Returns:
+            Timeline: Check timeline.errors before running it.
+        """
+        timeline = Timeline(self.name)
+        context = dict(
+            gas_map=gas_map or self.gas_map or DEFAULT_GAS_MAP,
+            odor_map=odor_map or self.odor_map,
+            settle_time_sec=settle_time_sec,
+            warnings=timeline.warnings,
+        )
+        onset_ms = 0
+        for where, step_name, kwargs in self.flat_steps():
+            try:
+                duration_ms, events, n_stimuli = _compile_step(context, step_name, kwargs)
+            except (TypeError, ValueError) as e:
+                timeline.errors.append(f"{where} ({step_name}): {e}")
+                continue
+            timeline.steps.append(
+                dict(where=where, step=step_name, kwargs=kwargs, onset_ms=onset_ms, duration_ms=duration_ms)
+            )
+            for event in events:
+                event["onset_ms"] += onset_ms
+                timeline.events.append(event)
+            timeline.counts[step_name] += n_stimuli
+            onset_ms += duration_ms
+        timeline.total_ms = onset_ms
+        # A repeated block reports the same problem once per repetition
+        timeline.errors = list(dict.fromkeys(timeline.errors))
+        timeline.warnings[:] = list(dict.fromkeys(timeline.warnings))
+        return timeline
+
+    def run(self, controller, verbose=True, checkpoint_path=None, resume_from=None):
+        """
+        Compile against the controller's gas and odor maps, then run every step if there were no errors.
+
+        A checkpoint is saved after every step (see checkpoint.py), so that resume can carry on after the session
+        died.
+
+        Args:
+            controller (Controller): The Controller to run on.
+            verbose (bool, optional): Print the timeline report. Defaults to True.
+            checkpoint_path (str or Path, optional): Where to save the checkpoint. Defaults to
+                <controller.gate_dest_default>/_cibbrig_checkpoint.<name>.json.
+            resume_from (Checkpoint, optional): Restore its state and only run the steps after it (see resume).
+
+        Raises:
+            ProtocolError: Before anything is sent, if the protocol does not compile.
+
+        Returns:
+            Timeline: The compiled protocol that was run.
+        """
+        timeline = self.compile(controller.gas_map, controller.odor_map, controller.settle_time_sec)
+        if timeline.errors:
+            raise ProtocolError(timeline.errors)
+        print(timeline.report()) if verbose else None
+        if checkpoint_path is None:
+            checkpoint_path = Path(controller.gate_dest_default).joinpath(checkpoint_filename(self.name))
+        if not Path(checkpoint_path).parent.exists():
+            print(f"NO CHECKPOINTS SAVED!!! {Path(checkpoint_path).parent} does not exist")
+            checkpoint_path = None
+        steps = self.flat_steps()
+        start_step = 0
+        if resume_from is not None:
+            start_step = resume_from.next_step
+            print(f"Resuming {self.name} at step {start_step + 1} of {len(steps)}")
+            resume_from.restore(controller, verbose=verbose)
+        for index in range(start_step, len(steps)):
+            where, step_name, kwargs = steps[index]
+            getattr(controller, step_name)(**kwargs)
+            if checkpoint_path is not None:
+                Checkpoint.capture(controller, self, index + 1).save(checkpoint_path)
+        return timeline
+
+    @classmethod
+    def resume(cls, controller, checkpoint_path, verbose=True):
+        """
+        Carry on with a protocol from its last checkpoint, e.g. after the script crashed or was interrupted.
+
+        Restores the random state, odor map and device state, starts the recording again as the next trigger of
+        the same gate (increment_gate=False) if one was running, and runs the steps after the last one that
+        finished.
+
+        Args:
+            controller (Controller): A connected Controller, e.g. a new one after a crash.
+            checkpoint_path (str or Path): Checkpoint saved by run.
+            verbose (bool, optional): Print the timeline report. Defaults to True.
+
+        Returns:
+            Timeline: The compiled protocol, or None if it had already finished.
+        """
+        checkpoint = Checkpoint.load(checkpoint_path)
+        if checkpoint.done:
+            print(f"{checkpoint.protocol['name']} already finished ({checkpoint.saved_at}), nothing to resume")
+            return None
+        protocol = cls(**checkpoint.protocol)
+        if checkpoint.odor_map is not None:
+            # Compile against the odor map the protocol ran with
+            controller.odor_map = checkpoint.odor_map
+        return protocol.run(controller, verbose=verbose, checkpoint_path=checkpoint_path, resume_from=checkpoint)
+
+
+def _flatten(steps, where):
+    for ii, spec in enumerate(steps):
+        here = f"{where}[{ii}]"
+        if not isinstance(spec, dict) or len(spec) != 1:
+            yield here, None, spec
+            continue
+        (step_name, kwargs), = spec.items()
+        if step_name == "repeat":
+            for _ in range(kwargs.get("n", 1)):
+                yield from _flatten(kwargs.get("steps", []), f"{here}.repeat.steps")
+        else:
+            yield here, step_name, dict(kwargs or {})
+
+
+def _compile_step(context, step_name, kwargs):
+    """
+    Compile one step.
+
+    Returns:
+        tuple: (duration_ms, events, n_stimuli), with event onsets relative to the step.
+    """
+    if step_name not in STEPS:
+        raise ValueError(f"unknown step, must be a {{step: kwargs}} entry with a step in {sorted(STEPS)}")
+    compiler = STEPS[step_name]
+    kwargs = dict(kwargs)
+    kwargs.pop("log_enabled", None)
+    n = interval = None
+    if compiler.repeatable:
+        n, interval = kwargs.pop("n", None), kwargs.pop("interval", 5)
+    # The signature is the Controller method's, so a wrong keyword fails here as it would in the session
+    inspect.signature(compiler).bind(context, **kwargs)
+    duration_sec, commands, n_stimuli = compiler(context, **kwargs)
+
+    events = []
+    for offset_sec, command_name, fields in commands:
+        command = COMMANDS[command_name]
+        values = command.values(**fields)
+        events.append(
+            dict(
+                onset_ms=_ms(offset_sec),
+                duration_ms=math.ceil(command.expected_sec(values) * 1000),
+                step=step_name,
+                command=command_name,
+                fields=fields,
+            )
+        )
+    duration_ms = max([round(duration_sec * 1000)] + [event["onset_ms"] + event["duration_ms"] for event in events])
+    if n is None:
+        return duration_ms, events, n_stimuli
+
+    # Repeated on a grid, the block ends one interval after the last onset (see nebPod.repeater)
+    interval_ms = round(interval * 1000)
+    if interval_ms < duration_ms:
+        raise ValueError(f"interval={interval}s is shorter than the step itself ({duration_ms} ms)")
+    repeated = [dict(event, onset_ms=event["onset_ms"] + ii * interval_ms) for ii in range(n) for event in events]
+    return n * interval_ms, repeated, n * n_stimuli
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compile a protocol file and report its timeline, without hardware.")
+    parser.add_argument("path", type=Path, help="Protocol file (.yaml, .yml or .json)")
+    parser.add_argument("--events", action="store_true", help="Also print every command")
+    args = parser.parse_args()
+
+    timeline = Protocol.load(args.path).compile()
+    if args.events:
+        print(timeline.to_pandas().to_string())
+    print(timeline.report())
+    if timeline.errors:
+        raise SystemExit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,133 @@
+"""
+Rebuild the log table and odor map of a session from its log journal, e.g. after the script crashed or the PC
+lost power before stop_recording/close saved them.
+
+The journal holds every entry that reached the disk, with checksums, plus the recording start time, odor map and
+filenames (see log_journal.py). The table is derived exactly as Controller.save_log does, except that the last gas
+presentation lasts until the last time recorded in the journal. If the session emitted sync pulses, the sample map
+is refitted from the sample counts logged with them (the Controller reads more counts than it logs, so the refit
+can differ slightly from the online one), and the sync map is written too.
+
+Usage:
+    python recover_log.py <gate_dir or journal> [--out <dir>] [--format tsv|parquet] [--overwrite]
+
+A gate directory recovers every journal in it. Existing tables are only replaced with --overwrite.
+"""
+
+import argparse
+import json
+import time
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+from log_journal import load_journal
+from log_store import frame_to_arrow, log_table, replace_atomically
+from sglx_sync import SampleMap, event_times, sync_map, sync_map_filename
+
+JOURNAL_GLOB = "*_log.journal.*.jsonl"
+
+
+def table_filename(journal_path):
+    """
+    Inverse of log_journal.journal_filename.
+    """
+    return Path(journal_path).name.replace("_log.journal.", "_log.table.").replace(".jsonl", ".tsv")
+
+
+def odormap_filename(journal_path):
+    return Path(journal_path).name.replace("_log.journal.", "_odors.map.").replace(".jsonl", ".json")
+
+
+def recover(journal_path, out_dir=None, file_format="tsv", overwrite=False):
+    """
+    Rebuild the table, odor map and sync map of one journal.
+
+    Args:
+        journal_path (str or Path): Journal to recover.
+        out_dir (str or Path, optional): Where to write. Defaults to the journal's directory.
+        file_format (str, optional): "tsv" or "parquet" (needs pyarrow). Defaults to "tsv".
+        overwrite (bool, optional): Replace existing files. Defaults to False.
+
+    Returns:
+        list: Paths written.
+    """
+    journal_path = Path(journal_path)
+    out_dir = journal_path.parent if out_dir is None else Path(out_dir)
+    entries, meta = load_journal(journal_path)
+    if not entries:
+        print(f"{journal_path} has no entries")
+        return []
+    out_dir.mkdir(parents=True, exist_ok=True)
+    log_df = pd.DataFrame(entries)
+
+    base_time = meta.get("rec_start_time") or meta.get("init_time")
+    if base_time is None:
+        # Journals written before the metadata was added
+        rec_start = log_df[log_df["label"] == "rec_start"]
+        base_time = (rec_start if len(rec_start) else log_df)["start_time"].iloc[0]
+        print(f"{journal_path} has no recording start time, using {base_time:.3f}")
+    last_time = np.nanmax(log_df[["start_time", "end_time"]].values)
+    save_fn = out_dir.joinpath(meta.get("log_filename") or table_filename(journal_path))
+    written = []
+
+    sample_map = SampleMap.from_log(log_df, **meta["sample_stream"]) if "sample_stream" in meta else SampleMap()
+    if sample_map.ready:
+        log_df["sample_index"] = sample_map.to_sample(event_times(log_df))
+        sync_save_fn = save_fn.with_name(sync_map_filename(save_fn.name))
+        if _can_write(sync_save_fn, overwrite):
+            sync_json = json.dumps(sync_map(sample_map, log_df))
+            replace_atomically(sync_save_fn, lambda tmp_fn: tmp_fn.write_text(sync_json))
+            written.append(sync_save_fn)
+            print(f"Recovered the sync map to {sync_save_fn}")
+    log_df = log_table(log_df, base_time, last_time)
+
+    if file_format == "parquet":
+        import pyarrow.parquet as pq
+
+        save_fn = save_fn.with_suffix(".parquet")
+        write = lambda tmp_fn: pq.write_table(frame_to_arrow(log_df), tmp_fn)
+    else:
+        write = lambda tmp_fn: log_df.to_csv(tmp_fn, sep="\t")
+    if _can_write(save_fn, overwrite):
+        replace_atomically(save_fn, write)
+        written.append(save_fn)
+        print(f"Recovered {len(log_df)} entries to {save_fn}")
+
+    odor_map = meta.get("odor_map")
+    if odor_map is not None:
+        odor_save_fn = out_dir.joinpath(meta.get("odormap_filename") or odormap_filename(journal_path))
+        if _can_write(odor_save_fn, overwrite):
+            replace_atomically(odor_save_fn, lambda tmp_fn: tmp_fn.write_text(json.dumps(odor_map)))
+            written.append(odor_save_fn)
+            print(f"Recovered the odor map to {odor_save_fn}")
+    return written
+
+
+def _can_write(path, overwrite):
+    if path.exists() and not overwrite:
+        print(f"{path} exists, not replacing it (use --overwrite)")
+        return False
+    return True
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Rebuild log tables and odor maps from log journals.")
+    parser.add_argument("path", type=Path, help="Log journal, or a gate directory to recover every journal in")
+    parser.add_argument("--out", type=Path, help="Directory to write to. Defaults to the journal's directory")
+    parser.add_argument("--format", choices=["tsv", "parquet"], default="tsv")
+    parser.add_argument("--overwrite", action="store_true", help="Replace existing tables and odor maps")
+    args = parser.parse_args()
+
+    journals = sorted(args.path.glob(JOURNAL_GLOB)) if args.path.is_dir() else [args.path]
+    if not journals:
+        print(f"No log journals in {args.path}")
+    for journal_path in journals:
+        start = time.perf_counter()
+        recover(journal_path, args.out, args.format, args.overwrite)
+        print(f"Recovered {journal_path.name} in {time.perf_counter() - start:.2f}s")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,93 @@
+"""
+Onsets on a fixed grid of clock times.
+
+Waiting a fixed interval after each stimulus makes the true inter-trial interval the interval plus however long
+the command, the log write and the GUI took, and the error adds up over a block. A Schedule fixes every onset in
+advance instead, relative to one start time:
+
+    onset(i) = start + i * interval_sec
+
+and waits for each with the clock's sleep_until (see clock.py), so the time a repetition takes only eats into
+the wait before the next one. An onset that comes due while the previous repetition is still running is started
+at once, and counted as late; the ones after it stay on the grid.
+
+The Controller's repeater runs every repetition on a Schedule, and each logged repetition gets its scheduled_time
+and onset_error: its start_time minus the scheduled time. That is the host's part of the error, the serial link's
+part is device_onset_time minus start_time (v3 firmware).
+
+    schedule = Schedule(controller.clock, 30)
+    for ii in range(5):
+        controller.wait(deadline=schedule.onset(ii), progress=None)
+        controller.run_train(5, 10, 0.6)
+"""
+
+import numpy as np
+
+LATE_SEC = 0.001  # Onset errors above this are counted as late
+
+
+class Schedule:
+    """
+    Onset times at a fixed interval, and the error of every onset run so far.
+
+    Attributes:
+        clock (SessionClock): Clock the onsets are on.
+        interval_sec (float): Time between onsets.
+        start (float): Time of onset 0.
+        errors (list): Onset errors (s), in the order they were recorded.
+    """
+
+    def __init__(self, clock, interval_sec, start=None):
+        """
+        Args:
+            clock (SessionClock): Clock the onsets are on.
+            interval_sec (float): Time between onsets.
+            start (float, optional): Time of onset 0. Defaults to now.
+        """
+        self.clock = clock
+        self.interval_sec = interval_sec
+        self.start = clock.now() if start is None else start
+        self.errors = []
+
+    def onset(self, index):
+        """
+        Returns:
+            float: Scheduled time of onset `index`.
+        """
+        return self.start + index * self.interval_sec
+
+    def restart(self, index):
+        """
+        Move the grid so that onset `index` is now, e.g. after the user skipped the wait before it.
+        """
+        self.start = self.clock.now() - index * self.interval_sec
+
+    def record(self, scheduled_time, onset_time):
+        """
+        Record when a scheduled onset happened.
+
+        Args:
+            scheduled_time (float): From onset().
+            onset_time (float): When it happened.
+
+        Returns:
+            dict: scheduled_time and onset_error, for the log entry of the onset.
+        """
+        onset_error = onset_time - scheduled_time
+        self.errors.append(onset_error)
+        return dict(scheduled_time=scheduled_time, onset_error=onset_error)
+
+    def summary(self):
+        """
+        Returns:
+            dict: Number of onsets, mean and largest absolute onset error (ms) and number of late onsets.
+        """
+        errors = np.array(self.errors)
+        if len(errors) == 0:
+            return dict(n=0, mean_ms=np.nan, max_abs_ms=np.nan, n_late=0)
+        return dict(
+            n=len(errors),
+            mean_ms=1e3 * errors.mean(),
+            max_abs_ms=1e3 * np.abs(errors).max(),
+            n_late=int((errors > LATE_SEC).sum()),
+        )
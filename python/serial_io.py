@@ -0,0 +1,508 @@
+"""
+Background serial I/O for the Controller.
+
+A single SerialIOThread owns the serial port. Commands are submitted from any thread and return a
+concurrent.futures.Future that resolves to the teensy's Reply once the command has been acknowledged:
+
+    future = io_thread.submit(COMMANDS["run_train"], values, timeout=12)
+    ...  # the caller is free to keep working while the train runs
+    reply = future.result()
+
+With v1 (legacy) firmware, SerialIOThread sends and acknowledges commands strictly one at a time, in the
+order they were submitted. With v2 firmware, PipelinedSerialIO writes each frame as soon as it is submitted
+and matches replies to commands by sequence id, so several commands can be in flight at once. With v3
+firmware it sends timed frames, and every Reply also carries the device time the command took effect, and the
+host times it was sent and received (see clock_sync.py). With v4 firmware, a stimulus program streams a completion
+record for every step while it runs, and they are collected on the Reply of its run_program (see stim_program.py).
+"""
+
+import collections
+import queue
+import threading
+import struct
+import time
+from concurrent.futures import Future
+
+from clock import SessionClock
+from commands import (
+    MAX_FRAME_BYTES,
+    MAX_REPLY_PAYLOAD,
+    ONSET_BYTES,
+    RECORD_BYTES,
+    RECORD_START,
+    REPLY_HEADER_BYTES,
+    REPLY_START,
+    REPLY_START_TIMED,
+    STATUS_OK,
+    STATUS_UNKNOWN_COMMAND,
+)
+
+ACK = 255
+READ_POLL_SEC = 0.05  # How often the v2 reader wakes up to check for timeouts and stop requests
+DRAIN_ONLY = "empty_read_buffer"  # desync_bytes key for bytes discarded by a drain that sends no command
+IDLE = "idle"  # desync_bytes key for v2 stray bytes that arrive with no command in flight
+
+
+class AckTimeoutError(TimeoutError):
+    """
+    Raised when the teensy does not acknowledge a command within its timeout.
+    """
+    pass
+
+
+class ProtocolError(RuntimeError):
+    """
+    Raised when the teensy rejects a command or the host cannot frame it.
+    """
+    pass
+
+
+class Reply:
+    """
+    What the teensy sent back for one command.
+
+    Attributes:
+        command (str): Name of the command that was acknowledged.
+        payload (bytes): Data bytes sent before the acknowledgement (e.g. the photometer read).
+        status (bytes): Any other bytes that arrived before the acknowledgement (e.g. 111 when the olfactometer is missing).
+            For v2 replies, the status code if it is not STATUS_OK.
+        seq (int): Sequence id echoed by v2 firmware. None for v1 replies.
+        onset_us (int): Device micros() when the command took effect (v3 timed replies). None otherwise.
+        sent_time (float): Host clock time the frame was written (v2 and v3).
+        received_time (float): Host clock time the reply was read (v2 and v3).
+        records (list): (step index, onset micros, host time received) of every completion record streamed before
+            the reply (v4 run_program).
+    """
+
+    def __init__(
+        self,
+        command,
+        payload=b"",
+        status=b"",
+        seq=None,
+        onset_us=None,
+        sent_time=None,
+        received_time=None,
+        records=(),
+    ):
+        self.command = command
+        self.payload = payload
+        self.status = status
+        self.seq = seq
+        self.onset_us = onset_us
+        self.sent_time = sent_time
+        self.received_time = received_time
+        self.records = list(records)
+
+    def __repr__(self):
+        return f"Reply({self.command!r}, payload={self.payload!r}, status={self.status!r}, seq={self.seq})"
+
+
+class _Request:
+    __slots__ = ("command", "values", "timeout", "drain", "future", "deadline", "sent_time", "records")
+
+    def __init__(self, command, values, timeout, drain, future=None):
+        self.command = command
+        self.values = values
+        self.timeout = timeout
+        self.drain = drain
+        self.future = future or Future()
+        self.deadline = None
+        self.sent_time = None
+        self.records = []
+
+
+class ReplyParser:
+    """
+    Incremental parser for protocol v2 replies, v3 timed replies and v4 completion records.
+
+    Bytes that are not part of a well formed reply (e.g. left over from a v1 exchange) are skipped and counted.
+
+    Attributes:
+        skipped_bytes (int): Number of bytes skipped since the parser was created.
+        last_skipped (bytes): Bytes skipped by the most recent call to feed.
+        last_records (list): (seq, step index, onset_us) of every completion record in the most recent call to feed.
+    """
+
+    def __init__(self):
+        self.skipped_bytes = 0
+        self.last_skipped = b""
+        self.last_records = []
+        self._buffer = bytearray()
+
+    def feed(self, data):
+        """
+        Add received bytes.
+
+        Returns:
+            list: (seq, status, payload, onset_us) of every reply completed by these bytes. onset_us is None for
+                untimed replies.
+        """
+        self._buffer += data
+        replies = []
+        records = []
+        skipped = bytearray()
+        while True:
+            start = _find_reply_start(self._buffer)
+            if start < 0:
+                skipped += self._buffer
+                self._buffer.clear()
+                break
+            if start > 0:
+                skipped += self._buffer[:start]
+                del self._buffer[:start]
+            if self._buffer[0] == RECORD_START:
+                if len(self._buffer) < RECORD_BYTES:
+                    break
+                index, onset_us = struct.unpack_from("<HI", self._buffer, 2)
+                records.append((self._buffer[1], index, onset_us))
+                del self._buffer[:RECORD_BYTES]
+                continue
+            if len(self._buffer) < REPLY_HEADER_BYTES:
+                break
+            n_payload = self._buffer[3]
+            if n_payload > MAX_REPLY_PAYLOAD:
+                # Not a real reply header
+                skipped += self._buffer[:1]
+                del self._buffer[:1]
+                continue
+            timed = self._buffer[0] == REPLY_START_TIMED
+            header_bytes = REPLY_HEADER_BYTES + (ONSET_BYTES if timed else 0)
+            end = header_bytes + n_payload
+            if len(self._buffer) < end:
+                break
+            onset_us = struct.unpack_from("<I", self._buffer, REPLY_HEADER_BYTES)[0] if timed else None
+            replies.append((self._buffer[1], self._buffer[2], bytes(self._buffer[header_bytes:end]), onset_us))
+            del self._buffer[:end]
+        self.skipped_bytes += len(skipped)
+        self.last_skipped = bytes(skipped)
+        self.last_records = records
+        return replies
+
+
+def _find_reply_start(buffer):
+    starts = [
+        index
+        for index in (buffer.find(REPLY_START), buffer.find(REPLY_START_TIMED), buffer.find(RECORD_START))
+        if index >= 0
+    ]
+    return min(starts) if starts else -1
+
+
+def resolve_reply(request, seq, status, payload, onset_us=None, received_time=None):
+    """
+    Resolve a request's future from a parsed v2 or v3 reply.
+    """
+    if request.future.done():
+        return
+    if status == STATUS_UNKNOWN_COMMAND:
+        request.future.set_exception(
+            ProtocolError(f"{request.command.name}: teensy does not know this command")
+        )
+        return
+    status_bytes = b"" if status == STATUS_OK else bytes([status])
+    request.future.set_result(
+        Reply(
+            request.command.name,
+            payload,
+            status_bytes,
+            seq,
+            onset_us,
+            request.sent_time,
+            received_time,
+            request.records,
+        )
+    )
+
+
+def oldest_pending(pending):
+    """
+    Name of the in-flight command the teensy is working on, or IDLE.
+    """
+    if not pending:
+        return IDLE
+    # Dicts keep insertion order, and the teensy runs commands in the order they were sent
+    return next(iter(pending.values())).command.name
+
+
+def record_desync(desync_bytes, name, data):
+    """
+    Count bytes discarded because host and firmware were out of step, and say so.
+
+    Args:
+        desync_bytes (collections.Counter): Discarded bytes per command name.
+        name (str): Command that was about to be sent or whose reply was awaited.
+        data (bytes): The discarded bytes.
+    """
+    desync_bytes[name] += len(data)
+    print(f"Discarded {len(data)} stale bytes ({data.count(ACK)} stray acks) at {name}")
+
+
+class SerialIOThread(threading.Thread):
+    """
+    Thread that owns the serial port and runs submitted commands in order.
+
+    Attributes:
+        serial_object (Transport): The transport to the teensy (see transports.py).
+        last_future (Future): Future of the most recently submitted request.
+        desync_bytes (collections.Counter): Stale bytes discarded before each command name.
+    """
+
+    def __init__(self, serial_object, desync_bytes=None):
+        """
+        Args:
+            serial_object (Transport): The transport to the teensy (see transports.py).
+            desync_bytes (collections.Counter, optional): Counter to add discarded bytes to. Defaults to a new one.
+        """
+        super().__init__(name="SerialIOThread", daemon=True)
+        self.serial_object = serial_object
+        self.last_future = None
+        self.desync_bytes = desync_bytes if desync_bytes is not None else collections.Counter()
+        self._requests = queue.Queue()
+        self._tx_buffer = bytearray(MAX_FRAME_BYTES)
+        self._tx_view = memoryview(self._tx_buffer)
+
+    def submit(self, command, values, timeout, drain=False):
+        """
+        Queue a command.
+
+        Args:
+            command (Command): Entry from a command table.
+            values (list): Field values already checked by command.values().
+            timeout (float): Seconds to wait for the acknowledgement once the command has been sent.
+            drain (bool, optional): Discard stale bytes from the input buffer before sending. Defaults to False.
+
+        Returns:
+            Future: Resolves to a Reply, or raises AckTimeoutError.
+        """
+        request = _Request(command, values, timeout, drain)
+        self.last_future = request.future
+        self._requests.put(request)
+        return request.future
+
+    def drain(self):
+        """
+        Queue a request that only discards stale bytes from the input buffer.
+
+        Returns:
+            Future: Resolves to the number of bytes discarded.
+        """
+        return self.submit(None, None, 0.0, drain=True)
+
+    def stop(self):
+        """
+        Stop the thread after the requests already queued have run.
+        """
+        self._requests.put(None)
+        self.join()
+
+    def run(self):
+        while True:
+            request = self._requests.get()
+            if request is None:
+                return
+            if not request.future.set_running_or_notify_cancel():
+                continue
+            try:
+                n_drained = self._drain(request) if request.drain else 0
+                if request.command is None:
+                    request.future.set_result(n_drained)
+                    continue
+                n_bytes = request.command.pack_values_into(self._tx_buffer, request.values)
+                self.serial_object.write(self._tx_view[:n_bytes])
+                request.future.set_result(self._read_reply(request))
+            except Exception as e:
+                request.future.set_exception(e)
+
+    def _drain(self, request):
+        """
+        Discard everything in the input buffer, reading it in bulk.
+        """
+        data = b""
+        n_waiting = self.serial_object.in_waiting
+        while n_waiting > 0:
+            data += self.serial_object.read(n_waiting)
+            n_waiting = self.serial_object.in_waiting
+        if data:
+            name = request.command.name if request.command is not None else DRAIN_ONLY
+            record_desync(self.desync_bytes, name, data)
+        return len(data)
+
+    def _read_reply(self, request):
+        """
+        Read the payload of a command, then everything up to and including the acknowledgement byte.
+        """
+        payload = self._read_bytes(request.command.reply_bytes, request)
+        status = bytearray()
+        while True:
+            byte = self._read_bytes(1, request)[0]
+            if byte == ACK:
+                break
+            status.append(byte)
+        return Reply(request.command.name, bytes(payload), bytes(status))
+
+    def _read_bytes(self, n_bytes, request):
+        """
+        Blocking read in the serial driver. No CPU is used while the teensy is busy.
+        """
+        if n_bytes == 0:
+            return b""
+        if self.serial_object.timeout != request.timeout:
+            self.serial_object.timeout = request.timeout
+        data = self.serial_object.read(n_bytes)
+        if len(data) < n_bytes:
+            raise AckTimeoutError(
+                f"{request.command.name}: teensy did not reply within {request.timeout:.1f}s "
+                f"(got {len(data)} of {n_bytes} bytes)"
+            )
+        return data
+
+
+class PipelinedSerialIO(threading.Thread):
+    """
+    Protocol v2 and v3 serial I/O. Frames are written as soon as they are submitted, and this thread reads replies
+    and resolves the matching futures by sequence id.
+
+    The teensy still runs commands one after the other, so each command's timeout starts when the
+    previous command is expected to finish.
+
+    Attributes:
+        serial_object (Transport): The transport to the teensy (see transports.py).
+        last_future (Future): Future of the most recently submitted request.
+        parser (ReplyParser): Parser of the incoming bytes.
+        desync_bytes (collections.Counter): Stray bytes and late replies, by the command that was awaited.
+        timed (bool): Send v3 timed frames, so replies carry the device onset time.
+        clock (SessionClock): Clock the sent and received times of replies are read from.
+    """
+
+    def __init__(self, serial_object, desync_bytes=None, timed=False, clock=None):
+        """
+        Args:
+            serial_object (Transport): The transport to the teensy (see transports.py).
+            desync_bytes (collections.Counter, optional): Counter to add stray bytes to. Defaults to a new one.
+            timed (bool, optional): Send v3 timed frames. Defaults to False.
+            clock (SessionClock, optional): Clock for the sent and received times. Defaults to a new SessionClock.
+        """
+        super().__init__(name="PipelinedSerialIO", daemon=True)
+        self.serial_object = serial_object
+        self.last_future = None
+        self.desync_bytes = desync_bytes if desync_bytes is not None else collections.Counter()
+        self.parser = ReplyParser()
+        self.timed = timed
+        self.clock = clock or SessionClock()
+        self._pending = {}
+        self._next_seq = 0
+        self._busy_until = 0.0
+        self._n_skipped_drained = 0
+        self._read_error = None
+        self._lock = threading.Lock()
+        self._stopped = threading.Event()
+        self._tx_buffer = bytearray(MAX_FRAME_BYTES)
+        self._tx_view = memoryview(self._tx_buffer)
+
+    def submit(self, command, values, timeout, drain=False):
+        """
+        Write a command frame.
+
+        Args:
+            command (Command): Entry from a command table.
+            values (list): Field values already checked by command.values().
+            timeout (float): Seconds to wait for the reply once the teensy gets to the command.
+            drain (bool, optional): Ignored. Stray bytes are skipped by the reply parser.
+
+        Returns:
+            Future: Resolves to a Reply, or raises AckTimeoutError or ProtocolError.
+        """
+        request = _Request(command, values, timeout, drain)
+        with self._lock:
+            self.last_future = request.future
+            if self._read_error is not None:
+                # The reader is gone, so nothing would ever resolve this request
+                request.future.set_exception(self._read_error)
+                return request.future
+            seq = self._next_seq
+            if seq in self._pending:
+                request.future.set_exception(ProtocolError("256 commands are already in flight"))
+                return request.future
+            self._next_seq = (seq + 1) % 256
+            self._busy_until = max(time.monotonic(), self._busy_until) + timeout
+            request.deadline = self._busy_until
+            self._pending[seq] = request
+            try:
+                n_bytes = command.pack_frame_into(self._tx_buffer, values, seq, timed=self.timed)
+                self.serial_object.write(self._tx_view[:n_bytes])
+                request.sent_time = self.clock.now()
+            except Exception as e:
+                del self._pending[seq]
+                request.future.set_exception(e)
+        return request.future
+
+    def drain(self):
+        """
+        Stray bytes are already skipped by the reply parser, so there is nothing to discard.
+
+        Returns:
+            Future: Resolves to the number of stray bytes skipped since the last drain.
+        """
+        future = Future()
+        with self._lock:
+            n_skipped = self.parser.skipped_bytes - self._n_skipped_drained
+            self._n_skipped_drained = self.parser.skipped_bytes
+        future.set_result(n_skipped)
+        return future
+
+    def stop(self):
+        """
+        Stop the reader thread. Requests still in flight fail with AckTimeoutError.
+        """
+        self._stopped.set()
+        self.join()
+        self._expire(float("inf"))
+
+    def run(self):
+        self.serial_object.timeout = READ_POLL_SEC
+        while not self._stopped.is_set():
+            try:
+                data = self.serial_object.read(max(1, self.serial_object.in_waiting))
+            except Exception as e:
+                self._fail_all(e)
+                return
+            if data:
+                received_time = self.clock.now()
+                with self._lock:
+                    awaited = oldest_pending(self._pending)
+                    replies = self.parser.feed(data)
+                    # Records come before the reply of their program, which may be in the same bytes
+                    for seq, index, onset_us in self.parser.last_records:
+                        if seq in self._pending:
+                            self._pending[seq].records.append((index, onset_us, received_time))
+                    requests = [self._pending.pop(seq, None) for seq, _, _, _ in replies]
+                if self.parser.last_skipped:
+                    record_desync(self.desync_bytes, awaited, self.parser.last_skipped)
+                for request, (seq, status, payload, onset_us) in zip(requests, replies):
+                    if request is None:
+                        # Reply to a command that already timed out
+                        self.desync_bytes[IDLE] += REPLY_HEADER_BYTES + len(payload)
+                        continue
+                    resolve_reply(request, seq, status, payload, onset_us, received_time)
+            self._expire(time.monotonic())
+
+    def _expire(self, now):
+        with self._lock:
+            expired = [seq for seq, request in self._pending.items() if request.deadline < now]
+            requests = [self._pending.pop(seq) for seq in expired]
+        for request in requests:
+            if request.future.done():
+                continue
+            request.future.set_exception(
+                AckTimeoutError(f"{request.command.name}: teensy did not reply within {request.timeout:.1f}s")
+            )
+
+    def _fail_all(self, exception):
+        with self._lock:
+            self._read_error = exception
+            requests = list(self._pending.values())
+            self._pending.clear()
+        for request in requests:
+            if not request.future.done():
+                request.future.set_exception(exception)
@@ -0,0 +1,144 @@
+"""
+Software stand-in for the SpikeGLX API (the sglx module of the SpikeGLX-CPP-SDK).
+
+Pass one to the Controller to run record_control="sglx" sessions without SpikeGLX:
+
+    from sglx_sim import SpikeGLXSimulator
+    from nebPod import Controller
+
+    sglx = SpikeGLXSimulator(data_dir="/tmp/sglx_data")
+    controller = Controller(None, transport=sim.transport, sglx=sglx)
+
+It has the c_sglx_* functions the Controller calls, with the same arguments (outputs are passed with
+ctypes.byref), and keeps the state SpikeGLX would: the data directory, run name, next file name, recording
+enable and the gate/trigger. Starting a trigger writes the .meta file SpikeGLX would, with its firstSample.
+
+Each stream counts samples off the host's perf_counter, at its nominal rate with a drift, and reports the count
+it has fetched, `fetch_lag_sec` behind acquisition. `sample_index` gives the true sample index of a perf_counter
+time, to check the sample map against (see sglx_sync.py). Every query takes `latency_sec`, like a round trip to
+the SpikeGLX server.
+
+Pass the Controller's clock to count samples off it instead, e.g. a ManualClock in a dry run (see dry_run.py).
+"""
+
+import tempfile
+import time
+from pathlib import Path
+
+SAMPLE_RATES = {0: 25000.0, 1: 25000.0, 2: 30000.0}  # Nominal rate by stream type (js): nidq, obx, imec
+
+
+class SpikeGLXSimulator:
+    """
+    Stand-in for the sglx module.
+
+    Attributes:
+        data_dir (Path): SpikeGLX's data directory 0.
+        run_name (str): Name of the current run.
+        drift_ppm (float): How much faster the probe clock runs than the host clock.
+        fetch_lag_sec (float): How far the reported sample count trails acquisition.
+        latency_sec (float): Time every API call takes.
+        running (bool): Whether a run is in progress.
+        recording_enabled (bool): Set by c_sglx_setRecordingEnable.
+        next_file_name (str): Set by c_sglx_setNextFileName.
+        gate_triggers (list): (gate, trigger) of every c_sglx_triggerGT call.
+        clock (SessionClock): Clock the streams count samples off, or None for the host's perf_counter.
+    """
+
+    def __init__(
+        self, data_dir=None, run_name="sim_run", drift_ppm=0.0, fetch_lag_sec=0.0, latency_sec=0.0005, clock=None
+    ):
+        self.clock = clock
+        self.data_dir = Path(data_dir or tempfile.mkdtemp(prefix="sglx_data_"))
+        self.data_dir.mkdir(parents=True, exist_ok=True)
+        self.run_name = run_name
+        self.drift_ppm = drift_ppm
+        self.fetch_lag_sec = fetch_lag_sec
+        self.latency_sec = latency_sec
+        self.running = True
+        self.recording_enabled = False
+        self.next_file_name = None
+        self.gate_triggers = []
+        self._run_start_ns = self._now_ns()
+
+    def _now_ns(self):
+        return time.perf_counter_ns() if self.clock is None else self.clock.now_ns()
+
+    def _sleep(self, seconds):
+        if self.clock is None:
+            time.sleep(seconds)
+        else:
+            self.clock.sleep(seconds)
+
+    def sample_index(self, perf_counter_ns, js=2):
+        """
+        True sample index of stream `js` at a time.perf_counter_ns() value (clock.now_ns() with a clock).
+        """
+        elapsed_sec = (perf_counter_ns - self._run_start_ns) / 1e9
+        return elapsed_sec * SAMPLE_RATES[js] * (1 + self.drift_ppm * 1e-6)
+
+    def _call(self):
+        if self.latency_sec > 0:
+            self._sleep(self.latency_sec)
+        return True
+
+    # ------------------------------------- #
+    # API
+    # ------------------------------------- #
+    def c_sglx_createHandle(self):
+        return object()
+
+    def c_sglx_connect(self, handle, host, port):
+        return self._call()
+
+    def c_sglx_isRunning(self, running, handle):
+        running._obj.value = self.running
+        return self._call()
+
+    def c_sglx_getRunName(self, name, handle):
+        name._obj.value = self.run_name.encode()
+        return self._call()
+
+    def c_sglx_getDataDir(self, data_dir, handle, i):
+        data_dir._obj.value = str(self.data_dir).encode()
+        return self._call()
+
+    def c_sglx_setDataDir(self, handle, i, data_dir):
+        self.data_dir = Path(data_dir.value.decode())
+        return self._call()
+
+    def c_sglx_setNextFileName(self, handle, name):
+        self.next_file_name = name.value.decode()
+        return self._call()
+
+    def c_sglx_setRecordingEnable(self, handle, enable):
+        self.recording_enabled = enable.value
+        return self._call()
+
+    def c_sglx_triggerGT(self, handle, g, t):
+        self.gate_triggers.append((g.value, t.value))
+        if t.value == 1 and self.recording_enabled and self.next_file_name is not None:
+            self._write_meta(Path(self.next_file_name))
+        return self._call()
+
+    def c_sglx_getStreamSampleRate(self, srate, handle, js, ip):
+        srate._obj.value = SAMPLE_RATES[js.value]
+        return self._call()
+
+    def c_sglx_getStreamSampleCount(self, handle, js, ip):
+        # SpikeGLX answers with what it has fetched when the query arrives, half way through the round trip
+        if self.latency_sec > 0:
+            self._sleep(self.latency_sec / 2)
+        count = self.sample_index(self._now_ns() - int(self.fetch_lag_sec * 1e9), js.value)
+        if self.latency_sec > 0:
+            self._sleep(self.latency_sec / 2)
+        return int(count)
+
+    def _write_meta(self, recname):
+        """
+        Write the .meta file SpikeGLX writes when a file starts.
+        """
+        first_sample = int(self.sample_index(self._now_ns()))
+        recname.parent.mkdir(parents=True, exist_ok=True)
+        meta_fn = recname.with_name(recname.name + ".imec0.ap.meta")
+        meta_fn.write_text(f"imSampRate={SAMPLE_RATES[2]}\nfirstSample={first_sample}\n")
@@ -0,0 +1,230 @@
+"""
+Map host times onto SpikeGLX sample indices.
+
+Log times are host clock times, but analysis of a Neuropixels recording happens in sample indices of one of its
+streams. SpikeGLX counts the samples of every stream since the run started, and its API reports that count on
+request. Reading it gives a (host time, sample count) pair, with the host time of the count taken as the midpoint
+of the query's round trip, as for clock pings (see clock_sync.py). A line through such pairs maps any host time to
+a sample index:
+
+    sample_index = sample_ref + rate * (host_time - host_ref)
+
+`rate` starts at the stream's nominal sample rate and is fitted once the pairs span MIN_RATE_SPAN_SEC, which
+absorbs the drift between the host clock and the probe's. The fit uses the pairs of the last RATE_WINDOW_SEC, however
+many the Controller reads per sync pulse, so a drift that changes with temperature is followed.
+
+The count SpikeGLX reports is the count it has fetched from the hardware, which trails acquisition by up to a
+fetch period, so the map carries a small, roughly constant lag. To remove it offline, the Controller emits a coded
+sync pulse whenever it reads the count (see Controller.emit_sync): a GPIO pulse wired to a sync input of the
+recording, whose width encodes the sync index modulo SYNC_CODES. Matching the pulse edges found in the recording
+to the pulses in the map file pins the map to the samples themselves.
+
+Sample indices count from the start of the run. Subtract firstSample from the .meta file of a recording to index
+into its binary file.
+
+    sample_map = SampleMap(sample_rate=30000.0)
+    sample_map.add_sample(count, sent_time, received_time)
+    sample_index = sample_map.to_sample(host_time)
+"""
+
+import collections
+
+import numpy as np
+
+from clock_sync import fit_line
+
+SYNC_CODES = 8  # Pulse widths cycle through this many codes
+SYNC_PULSE_BASE_SEC = 0.01  # Width of the pulse for code 0
+SYNC_PULSE_STEP_SEC = 0.005  # Added to the width per code
+IMEC_STREAM = (2, 0)  # (js, ip) of imec probe 0. The nidq stream is (0, 0)
+MIN_RATE_SPAN_SEC = 60.0  # Counts closer together than this give a worse rate than the nominal one
+RATE_WINDOW_SEC = 600.0  # The rate is fitted to the counts of this many recent seconds
+
+
+def sync_pulse_sec(code):
+    """
+    Width of the sync pulse that encodes `code`.
+    """
+    return SYNC_PULSE_BASE_SEC + code * SYNC_PULSE_STEP_SEC
+
+
+def sync_map_filename(log_filename):
+    """
+    Sync map that goes with a log table, e.g. _cibbrig_sync.map.<run>.g0.t0.json
+    """
+    return str(log_filename).replace("_log.table.", "_sync.map.").replace(".tsv", ".json")
+
+
+def event_times(log_df):
+    """
+    Host time of every log entry: device_onset_time where the teensy reported one, start_time otherwise.
+
+    Args:
+        log_df (pd.DataFrame): Raw log with absolute times.
+
+    Returns:
+        np.ndarray: Times in seconds since the epoch.
+    """
+    times = log_df["start_time"].to_numpy(dtype=float)
+    if "device_onset_time" in log_df:
+        onset_times = log_df["device_onset_time"].to_numpy(dtype=float)
+        times = np.where(np.isnan(onset_times), times, onset_times)
+    return times
+
+
+class SampleMap:
+    """
+    Running estimate of a SpikeGLX stream's sample index as a linear function of host time.
+
+    Attributes:
+        js (int): Stream type (0 nidq, 1 obx, 2 imec).
+        ip (int): Substream, e.g. the probe index.
+        sample_rate (float): Nominal sample rate of the stream (Hz), reported by SpikeGLX.
+        window_sec (float): The line is fitted to the counts read in the last window_sec seconds.
+        max_round_trip_sec (float): Counts read with longer round trips are discarded.
+        rate (float): Fitted samples per host second.
+        host_ref (float): Host time of the reference point.
+        sample_ref (float): Sample index at host_ref.
+        n_samples (int): Counts accepted so far.
+        n_rejected (int): Counts discarded for their round trip.
+    """
+
+    def __init__(
+        self,
+        sample_rate=np.nan,
+        js=IMEC_STREAM[0],
+        ip=IMEC_STREAM[1],
+        window_sec=RATE_WINDOW_SEC,
+        max_round_trip_sec=0.02,
+    ):
+        self.js = js
+        self.ip = ip
+        self.window_sec = window_sec
+        self.max_round_trip_sec = max_round_trip_sec
+        self.reset(sample_rate)
+
+    def reset(self, sample_rate=None):
+        """
+        Forget every count, e.g. when a new SpikeGLX run starts counting from zero.
+
+        Args:
+            sample_rate (float, optional): New nominal sample rate. Defaults to keeping the current one.
+        """
+        if sample_rate is not None:
+            self.sample_rate = sample_rate
+        self.rate = np.nan
+        self.host_ref = np.nan
+        self.sample_ref = np.nan
+        self.n_samples = 0
+        self.n_rejected = 0
+        self._samples = collections.deque()
+
+    @property
+    def ready(self):
+        """
+        Whether host times can be mapped yet.
+        """
+        return self.n_samples > 0 and not np.isnan(self.sample_rate)
+
+    def add_sample(self, sample_count, sent_time, received_time):
+        """
+        Add one sample count query and update the fit.
+
+        Args:
+            sample_count (int): Count SpikeGLX reported.
+            sent_time (float): Host time the query was sent.
+            received_time (float): Host time the count came back.
+
+        Returns:
+            bool: Whether the count was accepted.
+        """
+        round_trip_sec = received_time - sent_time
+        if round_trip_sec > self.max_round_trip_sec:
+            self.n_rejected += 1
+            return False
+        host_time = (sent_time + received_time) / 2
+        self._samples.append((host_time, sample_count, round_trip_sec))
+        self.n_samples += 1
+        while host_time - self._samples[0][0] > self.window_sec:
+            self._samples.popleft()
+        host_sec, sample_count, round_trip_sec = np.array(self._samples, dtype=float).T
+        self.rate, self.host_ref, self.sample_ref = fit_line(
+            host_sec, sample_count, round_trip_sec, default_slope=self.sample_rate, min_span=MIN_RATE_SPAN_SEC
+        )
+        return True
+
+    def to_sample(self, host_times):
+        """
+        Args:
+            host_times (float or np.ndarray): Host clock times, e.g. log start times.
+
+        Returns:
+            float or np.ndarray: Nearest sample indices, NaN until the map is ready or where a time is NaN.
+        """
+        host_times = np.asarray(host_times, dtype=float)
+        if not self.ready:
+            return np.full(host_times.shape, np.nan)[()]
+        return np.rint(self.sample_ref + self.rate * (host_times - self.host_ref))[()]
+
+    def summary(self):
+        """
+        Returns:
+            dict: Current estimate, as written to the sync map file.
+        """
+        return dict(
+            js=self.js,
+            ip=self.ip,
+            sample_rate=self.sample_rate,
+            rate=self.rate,
+            host_ref=self.host_ref,
+            sample_ref=self.sample_ref,
+            n_samples=self.n_samples,
+            n_rejected=self.n_rejected,
+        )
+
+    @classmethod
+    def from_log(cls, log_df, sample_rate, js=IMEC_STREAM[0], ip=IMEC_STREAM[1]):
+        """
+        Refit a map from the sync entries of a log, e.g. one recovered from its journal.
+
+        Args:
+            log_df (pd.DataFrame): Raw log with absolute times.
+            sample_rate (float): Nominal sample rate of the stream.
+
+        Returns:
+            SampleMap: Not ready if the log has no sample counts.
+        """
+        sample_map = cls(sample_rate, js, ip)
+        if "sample_count" not in log_df:
+            return sample_map
+        syncs = log_df[log_df["sample_count"].notna()]
+        for count, time, round_trip_sec in syncs[["sample_count", "sample_count_time", "sample_count_round_trip"]].values:
+            sample_map.add_sample(count, time - round_trip_sec / 2, time + round_trip_sec / 2)
+        return sample_map
+
+
+def sync_map(sample_map, log_df):
+    """
+    Contents of the sync map file: the fit, and every sync pulse with its predicted sample index.
+
+    Args:
+        sample_map (SampleMap): The map.
+        log_df (pd.DataFrame): Raw log with absolute times.
+
+    Returns:
+        dict: JSON-serializable.
+    """
+    syncs = log_df[log_df["category"] == "sync"] if len(log_df) else log_df
+    times = event_times(syncs)
+    pulses = [
+        dict(
+            sync_index=int(sync.sync_index),
+            method=sync.method,
+            code=None if np.isnan(sync.code) else int(sync.code),
+            pulse_sec=None if np.isnan(sync.pulse_sec) else float(sync.pulse_sec),
+            host_time=float(time),
+            sample_index=None if np.isnan(sample_index) else int(sample_index),
+        )
+        for sync, time, sample_index in zip(syncs.itertuples(), times, np.atleast_1d(sample_map.to_sample(times)))
+    ]
+    return dict(**sample_map.summary(), sync_codes=SYNC_CODES, pulses=pulses)
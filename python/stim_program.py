@@ -0,0 +1,273 @@
+"""
+Stimulus programs: a list of timed steps that the teensy runs from its own clock (protocol v4).
+
+A host loop that sends one command, sleeps, and sends the next puts the host's scheduling and the USB link's
+jitter into every inter-stimulus interval. A stimulus program is uploaded in one frame instead, and the firmware
+starts each step at its onset, in microseconds from the start of the program:
+
+    program = StimulusProgram()
+    for ii in range(75):
+        program.pulse(ii * 3.05, duration_sec=0.05, amp=0.8)
+    reply = controller.run_program(program)
+
+Each step is a fixed size record (PROGRAM_STEP_FIELDS in commands.py): onset_us, an opcode, and four arguments
+whose meaning depends on the opcode (see STEP_TYPES). Steps run one after the other, and steps that block the
+firmware (pulses, trains, GPIO pulses) hold up the ones after them, so a step must not start before the one
+before it is done. compile() checks that, and every argument against its wire type, before anything is sent.
+
+While the program runs, the firmware streams a completion record with the device onset of every step, and it
+acknowledges run_program once the program's duration is up. The Controller logs every step with its onset on the
+host clock and its onset error (see Controller.run_program).
+"""
+
+from commands import COMMANDS, MAX_PROGRAM_STEPS
+
+
+class StepType:
+    """
+    One kind of program step.
+
+    Attributes:
+        opcode (str): Opcode character in the step record.
+        args (dict): Argument name -> step record field it is sent in (arg0 and arg1 are uint16, arg2 and arg3
+            uint8).
+        label (str): Label of the step's log entries, as for the Controller method that does the same.
+        category (str): Category of the step's log entries.
+        params (callable): Takes the arguments and returns the params of the log entry, in the units and names the
+            Controller method logs them with.
+        busy (callable): Seconds the firmware is blocked by the step, from its arguments. None if it returns
+            right away.
+    """
+
+    def __init__(self, opcode, args, label, category, params, busy=None):
+        self.opcode = opcode
+        self.args = args
+        self.label = label
+        self.category = category
+        self.params = params
+        self.busy = busy
+
+
+def _ms_arg(arg_name):
+    return lambda args: args[arg_name] / 1000
+
+
+# Steps the firmware runs (runProgramStep in teensy32_firmware.ino). Durations are in ms, amps in percent.
+STEP_TYPES = {
+    "pulse": StepType(
+        "p",
+        dict(duration="arg0", amp="arg2"),
+        "opto_pulse",
+        "opto",
+        lambda args: dict(amplitude=args["amp"] / 100, duration=args["duration"] / 1000),
+        busy=_ms_arg("duration"),
+    ),
+    "train": StepType(
+        "t",
+        dict(duration="arg0", freq="arg1", amp="arg2", pulse_duration="arg3"),
+        "opto_train",
+        "opto",
+        lambda args: dict(
+            amplitude=args["amp"] / 100,
+            duration=args["duration"] / 1000,
+            frequency=args["freq"],
+            pulse_duration=args["pulse_duration"] / 1000,
+        ),
+        busy=_ms_arg("duration"),
+    ),
+    "gpio_pulse": StepType(
+        "g",
+        dict(duration="arg0", pin="arg2"),
+        "gpio",
+        "event",
+        lambda args: dict(pin=args["pin"], mode="p", duration=args["duration"] / 1000),
+        busy=_ms_arg("duration"),
+    ),
+    "gpio_high": StepType("h", dict(pin="arg2"), "gpio", "event", lambda args: dict(pin=args["pin"], mode="h")),
+    "gpio_low": StepType("l", dict(pin="arg2"), "gpio", "event", lambda args: dict(pin=args["pin"], mode="l")),
+    # tone() plays in the background, so a tone does not hold up the next step
+    "tone": StepType(
+        "a",
+        dict(freq="arg0", duration="arg1"),
+        "tone",
+        "event",
+        lambda args: dict(frequency=args["freq"], duration=args["duration"] / 1000),
+    ),
+    "valve": StepType("v", dict(valve="arg2"), "open_valve", "gas", lambda args: dict(valve=args["valve"])),
+    "olfactometer": StepType(
+        "b", dict(valves="arg2"), "set_all_valves", "odor", lambda args: dict(valve=format(args["valves"], "08b")[::-1])
+    ),
+    # Closes the Hering Breuer valve and opens it again after the duration, as timed_hb does
+    "hering_breuer": StepType(
+        "c",
+        dict(duration="arg0"),
+        "hering_breuer",
+        "event",
+        lambda args: dict(duration=args["duration"] / 1000),
+        busy=_ms_arg("duration"),
+    ),
+}
+OPCODE_STEPS = {step_type.opcode: name for name, step_type in STEP_TYPES.items()}
+
+
+def _amp2int(amp):
+    if not 0 <= amp <= 1:
+        raise ValueError(f"amp={amp} must be between 0 and 1")
+    return int(amp * 100)
+
+
+def _sec2ms(val):
+    return int(float(val) * 1000)
+
+
+class StimulusProgram:
+    """
+    A list of timed steps for the teensy to run from its own clock.
+
+    Attributes:
+        steps (list): (step type name, onset in seconds, arguments in wire units) in the order they were added.
+        duration_sec (float): Time from the start of the program to its acknowledgement.
+    """
+
+    def __init__(self, duration_sec=None):
+        """
+        Args:
+            duration_sec (float, optional): Run the program for this long, e.g. to include the interval after the
+                last pulse. Defaults to until the last step is done.
+        """
+        self.steps = []
+        self._duration_sec = duration_sec
+
+    def __len__(self):
+        return len(self.steps)
+
+    def add(self, step_name, onset_sec, **args):
+        """
+        Append a step, with its arguments in wire units (see STEP_TYPES). Returns the program.
+        """
+        if step_name not in STEP_TYPES:
+            raise ValueError(f"Unknown program step {step_name!r}, must be one of {sorted(STEP_TYPES)}")
+        if onset_sec < 0:
+            raise ValueError(f"{step_name}: onset {onset_sec}s is before the start of the program")
+        self.steps.append((step_name, onset_sec, args))
+        return self
+
+    def pulse(self, onset_sec, duration_sec, amp):
+        """
+        Single opto pulse, amp between 0 and 1.
+        """
+        return self.add("pulse", onset_sec, duration=_sec2ms(duration_sec), amp=_amp2int(amp))
+
+    def train(self, onset_sec, duration_sec, freq, amp, pulse_duration_sec):
+        """
+        Opto train at freq Hz, amp between 0 and 1.
+        """
+        if pulse_duration_sec >= 1 / freq:
+            raise ValueError(f"train: a {pulse_duration_sec}s pulse does not fit in a period at {freq}Hz")
+        return self.add(
+            "train",
+            onset_sec,
+            duration=_sec2ms(duration_sec),
+            freq=int(freq),
+            amp=_amp2int(amp),
+            pulse_duration=_sec2ms(pulse_duration_sec),
+        )
+
+    def gpio_pulse(self, onset_sec, pin, duration_sec):
+        """
+        TTL pulse on general purpose output `pin` (an index into gpPins in the firmware).
+        """
+        return self.add("gpio_pulse", onset_sec, duration=_sec2ms(duration_sec), pin=pin)
+
+    def gpio(self, onset_sec, pin, high):
+        """
+        Set general purpose output `pin` high or low.
+        """
+        return self.add("gpio_high" if high else "gpio_low", onset_sec, pin=pin)
+
+    def tone(self, onset_sec, freq, duration_sec):
+        """
+        Audio tone, played in the background.
+        """
+        return self.add("tone", onset_sec, freq=int(freq), duration=_sec2ms(duration_sec))
+
+    def valve(self, onset_sec, valve):
+        """
+        Open gas valve `valve` and close the others.
+        """
+        return self.add("valve", onset_sec, valve=valve)
+
+    def olfactometer(self, onset_sec, valves):
+        """
+        Set all olfactometer valves at once. `valves` is a bit mask, bit 0 is valve 1.
+        """
+        return self.add("olfactometer", onset_sec, valves=valves)
+
+    def hering_breuer(self, onset_sec, duration_sec):
+        """
+        Hering Breuer stimulation for duration_sec (at most 65.535s).
+        """
+        return self.add("hering_breuer", onset_sec, duration=_sec2ms(duration_sec))
+
+    def ordered_steps(self):
+        """
+        Returns:
+            list: The steps in the order the firmware runs them, by onset. Steps with the same onset keep the
+                order they were added in.
+        """
+        return sorted(self.steps, key=lambda step: step[1])
+
+    @staticmethod
+    def busy_sec(step):
+        """
+        Seconds the firmware is blocked by a (step type name, onset, arguments) step.
+        """
+        step_type = STEP_TYPES[step[0]]
+        return step_type.busy(step[2]) if step_type.busy is not None else 0.0
+
+    @property
+    def duration_sec(self):
+        """
+        Time from the start of the program to its acknowledgement.
+        """
+        if self._duration_sec is not None:
+            return self._duration_sec
+        return max([step[1] + self.busy_sec(step) for step in self.steps], default=0.0)
+
+    def compile(self):
+        """
+        Lay out the step records for upload_program.
+
+        Raises:
+            ValueError: If there are too many steps, if a step starts before the previous one is done, if the
+                program ends before its last step does, or if an argument does not fit in its wire type.
+
+        Returns:
+            list: Field dicts of the step records (PROGRAM_STEP_FIELDS), in the order they run.
+        """
+        if len(self.steps) > MAX_PROGRAM_STEPS:
+            raise ValueError(f"{len(self.steps)} steps, a program holds at most {MAX_PROGRAM_STEPS}")
+        records = []
+        busy_until_sec = 0.0
+        previous = None
+        for step in self.ordered_steps():
+            step_name, onset_sec, args = step
+            if onset_sec < busy_until_sec - 1e-9:
+                raise ValueError(
+                    f"{step_name} at {onset_sec:.6f}s starts before the {previous} before it is done "
+                    f"({busy_until_sec:.6f}s)"
+                )
+            busy_until_sec = max(busy_until_sec, onset_sec + self.busy_sec(step))
+            previous = step_name
+            step_type = STEP_TYPES[step_name]
+            unexpected = set(args) - set(step_type.args)
+            if unexpected:
+                raise ValueError(f"{step_name}: unexpected arguments {sorted(unexpected)}")
+            record = dict(onset_us=round(onset_sec * 1e6), opcode=step_type.opcode, arg0=0, arg1=0, arg2=0, arg3=0)
+            record.update({step_type.args[arg_name]: value for arg_name, value in args.items()})
+            records.append(record)
+        if self.duration_sec < busy_until_sec - 1e-9:
+            raise ValueError(f"The program ends at {self.duration_sec}s, before its last step ({busy_until_sec:.6f}s)")
+        # Range checks every record
+        COMMANDS["upload_program"].values(steps=records)
+        return records
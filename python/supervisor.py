@@ -0,0 +1,213 @@
+"""
+Recover from a dropped USB link to the teensy without ending the session.
+
+If the teensy's USB link drops (a loose cable, a hub resetting, the teensy rebooting), the serial port goes away
+under the Controller and every command fails with a SerialException. The LinkSupervisor reopens the port with
+exponential backoff, puts the device back in the state it was in, logs the outage, and lets the experiment carry on.
+
+The state to restore comes from a DeviceJournal: every command that leaves the device in a lasting state (the
+cobalt mode and null voltage, the open gas valve, the Hering Breuer valve, the olfactometer valves, the camera
+trigger, the record pin and the uploaded stimulus program) is journaled when it is submitted, and the last command
+of each kind is sent again once the link is back. A rebooted teensy starts with its power-on defaults, so replaying onto it is always safe.
+
+The Controller does this by itself when it was opened from a port string:
+
+    controller = Controller("COM11")
+    controller.open_valve(2)  # link drops here -> reconnect, replay, open_valve(2) is sent again
+
+Try it against a simulated teensy by yanking its pty (see benchmarks/bench_reconnect.py):
+
+    sim = TeensySimulator(link="/tmp/teensy").start()
+    controller = Controller("serial:///tmp/teensy")
+    sim.unplug(duration_sec=1.0)
+"""
+
+
+from serial_io import AckTimeoutError
+from transports import open_transport
+
+INITIAL_BACKOFF_SEC = 0.1
+MAX_BACKOFF_SEC = 5.0
+GIVE_UP_SEC = 120.0  # Long enough to replug a cable, short enough that nobody waits on a dead rig
+
+# Command name -> piece of device state it sets. The last command of each kind is replayed, in this order.
+STATE_COMMANDS = {
+    "init_cobalt": "cobalt",
+    "open_valve": "valve",
+    "start_hb": "hering_breuer",
+    "end_hb": "hering_breuer",
+    "start_camera_trig": "camera",
+    "stop_camera_trig": "camera",
+    "start_recording_ttl": "record",
+    "stop_recording_ttl": "record",
+    "upload_program": "program",
+}
+OLFACTOMETER_STATE = "olfactometer"
+REPLAY_ORDER = ["cobalt", "valve", "hering_breuer", OLFACTOMETER_STATE, "camera", "record", "program"]
+
+
+def is_link_lost(exception):
+    """
+    Whether a failed command means the link itself is gone, as opposed to the teensy not replying in time.
+
+    Serial and socket errors are OSErrors. AckTimeoutError is too (through TimeoutError), but a missing
+    acknowledgement on a working port is reported as is rather than reconnecting.
+    """
+    return isinstance(exception, OSError) and not isinstance(exception, AckTimeoutError)
+
+
+class DeviceJournal:
+    """
+    Last known device state, as the commands that set it.
+
+    Attributes:
+        state (dict): Piece of state (see REPLAY_ORDER) -> (command name, fields) of the command that set it last.
+        olfactometer_valves (int): Bit mask of the open olfactometer valves (bit 0 is valve 1), or None if no
+            olfactometer command was sent yet.
+    """
+
+    def __init__(self):
+        self.state = {}
+        self.olfactometer_valves = None
+
+    def record(self, name, fields):
+        """
+        Journal a command if it sets lasting device state.
+
+        Args:
+            name (str): Command name (see commands.py).
+            fields (dict): Field values of the command.
+        """
+        if name in STATE_COMMANDS:
+            self.state[STATE_COMMANDS[name]] = (name, dict(fields))
+            return
+        if name == "set_olfactometer_valves":
+            self.olfactometer_valves = fields["valves"]
+        elif name == "open_olfactometer":
+            self.olfactometer_valves = (self.olfactometer_valves or 0) | 1 << (fields["valve"] - 1)
+        elif name == "close_olfactometer":
+            self.olfactometer_valves = (self.olfactometer_valves or 0) & ~(1 << (fields["valve"] - 1))
+        else:
+            return
+        self.state[OLFACTOMETER_STATE] = ("set_olfactometer_valves", {"valves": self.olfactometer_valves})
+
+    def replay_commands(self):
+        """
+        Returns:
+            list: (command name, fields) that restore the journaled state, in REPLAY_ORDER.
+        """
+        return [self.state[key] for key in REPLAY_ORDER if key in self.state]
+
+
+class LinkSupervisor:
+    """
+    Reconnects a Controller whose link to the teensy dropped, and restores the device state from its journal.
+
+    Attributes:
+        controller (Controller): The supervised controller. Needs `port`, `journal`, `serial_port` and `_io`.
+        initial_backoff_sec (float): Wait before the second attempt to reopen the port. Doubles on every failure.
+        max_backoff_sec (float): Upper bound of the wait between attempts.
+        give_up_sec (float): Stop trying after this long without a link. None keeps trying forever.
+        recovering (bool): True while reconnecting, so that commands sent during recovery do not recurse.
+        outages (list): Dicts describing every outage recovered from.
+    """
+
+    def __init__(
+        self,
+        controller,
+        initial_backoff_sec=INITIAL_BACKOFF_SEC,
+        max_backoff_sec=MAX_BACKOFF_SEC,
+        give_up_sec=GIVE_UP_SEC,
+    ):
+        self.controller = controller
+        self.initial_backoff_sec = initial_backoff_sec
+        self.max_backoff_sec = max_backoff_sec
+        self.give_up_sec = give_up_sec
+        self.recovering = False
+        self.outages = []
+
+    def should_recover(self, exception):
+        """
+        Whether a failed command should trigger a reconnect.
+        """
+        return not self.recovering and is_link_lost(exception)
+
+    def recover(self, exception, command_name):
+        """
+        Reopen the port with backoff, restore the journaled device state and log the outage. Blocks until the
+        link is back.
+
+        Args:
+            exception (Exception): The error that revealed the lost link.
+            command_name (str): The command that failed. It is not replayed here; the caller sends it again.
+
+        Returns:
+            float: Seconds from the failure to a restored device.
+
+        Raises:
+            Exception: The original error, if the link is not back within give_up_sec.
+        """
+        controller = self.controller
+        lost_time = controller.clock.now()
+        print(f"Lost the link to the teensy at {command_name} ({exception}). Reconnecting...")
+        self.recovering = True
+        try:
+            self._close_link()
+            backoff = self.initial_backoff_sec
+            n_attempts = 0
+            while True:
+                n_attempts += 1
+                try:
+                    self._reopen()
+                    break
+                except Exception as e:
+                    self._close_link()
+                    if self.give_up_sec is not None and controller.clock.now() - lost_time > self.give_up_sec:
+                        controller.IS_CONNECTED = False
+                        print(f"Could not reconnect to the teensy within {self.give_up_sec:.0f}s: {e}")
+                        raise exception
+                    controller.clock.sleep(backoff)
+                    backoff = min(2 * backoff, self.max_backoff_sec)
+        finally:
+            self.recovering = False
+
+        time_to_recover = controller.clock.now() - lost_time
+        outage = dict(
+            failed_command=command_name,
+            error=str(exception),
+            n_attempts=n_attempts,
+            time_to_recover=time_to_recover,
+        )
+        self.outages.append(outage)
+        controller.make_log_entry(
+            "link_outage", "event", start_time=lost_time, end_time=lost_time + time_to_recover, **outage
+        )
+        print(f"Reconnected to the teensy and restored its state after {time_to_recover:.2f}s ({n_attempts} attempts)")
+        return time_to_recover
+
+    def _close_link(self):
+        """
+        Stop the serial I/O and close the dead port, ignoring the errors a dead port raises.
+        """
+        controller = self.controller
+        try:
+            controller._io.stop()
+        except Exception:
+            pass
+        try:
+            controller.serial_port.close()
+        except Exception:
+            pass
+
+    def _reopen(self):
+        """
+        One attempt: open the port, negotiate the protocol and replay the journal.
+        """
+        controller = self.controller
+        controller.serial_port = open_transport(controller.port)
+        # The firmware may have been reflashed while it was away
+        controller.protocol_version = 1
+        controller._start_io()
+        controller._negotiate_protocol()
+        for name, fields in controller.journal.replay_commands():
+            controller.submit(name, **fields).result()
@@ -0,0 +1,307 @@
+"""
+Randomized and counterbalanced parameter sweeps over a Controller stimulus method, scheduled before they run.
+
+Nested loops over frequency, amplitude, pulse width, ... present the conditions in the same order every time, so
+order effects are confounded with the parameters, and nobody knows how long the sweep will take. A Sweep crosses
+the parameter values into conditions, orders them in blocks, and lays out the whole schedule before anything is
+sent:
+
+    sweep = Sweep(
+        "run_train",
+        params=dict(freq=[4, 6, 8, 10, 12, 14], amp=[0.4, 0.8]),
+        fixed=dict(duration_sec=15, pulse_duration_sec=0.025),
+        n_blocks=5,
+        order="latin",
+        interval_sec=45,
+        seed=2024,
+    )
+    print(sweep.report())  # trials, estimated wall time, problems
+    controller.run_sweep(sweep)
+
+Every block presents every condition once, in an order given by `order`:
+    factorial - the order of the nested loops, the same in every block.
+    shuffled  - a new random order in every block.
+    latin     - the rows of a Williams design, a Latin square in which every condition follows every other
+                condition equally often (twice as many rows when the number of conditions is odd). The
+                conditions are assigned to the square at random. Counterbalanced if n_blocks is a multiple of the
+                number of rows.
+
+Trials start on a fixed grid, `interval_sec` apart (see scheduler.py), and every trial is checked and timed with
+the protocol compiler (see protocol.py), so a condition that does not fit the firmware or the interval is found
+before the sweep starts. The random orders come from `seed`, drawn at random and kept if none is given. The
+Controller saves the sweep definition, the seed and the schedule next to the log (see sweep_filename), and
+Sweep.load rebuilds the exact same schedule from that file.
+"""
+
+import itertools
+import json
+from pathlib import Path
+
+import numpy as np
+
+from protocol import STEPS, Protocol, ProtocolError
+
+ORDERS = ["factorial", "shuffled", "latin"]
+
+
+def sweep_filename(log_filename, name):
+    """
+    Schedule of sweep `name` that goes with a log table, e.g. _cibbrig_sweep.<name>.<run>.g0.t0.json
+    """
+    return str(log_filename).replace("_log.table.", f"_sweep.{name}.").replace(".tsv", ".json")
+
+
+def williams_square(n_conditions):
+    """
+    Rows of a Williams design: a Latin square in which every condition is preceded by every other condition equally
+    often. With an odd number of conditions, that takes the square and its mirror image.
+
+    Returns:
+        list: Orders of range(n_conditions), n_conditions of them if it is even, twice as many if it is odd.
+    """
+    first = [0]
+    low, high = 1, n_conditions - 1
+    for ii in range(1, n_conditions):
+        if ii % 2:
+            first.append(low)
+            low += 1
+        else:
+            first.append(high)
+            high -= 1
+    rows = [[(condition + shift) % n_conditions for condition in first] for shift in range(n_conditions)]
+    if n_conditions % 2:
+        rows += [row[::-1] for row in rows]
+    return rows
+
+
+class Sweep:
+    """
+    A parameter sweep over one Controller stimulus method.
+
+    Attributes:
+        method (str): Controller method to call, e.g. run_train. Must be a protocol step (see protocol.STEPS).
+        params (dict): Parameter name -> values to sweep. Conditions are all their combinations.
+        fixed (dict): Arguments passed to every trial.
+        n_blocks (int): Number of blocks. Each presents every condition once.
+        order (str): Order of the conditions within blocks, one of ORDERS.
+        interval_sec (float): Time from the onset of a trial to the onset of the next one.
+        seed (int): Seed of the random orders.
+        name (str): Name of the sweep, in the saved file name.
+        conditions (list): Parameter dicts of the conditions, in factorial order.
+        order_index (np.ndarray): Condition index of every trial, in the order they run.
+    """
+
+    def __init__(
+        self, method, params, fixed=None, n_blocks=1, order="shuffled", interval_sec=30.0, seed=None, name=None
+    ):
+        """
+        Args:
+            method (str): Controller method to call, e.g. "run_train".
+            params (dict): Parameter name -> list of values to sweep.
+            fixed (dict, optional): Arguments passed to every trial. Defaults to none.
+            n_blocks (int, optional): Number of blocks. Defaults to 1.
+            order (str, optional): "factorial", "shuffled" or "latin". Defaults to "shuffled".
+            interval_sec (float, optional): Onset to onset time of the trials. Defaults to 30.
+            seed (int, optional): Seed of the random orders. Defaults to a new random seed, which is kept.
+            name (str, optional): Name of the sweep. Defaults to the method.
+
+        Raises:
+            ValueError: If the method is not a protocol step, an order is unknown or a parameter is swept and fixed.
+        """
+        if method not in STEPS:
+            raise ValueError(f"Cannot sweep {method!r}, it must be one of {sorted(STEPS)}")
+        if order not in ORDERS:
+            raise ValueError(f"Order must be one of {ORDERS}, not {order!r}")
+        fixed = dict(fixed or {})
+        both = set(params) & set(fixed)
+        if both:
+            raise ValueError(f"{sorted(both)} are both swept and fixed")
+        if not params or any(len(values) == 0 for values in params.values()):
+            raise ValueError("Every swept parameter needs at least one value")
+        self.method = method
+        self.params = {param: list(values) for param, values in params.items()}
+        self.fixed = fixed
+        self.n_blocks = n_blocks
+        self.order = order
+        self.interval_sec = interval_sec
+        self.seed = int(np.random.SeedSequence().entropy) if seed is None else int(seed)
+        self.name = name or method
+        self.conditions = [dict(zip(self.params, values)) for values in itertools.product(*self.params.values())]
+        self.order_index = self._order()
+        self._durations_ms = None
+        self._errors = None
+        self._warnings = None
+
+    def _order(self):
+        n_conditions = len(self.conditions)
+        rng = np.random.default_rng(self.seed)
+        if self.order == "factorial":
+            blocks = [np.arange(n_conditions)] * self.n_blocks
+        elif self.order == "shuffled":
+            blocks = [rng.permutation(n_conditions) for _ in range(self.n_blocks)]
+        else:
+            rows = williams_square(n_conditions)
+            if self.n_blocks % len(rows):
+                print(
+                    f"Warning: {self.n_blocks} blocks do not counterbalance {n_conditions} conditions, "
+                    f"that takes a multiple of {len(rows)}"
+                )
+            labels = rng.permutation(n_conditions)
+            blocks = [labels[rows[block % len(rows)]] for block in range(self.n_blocks)]
+        return np.concatenate(blocks).astype(int)
+
+    def __len__(self):
+        return len(self.order_index)
+
+    def trials(self):
+        """
+        Returns:
+            list: Keyword arguments of every trial, in the order they run.
+        """
+        return [dict(self.fixed, **self.conditions[condition]) for condition in self.order_index]
+
+    def compile(self, gas_map=None, odor_map=None, settle_time_sec=None):
+        """
+        Check every condition with the protocol compiler and time it.
+
+        Args:
+            gas_map (dict, optional): Gas map to check present_gas against, e.g. the Controller's.
+            odor_map (dict, optional): Odor map to check present_odor against, e.g. the Controller's.
+            settle_time_sec (float, optional): For settle. Defaults to the protocol default.
+
+        Returns:
+            list: Problems found, one string each. The sweep can only run without any.
+        """
+        self._durations_ms = []
+        self._errors = []
+        self._warnings = []
+        compile_kwargs = dict(gas_map=gas_map, odor_map=odor_map)
+        if settle_time_sec is not None:
+            compile_kwargs.update(settle_time_sec=settle_time_sec)
+        interval_ms = round(self.interval_sec * 1000)
+        for index, condition in enumerate(self.conditions):
+            timeline = Protocol(self.name, [{self.method: dict(self.fixed, **condition)}]).compile(**compile_kwargs)
+            self._durations_ms.append(timeline.total_ms)
+            self._errors += [f"condition {index} {condition}: {error}" for error in timeline.errors]
+            self._warnings += timeline.warnings
+            if not timeline.errors and timeline.total_ms > interval_ms:
+                self._errors.append(
+                    f"condition {index} {condition}: takes {timeline.total_ms} ms, longer than the "
+                    f"{interval_ms} ms interval"
+                )
+        self._warnings = list(dict.fromkeys(self._warnings))
+        return self._errors
+
+    @property
+    def errors(self):
+        if self._errors is None:
+            self.compile()
+        return self._errors
+
+    @property
+    def total_sec(self):
+        """
+        Estimated wall time: the sweep ends one interval after the onset of its last trial.
+        """
+        return len(self) * self.interval_sec
+
+    def schedule(self):
+        """
+        The whole sweep, one record per trial.
+
+        Returns:
+            np.recarray: trial, block, position (in its block), condition, the swept parameters, onset_sec (from
+                the start of the sweep) and duration_sec (of the trial itself).
+        """
+        if self._durations_ms is None:
+            self.compile()
+        n_conditions = len(self.conditions)
+        trials = np.arange(len(self))
+        columns = dict(
+            trial=trials,
+            block=trials // n_conditions,
+            position=trials % n_conditions,
+            condition=self.order_index,
+        )
+        for param in self.params:
+            columns[param] = np.array([self.conditions[condition][param] for condition in self.order_index])
+        columns.update(
+            onset_sec=trials * self.interval_sec,
+            duration_sec=np.array(self._durations_ms)[self.order_index] / 1000,
+        )
+        return np.rec.fromarrays(list(columns.values()), names=list(columns))
+
+    def report(self):
+        """
+        Returns:
+            str: Number of trials and conditions, the estimated wall time, and any problems.
+        """
+        errors = self.errors
+        minutes, seconds = divmod(self.total_sec, 60)
+        lines = [
+            f"Sweep {self.name}: {self.method} over {', '.join(self.params)}, {len(self.conditions)} conditions x "
+            f"{self.n_blocks} blocks = {len(self)} trials, {self.order} order (seed {self.seed})",
+            f"  every {self.interval_sec}s, estimated {int(minutes)}m{seconds:04.1f}s "
+            f"({1000 * self.total_sec:.0f} ms)",
+        ]
+        lines += [f"ERROR: {error}" for error in errors]
+        lines += [f"Warning: {warning}" for warning in self._warnings]
+        return "\n".join(lines)
+
+    def check(self, gas_map=None, odor_map=None, settle_time_sec=None):
+        """
+        Compile against the given maps, e.g. the Controller's.
+
+        Raises:
+            ProtocolError: If any condition does not compile or does not fit the interval.
+        """
+        errors = self.compile(gas_map, odor_map, settle_time_sec)
+        if errors:
+            raise ProtocolError(errors)
+
+    def to_dict(self, start_time=None):
+        """
+        Everything needed to rebuild the sweep, and its schedule.
+
+        Args:
+            start_time (float, optional): Controller clock time of the onset of the first trial, if it ran.
+        """
+        schedule = self.schedule()
+        return dict(
+            name=self.name,
+            method=self.method,
+            params=self.params,
+            fixed=self.fixed,
+            n_blocks=self.n_blocks,
+            order=self.order,
+            interval_sec=self.interval_sec,
+            seed=self.seed,
+            start_time=start_time,
+            total_sec=self.total_sec,
+            schedule=[
+                {name: schedule[name][ii].item() for name in schedule.dtype.names} for ii in range(len(schedule))
+            ],
+        )
+
+    @classmethod
+    def from_dict(cls, spec):
+        """
+        Rebuild a sweep from to_dict, with the same schedule.
+        """
+        return cls(
+            spec["method"],
+            spec["params"],
+            fixed=spec["fixed"],
+            n_blocks=spec["n_blocks"],
+            order=spec["order"],
+            interval_sec=spec["interval_sec"],
+            seed=spec["seed"],
+            name=spec["name"],
+        )
+
+    @classmethod
+    def load(cls, path):
+        """
+        Rebuild a sweep from the file saved next to a log.
+        """
+        return cls.from_dict(json.loads(Path(path).read_text()))
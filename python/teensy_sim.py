@@ -0,0 +1,722 @@
+"""
+Software stand-in for the teensy32 firmware on a Linux pseudo-terminal.
+
+The simulator opens a pty and answers on the slave end with the same byte protocol as
+`teensy32_firmware.ino`, so a `Controller` can be pointed at it instead of a real Teensy:
+
+    from teensy_sim import TeensySimulator
+    from nebPod import Controller
+
+    sim = TeensySimulator()
+    sim.start()
+    controller = Controller(sim.port)
+
+With loopback=True the simulator is served in-process instead, without a pty or any system calls, which
+measures only host-side overhead:
+
+    sim = TeensySimulator(loopback=True).start()
+    controller = Controller(None, transport=sim.transport)
+
+Commands hold the acknowledgement for as long as the firmware would be busy (e.g. a train blocks for its
+full duration), which makes the simulator useful for timing the host side.
+
+The simulator is also the reference implementation of the device side of protocols v2 to v4 (see
+commands.py): frames starting with FRAME_START carry a sequence id that is echoed in the reply with a status
+code, timed frames (FRAME_START_TIMED) are also answered with the device micros() at the command's onset, and
+legacy v1 messages are acknowledged with a single ACK byte. v4 adds stimulus programs, which the simulator runs
+from its own clock like the firmware, streaming a completion record for every step (see stim_program.py). Pass
+protocol_version=1, 2 or 3 to emulate older firmware.
+
+The device clock runs off the host's perf_counter, with a drift and an offset that can be set to exercise
+clock synchronization (see clock_sync.py). `onsets` records the true host time of every onset, including every
+step of a stimulus program, under the step's opcode.
+
+Pass the Controller's clock to run the firmware on it instead: with a ManualClock, a command that keeps the
+firmware busy moves the clock to the end of its duration rather than sleeping, so a whole session runs in
+seconds with the timestamps it would have for real (see dry_run.py).
+
+The whole firmware command set is implemented:
+    v    - open a gas valve
+    p    - single opto pulse
+    t    - opto train
+    m    - manual GPIO (pulse, low, high)
+    a    - auxiliary: phasic stims (a p), tagging (a t), tones (a a), audio synch (a s), camera trigger (a v),
+           phasic Hering Breuer (a h), protocol version query (a V), clock ping (a C)
+    r    - record control
+    x    - stimulus programs: upload (x u) and run (x r)
+    h    - Hering Breuer valve
+    o    - opto utilities (laser on/off, poll the photometer)
+    c m  - modify the cobalt object
+    s    - forward a command to the olfactometer
+Any other command class is consumed and acknowledged, as the firmware does for unknown commands. Phasic
+stimulations have no breathing signal to follow, so they only take as long as the firmware would.
+
+`unplug` pulls the pty out from under the host and brings the teensy back on a new one, reset to its
+power-on state, to exercise reconnecting (see supervisor.py).
+
+To run scripts against a simulator, start one from the command line and use the printed port (or --link):
+
+    python teensy_sim.py --link /tmp/teensy --time-scale 0.1
+"""
+
+import argparse
+import math
+import os
+import queue
+import random
+import select
+import struct
+import threading
+import time
+import tty
+
+from transports import LoopbackTransport
+from commands import (
+    FRAME_START,
+    FRAME_START_TIMED,
+    MAX_PROGRAM_STEPS,
+    MAX_REPLY_PAYLOAD,
+    PROGRAM_STEP_FIELDS,
+    PROTOCOL_VERSION,
+    RECORD_START,
+    REPLY_START,
+    REPLY_START_TIMED,
+    STATUS_NO_PROGRAM,
+    STATUS_OK,
+    STATUS_OLFACTOMETER_TIMEOUT,
+    STATUS_UNKNOWN_COMMAND,
+    WIRE_TYPES,
+)
+
+ACK = 255
+SIGM_RISETIME_SEC = 0.002  # Cobalt::SIGM_RISETIME
+POLL_LASER_POWER_SEC = 0.1 + 20 * 0.005  # Cobalt::poll_laser_power
+TAGGING_IPI_SEC = 5.0  # Cobalt::run_10ms_tagging
+SYNCH_USV_SEC = 0.35 + 0.35 + 0.75  # Tbox::syncUSV
+OLFACTOMETER_RESPONSE_SEC = 0.005
+OLFACTOMETER_TIMEOUT_SEC = 1.0  # processCommandS
+NUM_VALVES = 5
+NUM_GP_PINS = 2
+SPIN_SEC = 0.002  # Program steps are waited for by sleeping, then spinning for the last stretch like the firmware
+HOST_CATCH_UP_SEC = 0.1  # With a virtual clock, longest real wait for the host to read the replies sent so far
+HOST_STAMP_SEC = 0.001  # and to time them
+PROGRAM_STEP = struct.Struct("<" + "".join(WIRE_TYPES[wire_type][0] for _, wire_type in PROGRAM_STEP_FIELDS))
+
+
+class TeensySimulator:
+    """
+    Simulated teensy32 firmware served on a pseudo-terminal.
+
+    Attributes:
+        port (str): Path to pass to Controller as the serial port: the link if one was given, otherwise the pty
+            slave. None with loopback.
+        link (str): Symlink to the current pty, or None.
+        transport (LoopbackTransport): Host end of the in-process link if loopback is used, otherwise None.
+        valve (int): Currently open gas valve.
+        cobalt_mode (str): Cobalt mode ('S' or 'B').
+        null_voltage (float): Cobalt null voltage.
+        laser_on (bool): Whether the laser is on.
+        photometer_value (int): Synthetic reading returned by `o p`.
+        gpio (list): Level of each general purpose output pin.
+        recording (bool): Whether the record pin is high.
+        hering_breuer (bool): Whether the Hering Breuer valve is closed.
+        camera_fps (int): Frame rate of the camera trigger, or None if it is stopped.
+        olfactometer_valves (int): Bit mask of the open olfactometer valves (bit 0 is valve 1).
+        olfactometer_connected (bool): If False, olfactometer commands time out like they do with nothing on Serial3.
+        tones (list): (frequency, duration ms) of every tone played.
+        commands (list): (command, arrival time) of every command received.
+        protocol_version (int): Protocol version of the simulated firmware.
+        time_scale (float): Factor applied to every firmware-side duration.
+        drift_ppm (float): How much faster the device clock runs than the host's, in parts per million.
+        onsets (list): (command, host time.perf_counter_ns(), or clock.now_ns() with a clock) of every onset
+            reported in a timed reply, and of every program step (under its opcode).
+        program (list): Steps of the uploaded stimulus program, as unpacked PROGRAM_STEP_FIELDS, or None.
+    """
+
+    def __init__(
+        self,
+        photometer_value=1234,
+        protocol_version=PROTOCOL_VERSION,
+        latency_sec=0.0,
+        olfactometer_connected=True,
+        time_scale=1.0,
+        loopback=False,
+        link=None,
+        drift_ppm=0.0,
+        micros_at_start=0,
+        latency_jitter_sec=0.0,
+        request_latency_sec=0.0,
+        clock=None,
+    ):
+        """
+        Open the pty. The simulator does not answer until `start` is called.
+
+        Args:
+            photometer_value (int, optional): Synthetic photometer read returned by `o p`. Defaults to 1234.
+            protocol_version (int, optional): 1 to emulate firmware without sequence-numbered frames, 2 for firmware
+                without onset times, 3 for firmware without stimulus programs. Defaults to 4.
+            latency_sec (float, optional): Round trip latency of the USB link added to every reply, without
+                holding up the next command (e.g. 0.001 for full-speed USB polling). Defaults to 0.
+            olfactometer_connected (bool, optional): Whether an olfactometer answers forwarded commands. Defaults to True.
+            time_scale (float, optional): Scale firmware-side durations, e.g. 0.1 to soak test a script ten
+                times faster than real time. Defaults to 1.
+            loopback (bool, optional): Serve the firmware in-process on `transport` instead of on a pty. Defaults to False.
+            link (str, optional): Also make the pty available at this path (symlink), which stays the same when the
+                simulator is unplugged and plugged back in. Defaults to None.
+            drift_ppm (float, optional): Drift of the device clock against the host's. Defaults to 0.
+            micros_at_start (int, optional): micros() at power on, e.g. close to 2**32 to have it wrap. Defaults to 0.
+            latency_jitter_sec (float, optional): Random extra reply latency, uniform up to this. Defaults to 0.
+            request_latency_sec (float, optional): Time for a command to reach the firmware once written. Commands
+                are delayed one at a time, so only use it with one command in flight. Defaults to 0.
+            clock (SessionClock, optional): Clock to run the firmware on, e.g. the Controller's ManualClock (see
+                clock.py). The device clock and every firmware-side duration then follow it. Defaults to the
+                host's perf_counter and real sleeps.
+        """
+        self.clock = clock
+        self.link = link
+        if loopback:
+            self.transport = LoopbackTransport()
+            self.master_fd = self.slave_fd = None
+            self.port = None
+        else:
+            self.transport = None
+            self._open_pty()
+        self.photometer_value = photometer_value
+        self.drift_ppm = drift_ppm
+        self.micros_at_start = micros_at_start
+        self.onsets = []
+        self._power_on()
+        self.olfactometer_valves = 0
+        self.olfactometer_connected = olfactometer_connected
+        self.tones = []
+        self.time_scale = time_scale
+        self.commands = []
+        self.protocol_version = protocol_version
+        self.reply_status = STATUS_OK
+        self.reply_payload = bytearray()
+        self.latency_sec = latency_sec
+        self.latency_jitter_sec = latency_jitter_sec
+        self.request_latency_sec = request_latency_sec
+        self._random = random.Random(0)
+        self._onset_ns = 0
+        self._seq = 0
+        self._delayed = queue.Queue()
+        self._buffer = bytearray()
+        self._running = False
+        self._thread = None
+        self._handlers = {
+            "v": self._command_v,
+            "p": self._command_p,
+            "t": self._command_t,
+            "m": self._command_m,
+            "a": self._command_a,
+            "r": self._command_r,
+            "h": self._command_h,
+            "o": self._command_o,
+            "c": self._command_c,
+            "s": self._command_s,
+            "x": self._command_x,
+        }
+
+    def _open_pty(self):
+        self.master_fd, self.slave_fd = os.openpty()
+        tty.setraw(self.slave_fd)
+        self.port = os.ttyname(self.slave_fd)
+        if self.link is not None:
+            if os.path.islink(self.link):
+                os.remove(self.link)
+            os.symlink(self.port, self.link)
+            self.port = self.link
+
+    def _power_on(self):
+        """
+        Device state after a reset. The olfactometer is a separate board on Serial3 and keeps its valves.
+        """
+        self.valve = 0
+        self.cobalt_mode = "S"
+        self.power_meter_pin = 16
+        self.null_voltage = 0.3
+        self.laser_on = False
+        self.gpio = [0] * NUM_GP_PINS
+        self.recording = False
+        self.hering_breuer = False
+        self.camera_fps = None
+        self.program = None
+        self._boot_ns = self._now_ns()
+
+    def start(self):
+        """
+        Start answering commands on a background thread.
+        """
+        self._delayed = queue.Queue()
+        self._running = True
+        self._thread = threading.Thread(target=self._run, name="TeensySimulator", daemon=True)
+        self._thread.start()
+        if self.latency_sec > 0 or self.latency_jitter_sec > 0:
+            threading.Thread(target=self._run_delayed, name="TeensySimulatorLink", daemon=True).start()
+        return self
+
+    def stop(self):
+        """
+        Stop the simulator and close the pty.
+        """
+        self._running = False
+        if self._thread is not None:
+            self._thread.join()
+        self._delayed.put(None)
+        if self.transport is None:
+            os.close(self.master_fd)
+            os.close(self.slave_fd)
+            if self.link is not None and os.path.islink(self.link):
+                os.remove(self.link)
+
+    def unplug(self, duration_sec=0.0):
+        """
+        Yank the USB cable: the pty goes away under the host, and after `duration_sec` the teensy comes back
+        with its power-on state on a new pty. Pass `link` to the constructor so that the host can find it again.
+
+        Args:
+            duration_sec (float, optional): How long the teensy stays unplugged. Defaults to 0.
+        """
+        assert self.transport is None, "Only a simulator served on a pty can be unplugged"
+        self.stop()
+        time.sleep(duration_sec)
+        self._buffer = bytearray()
+        self._power_on()
+        self._open_pty()
+        self.start()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+    # ------------------------------------- #
+    # Serial helpers
+    # ------------------------------------- #
+    def _fill(self):
+        """
+        Wait for more bytes from the host. Returns False if the simulator was stopped.
+        """
+        while self._running:
+            if self.transport is not None:
+                data = self.transport.device_read(0.1)
+                if data:
+                    self._buffer += data
+                    return True
+                continue
+            ready, _, _ = select.select([self.master_fd], [], [], 0.1)
+            if ready:
+                self._buffer += os.read(self.master_fd, 4096)
+                return True
+        return False
+
+    def _read(self, n_bytes):
+        while len(self._buffer) < n_bytes:
+            if not self._fill():
+                raise EOFError
+        data = bytes(self._buffer[:n_bytes])
+        del self._buffer[:n_bytes]
+        return data
+
+    def read_char(self):
+        return self._read(1).decode("latin-1")
+
+    def read_uint8(self):
+        return self._read(1)[0]
+
+    def read_uint16(self):
+        return struct.unpack("<H", self._read(2))[0]
+
+    def read_uint32(self):
+        return struct.unpack("<I", self._read(4))[0]
+
+    def write(self, data):
+        if self.latency_sec > 0 or self.latency_jitter_sec > 0:
+            latency_sec = self.latency_sec + self._random.uniform(0, self.latency_jitter_sec)
+            self._delayed.put((time.perf_counter() + latency_sec, data))
+        else:
+            self._write_now(data)
+
+    def _write_now(self, data):
+        if self.transport is not None:
+            self.transport.device_write(data)
+        else:
+            os.write(self.master_fd, data)
+
+    def _run_delayed(self):
+        while True:
+            item = self._delayed.get()
+            if item is None:
+                return
+            due, data = item
+            delay = due - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+            try:
+                self._write_now(data)
+            except OSError:
+                return
+
+    def write_uint8(self, value):
+        self.write(bytes([value]))
+
+    def reply_uint8(self, value):
+        """
+        Add a byte to the reply payload of the current command.
+        """
+        if len(self.reply_payload) < MAX_REPLY_PAYLOAD:
+            self.reply_payload.append(value)
+
+    def reply_uint16(self, value):
+        for byte in struct.pack("<H", value):
+            self.reply_uint8(byte)
+
+    def _now_ns(self):
+        return time.perf_counter_ns() if self.clock is None else self.clock.now_ns()
+
+    def _sleep(self, seconds, since_ns=None):
+        """
+        Stand in for the firmware blocking for `seconds` (already scaled), from `since_ns` or now.
+        """
+        if self.clock is None:
+            time.sleep(seconds)
+            return
+        self._let_host_catch_up()
+        # Up to a deadline, so time the host already waited through is not counted twice
+        since_ns = self._now_ns() if since_ns is None else since_ns
+        self.clock.sleep_until((since_ns + int(seconds * 1e9)) / 1e9)
+
+    def _let_host_catch_up(self):
+        """
+        Before moving a virtual clock on, let the host read and time the replies sent so far, as it would while a
+        real command is still running. Otherwise a reply that was due before the clock moved is timed after it.
+        """
+        if self.transport is None:
+            return
+        deadline = time.perf_counter() + HOST_CATCH_UP_SEC
+        while self.transport.in_waiting and time.perf_counter() < deadline:
+            time.sleep(0)
+        time.sleep(HOST_STAMP_SEC)
+
+    def micros(self, perf_counter_ns=None):
+        """
+        Device micros(), drifting against the host clock and wrapping at 2**32 like the firmware's.
+        """
+        perf_counter_ns = self._now_ns() if perf_counter_ns is None else perf_counter_ns
+        elapsed_us = (perf_counter_ns - self._boot_ns) / 1000 * (1 + self.drift_ppm * 1e-6)
+        return int(self.micros_at_start + elapsed_us) % 2**32
+
+    def mark_onset(self):
+        """
+        Mirrors markOnset in the firmware: the command takes effect now.
+        """
+        self._onset_ns = self._now_ns()
+
+    def send_reply(self, framed, seq, timed=False):
+        """
+        Mirrors sendReply in the firmware. The reply is written in one go, as the USB stack would.
+        """
+        if timed:
+            self.onsets.append((self.commands[-1][0], self._onset_ns))
+            header = bytes([REPLY_START_TIMED, seq, self.reply_status, len(self.reply_payload)])
+            onset = struct.pack("<I", self.micros(self._onset_ns))
+            self.write(header + onset + self.reply_payload)
+        elif framed:
+            header = bytes([REPLY_START, seq, self.reply_status, len(self.reply_payload)])
+            self.write(header + self.reply_payload)
+        else:
+            status = bytes([STATUS_OLFACTOMETER_TIMEOUT]) if self.reply_status == STATUS_OLFACTOMETER_TIMEOUT else b""
+            self.write(bytes(self.reply_payload) + status + bytes([ACK]))
+
+    def busy(self, duration_sec):
+        """
+        Stand in for the firmware being busy with a timed command, which takes effect now.
+        """
+        self.mark_onset()
+        if duration_sec > 0:
+            self._sleep(duration_sec * self.time_scale, since_ns=self._onset_ns)
+
+    # ------------------------------------- #
+    # Main loop (mirrors loop() in the firmware)
+    # ------------------------------------- #
+    def _run(self):
+        try:
+            while self._running:
+                # Instructions should always be at least two bytes
+                while len(self._buffer) < 2:
+                    if not self._fill():
+                        return
+                command_type = self.read_char()
+                timed = self.protocol_version >= 3 and ord(command_type) == FRAME_START_TIMED
+                framed = timed or (self.protocol_version >= 2 and ord(command_type) == FRAME_START)
+                seq = 0
+                if framed:
+                    seq = self.read_uint8()
+                    command_type = self.read_char()
+                self._seq = seq if framed else None
+                if self.request_latency_sec > 0:
+                    time.sleep(self.request_latency_sec)
+                self.reply_status = STATUS_OK
+                self.reply_payload = bytearray()
+                self.commands.append((command_type, time.time() if self.clock is None else self.clock.now()))
+                self.mark_onset()
+                handler = self._handlers.get(command_type)
+                if handler is not None:
+                    handler()
+                else:
+                    self.reply_status = STATUS_UNKNOWN_COMMAND
+                self.send_reply(framed, seq, timed)
+        except (EOFError, OSError):
+            return
+
+    # ------------------------------------- #
+    # Command classes
+    # ------------------------------------- #
+    def _command_v(self):
+        valve = self.read_uint8()
+        if 0 <= valve < NUM_VALVES:
+            self.valve = valve
+
+    def _pulse_sec(self, duration_ms):
+        ramps = 2 * SIGM_RISETIME_SEC if self.cobalt_mode == "S" else 0.0
+        return duration_ms / 1000 + ramps
+
+    def _train_sec(self, duration_ms, freq):
+        # Cobalt::train always finishes the period it started
+        period_sec = 1.0 / freq if freq > 0 else duration_ms / 1000
+        n_pulses = max(1, math.ceil(duration_ms / 1000 / period_sec))
+        return n_pulses * period_sec
+
+    def _command_p(self):
+        duration_ms = self.read_uint16()
+        self.read_uint8()  # amp
+        self.busy(self._pulse_sec(duration_ms))
+
+    def _command_t(self):
+        duration_ms = self.read_uint16()
+        freq = self.read_uint8()
+        self.read_uint8()  # amp
+        self.read_uint8()  # pulse duration
+        self.busy(self._train_sec(duration_ms, freq))
+
+    def _command_m(self):
+        subcommand = self.read_char()
+        duration_ms = self.read_uint16()
+        pin = self.read_uint8()
+        if not 0 <= pin < NUM_GP_PINS:
+            return
+        if subcommand == "p":
+            self.gpio[pin] = 1
+            self.busy(duration_ms / 1000)
+            self.gpio[pin] = 0
+        elif subcommand == "l":
+            self.gpio[pin] = 0
+        elif subcommand == "h":
+            self.gpio[pin] = 1
+
+    def _command_a(self):
+        subcommand = self.read_char()
+        if subcommand == "p":
+            self._run_phasic(amp=True)
+        elif subcommand == "t":
+            n = self.read_uint8()
+            self.busy(n * (self._pulse_sec(10) + TAGGING_IPI_SEC))
+        elif subcommand == "a":
+            freq = self.read_uint16()
+            duration_ms = self.read_uint16()
+            self.tones.append((freq, duration_ms))
+            self.busy(duration_ms / 1000)
+        elif subcommand == "s":
+            self.tones += [(1000, 100), (2000, 100), (5000, 500)]
+            self.busy(SYNCH_USV_SEC)
+        elif subcommand == "v":
+            camera_subcommand = self.read_char()
+            fps = self.read_uint8()
+            if camera_subcommand == "b":
+                self.camera_fps = fps
+            elif camera_subcommand == "e":
+                self.camera_fps = None
+        elif subcommand == "h":
+            self._run_phasic(amp=False)
+        elif subcommand == "V" and self.protocol_version >= 2:
+            self.reply_uint8(self.protocol_version)
+        elif subcommand == "C":
+            self.mark_onset()
+
+    def _run_phasic(self, amp):
+        """
+        Read a phasic stimulation (a p) or phasic Hering Breuer (a h) command and wait as long as the firmware would.
+        """
+        self.read_char()  # phase
+        mode = self.read_char()
+        n = self.read_uint8()
+        duration_ms = self.read_uint16()
+        intertrain_interval_ms = self.read_uint16()
+        if amp:
+            self.read_uint8()
+            if mode in ["p", "t"]:
+                self.read_uint8()  # pulse duration
+            if mode == "t":
+                self.read_uint8()  # freq
+        # runPhasic_HB does not read the pulse parameters of its (unimplemented) pulse and train modes
+        self.busy(n * (duration_ms + intertrain_interval_ms) / 1000)
+
+    def _command_r(self):
+        subcommand = self.read_char()
+        if subcommand == "b":
+            self.recording = True
+        elif subcommand == "e":
+            self.recording = False
+
+    def _command_h(self):
+        subcommand = self.read_char()
+        if subcommand == "b":
+            self.hering_breuer = True
+        elif subcommand == "e":
+            self.hering_breuer = False
+
+    def _command_o(self):
+        subcommand = self.read_char()
+        self.read_uint8()  # amp
+        if subcommand == "p":
+            self.busy(POLL_LASER_POWER_SEC)
+            self.reply_uint16(self.photometer_value)
+        elif subcommand == "o":
+            self.laser_on = True
+        elif subcommand == "x":
+            self.laser_on = False
+
+    def _command_c(self):
+        subcommand = self.read_char()
+        if subcommand == "m":
+            self.cobalt_mode = self.read_char()
+            self.power_meter_pin = self.read_uint8()
+            self.null_voltage = self.read_uint8() / 255
+
+    def _command_s(self):
+        subcommand = self.read_char()
+        valve = self.read_uint8()
+        if not self.olfactometer_connected:
+            self.busy(OLFACTOMETER_TIMEOUT_SEC)
+            self.reply_status = STATUS_OLFACTOMETER_TIMEOUT
+            return
+        if subcommand == "o" and 1 <= valve <= 8:
+            self.olfactometer_valves |= 1 << (valve - 1)
+        elif subcommand == "c" and 1 <= valve <= 8:
+            self.olfactometer_valves &= ~(1 << (valve - 1))
+        elif subcommand == "b":
+            self.olfactometer_valves = valve
+        self.busy(OLFACTOMETER_RESPONSE_SEC)
+
+    def _command_x(self):
+        if self.protocol_version < 4:
+            # Unknown to older firmware, which leaves the rest of the message in the buffer
+            self.reply_status = STATUS_UNKNOWN_COMMAND
+            return
+        subcommand = self.read_char()
+        if subcommand == "u":
+            n_steps = self.read_uint16()
+            steps = [PROGRAM_STEP.unpack(self._read(PROGRAM_STEP.size)) for _ in range(n_steps)]
+            self.program = steps[:MAX_PROGRAM_STEPS]
+        elif subcommand == "r":
+            duration_ms = self.read_uint32()
+            if self.program is None:
+                self.reply_status = STATUS_NO_PROGRAM
+                return
+            self._run_program(duration_ms)
+
+    def _sleep_until(self, deadline_ns):
+        if self.clock is not None:
+            self._let_host_catch_up()
+            self.clock.sleep_until(deadline_ns / 1e9)
+            return
+        remaining_sec = (deadline_ns - time.perf_counter_ns()) / 1e9
+        if remaining_sec > SPIN_SEC:
+            time.sleep(remaining_sec - SPIN_SEC)
+        while time.perf_counter_ns() < deadline_ns:
+            pass
+
+    def _run_program(self, duration_ms):
+        """
+        Mirrors runProgram in the firmware: start every step at its onset from the start of the program, stream
+        its completion record, and return once the program's duration is up.
+        """
+        self.mark_onset()
+        start_ns = self._onset_ns
+        ns_per_us = 1000 * self.time_scale
+        for index, (onset_us, opcode, arg0, arg1, arg2, arg3) in enumerate(self.program):
+            self._sleep_until(start_ns + onset_us * ns_per_us)
+            step_ns = self._now_ns()
+            opcode = opcode.decode("latin-1")
+            self.onsets.append((opcode, step_ns))
+            self._run_program_step(opcode, arg0, arg1, arg2, arg3)
+            if self._seq is not None:
+                self.write(bytes([RECORD_START, self._seq]) + struct.pack("<HI", index, self.micros(step_ns)))
+        self._sleep_until(start_ns + duration_ms * 1000 * ns_per_us)
+        self._onset_ns = start_ns
+
+    def _run_program_step(self, opcode, arg0, arg1, arg2, arg3):
+        """
+        Mirrors runProgramStep in the firmware. See STEP_TYPES in stim_program.py for the arguments.
+        """
+        if opcode == "p":
+            self._sleep(self._pulse_sec(arg0) * self.time_scale)
+        elif opcode == "t":
+            self._sleep(self._train_sec(arg0, arg1) * self.time_scale)
+        elif opcode in "ghl" and 0 <= arg2 < NUM_GP_PINS:
+            self.gpio[arg2] = 0 if opcode == "l" else 1
+            if opcode == "g":
+                self._sleep(arg0 / 1000 * self.time_scale)
+                self.gpio[arg2] = 0
+        elif opcode == "a":
+            self.tones.append((arg0, arg1))
+        elif opcode == "v" and 0 <= arg2 < NUM_VALVES:
+            self.valve = arg2
+        elif opcode == "b":
+            response_sec = OLFACTOMETER_RESPONSE_SEC if self.olfactometer_connected else OLFACTOMETER_TIMEOUT_SEC
+            if self.olfactometer_connected:
+                self.olfactometer_valves = arg2
+            self._sleep(response_sec * self.time_scale)
+        elif opcode == "c":
+            self.hering_breuer = True
+            self._sleep(arg0 / 1000 * self.time_scale)
+            self.hering_breuer = False
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Serve a simulated teensy32 firmware on a pseudo-terminal.")
+    parser.add_argument("--link", help="Also make the port available at this path (symlink)")
+    parser.add_argument("--protocol-version", type=int, default=PROTOCOL_VERSION)
+    parser.add_argument("--latency-ms", type=float, default=0.0, help="Simulated USB round trip latency")
+    parser.add_argument("--time-scale", type=float, default=1.0, help="Scale firmware-side durations")
+    parser.add_argument("--photometer", type=int, default=1234, help="Value returned when polling laser power")
+    parser.add_argument("--no-olfactometer", action="store_true", help="Olfactometer commands time out")
+    args = parser.parse_args()
+
+    sim = TeensySimulator(
+        photometer_value=args.photometer,
+        protocol_version=args.protocol_version,
+        latency_sec=args.latency_ms / 1000,
+        olfactometer_connected=not args.no_olfactometer,
+        time_scale=args.time_scale,
+        link=args.link,
+    )
+    sim.start()
+    print(f"Simulated teensy on {sim.port}. Ctrl+C to stop.")
+    n_seen = 0
+    try:
+        while True:
+            time.sleep(0.5)
+            for command_type, arrival in sim.commands[n_seen:]:
+                print(f"{time.strftime('%H:%M:%S', time.localtime(arrival))} {command_type}")
+            n_seen = len(sim.commands)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        sim.stop()
+
+
+if __name__ == "__main__":
+    main()
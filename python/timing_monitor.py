@@ -0,0 +1,154 @@
+"""
+Hold every command's acknowledgement time against how long the firmware should have been busy with it.
+
+Firmware-timed commands (trains, pulses, phasic stimulations, tones, polling the laser power) declare their
+duration in commands.py as a function of the field values that actually go over the wire. The monitor measures
+how long each command took from the moment the teensy could start it (the later of it being submitted and the
+previous command being acknowledged) to its acknowledgement, and flags:
+
+    overrun   - the acknowledgement came later than expected (e.g. the olfactometer timed out)
+    early     - the acknowledgement came sooner than expected (e.g. a stimulation was cut short in the firmware)
+    mismatch  - the duration the caller asked for is not what the encoded fields will make the firmware do
+                (e.g. a duration rounded or truncated on its way into a wire field)
+
+Flagged commands are printed when they happen and added to the Controller's log, with the measured slack,
+along with the next logged call. Latency percentiles per command are kept for the whole session:
+
+    controller.timing.percentiles()
+"""
+
+import collections
+import threading
+
+import numpy as np
+import pandas as pd
+
+from clock import SessionClock
+
+TOLERANCE_SEC = 0.02  # USB round trip and OS scheduling
+TOLERANCE_FRACTION = 0.02  # Cobalt trains finish the period they started
+MAX_SAMPLES = 10000  # Per command
+
+
+class TimingMonitor:
+    """
+    Measures the acknowledgement time of every submitted command and flags the ones that deviate from the
+    firmware's expected duration.
+
+    Attributes:
+        tolerance_sec (float): Deviation allowed on every command.
+        tolerance_fraction (float): Additional deviation allowed as a fraction of the expected duration.
+        latencies (dict): Command name -> deque of measured seconds from start to acknowledgement.
+        slack (dict): Command name -> deque of measured minus expected seconds.
+        n_flagged (collections.Counter): Flagged commands by kind (overrun, early, mismatch).
+        clock (SessionClock): Clock the acknowledgement times and the log times of flagged commands are read from.
+    """
+
+    def __init__(self, tolerance_sec=TOLERANCE_SEC, tolerance_fraction=TOLERANCE_FRACTION, clock=None):
+        self.clock = clock or SessionClock()
+        self.tolerance_sec = tolerance_sec
+        self.tolerance_fraction = tolerance_fraction
+        self.latencies = collections.defaultdict(lambda: collections.deque(maxlen=MAX_SAMPLES))
+        self.slack = collections.defaultdict(lambda: collections.deque(maxlen=MAX_SAMPLES))
+        self.n_flagged = collections.Counter()
+        self._flags = collections.deque()
+        self._last_ack = 0.0
+        self._lock = threading.Lock()
+
+    def allowed_sec(self, expected_sec):
+        """
+        Deviation from `expected_sec` that is not flagged.
+        """
+        return self.tolerance_sec + self.tolerance_fraction * expected_sec
+
+    def watch(self, command, values, requested_sec, future, submitted=None):
+        """
+        Start timing a command that was just submitted.
+
+        Args:
+            command (Command): The submitted command.
+            values (list): Its field values as sent.
+            requested_sec (float): How long the caller expects the command to run.
+            future (Future): Future of the command's reply.
+            submitted (float, optional): Clock time the command was submitted, read before it was written. On a
+                virtual clock, the simulated firmware may already have moved the clock past the command by the
+                time it is watched (see dry_run.py). Defaults to now.
+        """
+        submitted = self.clock.now() if submitted is None else submitted
+        expected_sec = command.expected_sec(values)
+        if command.duration is not None and abs(requested_sec - expected_sec) > self.allowed_sec(expected_sec):
+            now = self.clock.now()
+            self._flag("mismatch", command.name, now, now, requested_sec, expected_sec)
+        future.add_done_callback(lambda f: self._acknowledged(command.name, expected_sec, submitted, f))
+
+    def _acknowledged(self, name, expected_sec, submitted, future):
+        """
+        Runs in the serial I/O thread as each reply resolves, in the order the teensy ran the commands.
+        """
+        acked = self.clock.now()
+        with self._lock:
+            started = max(submitted, self._last_ack)
+            self._last_ack = acked
+        if future.cancelled() or future.exception() is not None:
+            return
+        measured_sec = acked - started
+        slack_sec = measured_sec - expected_sec
+        self.latencies[name].append(measured_sec)
+        self.slack[name].append(slack_sec)
+        if slack_sec > self.allowed_sec(expected_sec):
+            kind = "overrun"
+        elif slack_sec < -self.allowed_sec(expected_sec):
+            kind = "early"
+        else:
+            return
+        self._flag(kind, name, started, acked, measured_sec, expected_sec)
+
+    def _flag(self, kind, name, start_time, end_time, actual_sec, expected_sec):
+        """
+        Queue a flagged command for the log. actual_sec is the measured time, or the requested one for a mismatch.
+        """
+        self.n_flagged[kind] += 1
+        print(f"Timing {kind} at {name}: {actual_sec:.3f}s against {expected_sec:.3f}s expected")
+        self._flags.append(
+            dict(
+                label=f"timing_{kind}",
+                category="timing",
+                start_time=start_time,
+                end_time=end_time,
+                command=name,
+                expected_sec=expected_sec,
+                measured_sec=actual_sec,
+                slack_sec=actual_sec - expected_sec,
+            )
+        )
+
+    def pop_flags(self):
+        """
+        Returns:
+            list: Dicts describing the commands flagged since the last call, ready for a log entry.
+        """
+        flags = []
+        while self._flags:
+            flags.append(self._flags.popleft())
+        return flags
+
+    def percentiles(self, q=(50, 90, 99)):
+        """
+        Latency percentiles per command.
+
+        Args:
+            q (tuple, optional): Percentiles to compute. Defaults to (50, 90, 99).
+
+        Returns:
+            pd.DataFrame: One row per command with the number of samples, latency percentiles (p50, ...) and
+                the largest deviation from the expected duration, in seconds.
+        """
+        rows = {}
+        for name, latencies in list(self.latencies.items()):
+            latencies = np.array(latencies)
+            slack = np.array(self.slack[name])
+            row = dict(n=len(latencies))
+            row.update({f"p{p:g}": value for p, value in zip(q, np.percentile(latencies, q))})
+            row["max_abs_slack"] = np.abs(slack).max()
+            rows[name] = row
+        return pd.DataFrame.from_dict(rows, orient="index")
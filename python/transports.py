@@ -0,0 +1,348 @@
+"""
+Byte transports between the Controller and the teensy.
+
+Every transport offers the subset of the pyserial API that the serial I/O classes use:
+
+    write(data)      - send bytes in one call
+    read(n_bytes)    - wait up to `timeout` seconds for n_bytes, return what arrived
+    in_waiting       - number of bytes that can be read without waiting
+    timeout          - read timeout in seconds (None blocks)
+    fileno()         - selectable file descriptor, for AsyncController (optional)
+    close()
+
+Implementations:
+    ArCOMTransport     - the port opened by Sanworks' ArCOM (default, as before)
+    SerialTransport    - the port opened with pyserial directly, without ArCOM
+    TCPTransport       - a teensy on another machine, served with `python transports.py --serial COM11 --listen 5555`
+    LoopbackTransport  - in-process link to a device model (e.g. TeensySimulator(loopback=True)), no OS calls
+
+Controller(port) picks one from the port string (see open_transport):
+
+    Controller("COM11")                  # ArCOM
+    Controller("serial:///dev/ttyACM0")  # pyserial
+    Controller("tcp://rig-pc:5555")      # TCP
+    Controller(None, transport=sim.transport)
+"""
+
+import argparse
+import select
+import socket
+import threading
+import time
+
+DEFAULT_BAUDRATE = 115200
+DEFAULT_TCP_PORT = 5555
+
+
+class Transport:
+    """
+    Base class for byte transports. Subclasses implement the methods below.
+
+    Attributes:
+        timeout (float): Read timeout in seconds. None blocks until every requested byte has arrived.
+    """
+
+    timeout = None
+
+    def write(self, data):
+        raise NotImplementedError
+
+    def read(self, n_bytes=1):
+        raise NotImplementedError
+
+    @property
+    def in_waiting(self):
+        raise NotImplementedError
+
+    def fileno(self):
+        """
+        Raises:
+            NotImplementedError: If the transport has no selectable file descriptor.
+        """
+        raise NotImplementedError(f"{type(self).__name__} has no file descriptor")
+
+    def close(self):
+        pass
+
+
+class SerialTransport(Transport):
+    """
+    Serial port opened with pyserial. Frames go to the driver in a single write, without ArCOM's numpy conversions.
+
+    Attributes:
+        serial_object (serial.Serial): The pyserial object of the port.
+    """
+
+    def __init__(self, port, baudrate=DEFAULT_BAUDRATE, serial_object=None):
+        """
+        Args:
+            port (str): Serial port (e.g. COM11 or /dev/ttyACM0).
+            baudrate (int, optional): Defaults to 115200.
+            serial_object (serial.Serial, optional): Already open port to use instead of opening `port`.
+        """
+        if serial_object is None:
+            import serial
+
+            serial_object = serial.Serial(port, baudrate, timeout=10)
+        self.serial_object = serial_object
+
+    @property
+    def timeout(self):
+        return self.serial_object.timeout
+
+    @timeout.setter
+    def timeout(self, value):
+        self.serial_object.timeout = value
+
+    def write(self, data):
+        return self.serial_object.write(data)
+
+    def read(self, n_bytes=1):
+        return self.serial_object.read(n_bytes)
+
+    @property
+    def in_waiting(self):
+        return self.serial_object.in_waiting
+
+    def fileno(self):
+        return self.serial_object.fileno()
+
+    def close(self):
+        self.serial_object.close()
+
+
+class ArCOMTransport(SerialTransport):
+    """
+    Serial port opened by ArCOM. Reads and writes go to ArCOM's pyserial object directly.
+
+    Attributes:
+        arcom (ArCOMObject): The ArCOM object, for code that still uses its typed read/write.
+    """
+
+    def __init__(self, port, baudrate=DEFAULT_BAUDRATE):
+        """
+        Args:
+            port (str): Serial port (e.g. COM11).
+            baudrate (int, optional): Defaults to 115200.
+        """
+        from ArCOM import ArCOMObject
+
+        self.arcom = ArCOMObject(port, baudrate)
+        super().__init__(port, baudrate, serial_object=self.arcom.serialObject)
+
+
+class TCPTransport(Transport):
+    """
+    TCP connection to a teensy served from another machine (see serve_tcp).
+    """
+
+    def __init__(self, host, port=DEFAULT_TCP_PORT, connect_timeout=5.0):
+        """
+        Args:
+            host (str): Host name or address of the machine the teensy is plugged into.
+            port (int, optional): TCP port. Defaults to 5555.
+            connect_timeout (float, optional): Seconds to wait for the connection. Defaults to 5.
+        """
+        self.timeout = 10.0
+        self._socket = socket.create_connection((host, port), timeout=connect_timeout)
+        self._socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self._socket.settimeout(None)
+        self._rx = bytearray()
+
+    def write(self, data):
+        self._socket.sendall(data)
+        return len(data)
+
+    def _receive(self, timeout):
+        """
+        Move whatever arrives within `timeout` seconds into the receive buffer.
+        """
+        ready, _, _ = select.select([self._socket], [], [], timeout)
+        if not ready:
+            return
+        data = self._socket.recv(65536)
+        if not data:
+            raise ConnectionError("TCP connection to the teensy was closed")
+        self._rx += data
+
+    def read(self, n_bytes=1):
+        deadline = None if self.timeout is None else time.monotonic() + self.timeout
+        while len(self._rx) < n_bytes:
+            remaining = None if deadline is None else deadline - time.monotonic()
+            if remaining is not None and remaining <= 0:
+                break
+            self._receive(remaining)
+        data = bytes(self._rx[:n_bytes])
+        del self._rx[:n_bytes]
+        return data
+
+    @property
+    def in_waiting(self):
+        self._receive(0)
+        return len(self._rx)
+
+    def fileno(self):
+        return self._socket.fileno()
+
+    def close(self):
+        self._socket.close()
+
+
+class _ByteChannel:
+    """
+    One direction of a loopback link.
+    """
+
+    def __init__(self):
+        self._buffer = bytearray()
+        self._condition = threading.Condition()
+
+    def put(self, data):
+        with self._condition:
+            self._buffer += data
+            self._condition.notify_all()
+
+    def get(self, n_bytes, timeout):
+        """
+        Wait up to `timeout` seconds for n_bytes (None waits forever). Returns what arrived.
+        """
+        with self._condition:
+            self._condition.wait_for(lambda: len(self._buffer) >= n_bytes, timeout)
+            data = bytes(self._buffer[:n_bytes])
+            del self._buffer[:n_bytes]
+        return data
+
+    def get_available(self, timeout):
+        """
+        Wait up to `timeout` seconds for any bytes and return all of them.
+        """
+        with self._condition:
+            self._condition.wait_for(lambda: len(self._buffer) > 0, timeout)
+            data = bytes(self._buffer)
+            self._buffer.clear()
+        return data
+
+    def __len__(self):
+        return len(self._buffer)
+
+
+class LoopbackTransport(Transport):
+    """
+    In-process link between the host and a device model. Bytes are handed over in memory, with no system calls,
+    so timing a Controller against it measures only host-side overhead.
+
+    It is not zero-copy: write copies the frame into the channel's bytearray and read copies it out as bytes. The
+    writer may reuse its buffer as soon as write returns, as with a real port, so the channel cannot keep a view of
+    it. The copies cost about a microsecond per frame, far below what is being measured, and a benchmark that
+    copies nothing would flatter the host side compared with a real port, whose driver copies too.
+
+    The device side uses `device_read` and `device_write`.
+    """
+
+    def __init__(self):
+        self.timeout = 10.0
+        self._to_device = _ByteChannel()
+        self._to_host = _ByteChannel()
+
+    def write(self, data):
+        self._to_device.put(data)
+        return len(data)
+
+    def read(self, n_bytes=1):
+        return self._to_host.get(n_bytes, self.timeout)
+
+    @property
+    def in_waiting(self):
+        return len(self._to_host)
+
+    def device_read(self, timeout):
+        """
+        Device side: wait up to `timeout` seconds for bytes from the host and return all of them.
+        """
+        return self._to_device.get_available(timeout)
+
+    def device_write(self, data):
+        """
+        Device side: send bytes to the host.
+        """
+        self._to_host.put(data)
+
+
+def open_transport(port, baudrate=DEFAULT_BAUDRATE):
+    """
+    Open the transport for a port string.
+
+    Args:
+        port (str or Transport): "tcp://host:port", "serial://<port>" for pyserial, a plain serial port name for
+            ArCOM, or an already open Transport.
+        baudrate (int, optional): Baud rate of serial ports. Defaults to 115200.
+
+    Returns:
+        Transport: The open transport.
+    """
+    if isinstance(port, Transport):
+        return port
+    if port.startswith("tcp://"):
+        host, _, tcp_port = port[len("tcp://") :].partition(":")
+        return TCPTransport(host, int(tcp_port or DEFAULT_TCP_PORT))
+    if port.startswith("serial://"):
+        return SerialTransport(port[len("serial://") :], baudrate)
+    return ArCOMTransport(port, baudrate)
+
+
+def serve_tcp(transport, host="0.0.0.0", port=DEFAULT_TCP_PORT):
+    """
+    Relay a local transport (e.g. the teensy's serial port) to one TCP client at a time. Blocks forever.
+
+    Args:
+        transport (Transport): The local transport.
+        host (str, optional): Address to listen on. Defaults to all interfaces.
+        port (int, optional): TCP port. Defaults to 5555.
+    """
+    server = socket.create_server((host, port))
+    print(f"Serving on {host}:{port}")
+    transport.timeout = 0.1
+    while True:
+        client, address = server.accept()
+        client.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        print(f"Client connected from {address[0]}")
+        connected = threading.Event()
+        connected.set()
+
+        def to_client():
+            while connected.is_set():
+                try:
+                    data = transport.read(max(1, transport.in_waiting))
+                    if data:
+                        client.sendall(data)
+                except Exception as e:
+                    print(f"Relay stopped: {e}")
+                    break
+
+        relay = threading.Thread(target=to_client, daemon=True)
+        relay.start()
+        try:
+            while True:
+                data = client.recv(65536)
+                if not data:
+                    break
+                transport.write(data)
+        except OSError:
+            pass
+        connected.clear()
+        relay.join()
+        client.close()
+        print("Client disconnected")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Serve a teensy's serial port over TCP.")
+    parser.add_argument("--serial", required=True, help="Serial port of the teensy (e.g. COM11)")
+    parser.add_argument("--listen", type=int, default=DEFAULT_TCP_PORT, help="TCP port to listen on")
+    parser.add_argument("--baudrate", type=int, default=DEFAULT_BAUDRATE)
+    args = parser.parse_args()
+    serve_tcp(SerialTransport(args.serial, args.baudrate), port=args.listen)
+
+
+if __name__ == "__main__":
+    main()
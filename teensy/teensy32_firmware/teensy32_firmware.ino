@@ -19,6 +19,48 @@ const int statusPin = 22;
 const int numGpPins = 2;
 int gpPins[numGpPins] = {17,11};
 
+// Serial protocol
+// v1 (legacy): <command><subcommand><params...>, acknowledged with the single byte 255 after any payload bytes.
+// v2: 0xA5 <seq> <command><subcommand><params...>, answered with 0x5A <seq> <status> <len> <payload...>.
+// v3: 0xA6 <seq> <command><subcommand><params...>, answered with 0x5B <seq> <status> <len> <onset micros, uint32>
+//     <payload...>. The onset is micros() when the command took effect (e.g. the start of a pulse), which the host
+//     maps to its own clock (see clock_sync.py). 'aC' is a clock ping and does nothing else.
+// v4: stimulus programs. 'xu' <n steps, uint16> <steps...> uploads a program of timed steps, 'xr' <duration ms, uint32>
+//     runs it from micros() and streams 0x5C <seq> <step index, uint16> <onset micros, uint32> as each step starts
+//     (see stim_program.py). The reply comes once the duration is up, with the start of the program as its onset.
+// All are accepted at all times. 'aV' reports the protocol version so the host knows which frames are understood.
+const int PROTOCOL_VERSION = 4;
+const uint8_t FRAME_START = 0xA5;
+const uint8_t REPLY_START = 0x5A;
+const uint8_t FRAME_START_TIMED = 0xA6;
+const uint8_t REPLY_START_TIMED = 0x5B;
+const uint8_t RECORD_START = 0x5C;
+const uint8_t ACK = 255;
+const uint8_t STATUS_OK = 0;
+const uint8_t STATUS_UNKNOWN_COMMAND = 1;
+const uint8_t STATUS_NO_PROGRAM = 2;
+const uint8_t STATUS_OLFACTOMETER_TIMEOUT = 111;  // Also sent before the ack in v1
+const int MAX_REPLY_BYTES = 8;
+uint8_t replyStatus = STATUS_OK;
+uint8_t replyPayload[MAX_REPLY_BYTES];
+uint8_t replyLen = 0;
+uint32_t onsetMicros = 0;
+bool commandFramed = false;
+uint8_t commandSeq = 0;
+
+// Stimulus program (v4). The meaning of the arguments depends on the opcode (see runProgramStep)
+const int MAX_PROGRAM_STEPS = 256;
+struct ProgramStep {
+  uint32_t onsetMicros;  // From the start of the program
+  char opcode;
+  uint16_t arg0;
+  uint16_t arg1;
+  uint8_t arg2;
+  uint8_t arg3;
+};
+ProgramStep program[MAX_PROGRAM_STEPS];
+int programLength = -1;  // No program uploaded yet
+
 void setup() {
   SerialUSB.begin(115200);
   Serial2.begin(115200);
@@ -56,6 +98,18 @@ void loop() {
 
     // Get the command class
     char commandType = pyControl.readChar();
+    bool timed = (uint8_t)commandType == FRAME_START_TIMED;
+    bool framed = timed || (uint8_t)commandType == FRAME_START;
+    uint8_t seq = 0;
+    if (framed) {
+      seq = pyControl.readUint8();
+      commandType = pyControl.readChar();
+    }
+    commandFramed = framed;
+    commandSeq = seq;
+    replyStatus = STATUS_OK;
+    replyLen = 0;
+    markOnset(); // Commands that start something later (e.g. after reading their params) mark it again
 
     // Run the appropriate subcommand
     switch (commandType) {
@@ -89,16 +143,156 @@ void loop() {
       case 's': // Olfactometer ([S]mell)
         processCommandS();
         break;
+      case 'x': // Stimulus programs
+        processCommandX();
+        break;
 
       // Add more cases if needed
+      default:
+        replyStatus = STATUS_UNKNOWN_COMMAND;
+        break;
     }
     // Write back to the pycontroller to let it know we finished that command
-    pyControl.writeUint8(255);
+    sendReply(framed, timed, seq);
 
   }
 
 }
 
+void sendReply(bool framed, bool timed, uint8_t seq) {
+  if (framed) {
+    pyControl.writeUint8(timed ? REPLY_START_TIMED : REPLY_START);
+    pyControl.writeUint8(seq);
+    pyControl.writeUint8(replyStatus);
+    pyControl.writeUint8(replyLen);
+    if (timed) {
+      // Little endian, like replyUint16
+      for (int i = 0; i < 4; i++) {pyControl.writeUint8((onsetMicros >> (8 * i)) & 0xFF);}
+    }
+    for (int i = 0; i < replyLen; i++) {pyControl.writeUint8(replyPayload[i]);}
+  } else {
+    for (int i = 0; i < replyLen; i++) {pyControl.writeUint8(replyPayload[i]);}
+    if (replyStatus == STATUS_OLFACTOMETER_TIMEOUT) {pyControl.writeUint8(STATUS_OLFACTOMETER_TIMEOUT);}
+    pyControl.writeUint8(ACK);
+  }
+}
+
+void markOnset() {
+  onsetMicros = micros();
+}
+
+void replyUint8(uint8_t value) {
+  if (replyLen < MAX_REPLY_BYTES) {replyPayload[replyLen++] = value;}
+}
+
+void replyUint16(uint16_t value) {
+  // Little endian, like ArCOM::writeUint16
+  replyUint8(value & 0xFF);
+  replyUint8(value >> 8);
+}
+
+// Stimulus programs: upload, then run from micros()
+void processCommandX() {
+  char subcommand = pyControl.readChar();
+  switch (subcommand) {
+    case 'u': {
+      int n = pyControl.readUint16();
+      for (int i = 0; i < n; i++) {
+        ProgramStep step;
+        step.onsetMicros = pyControl.readUint32();
+        step.opcode = pyControl.readChar();
+        step.arg0 = pyControl.readUint16();
+        step.arg1 = pyControl.readUint16();
+        step.arg2 = pyControl.readUint8();
+        step.arg3 = pyControl.readUint8();
+        if (i < MAX_PROGRAM_STEPS) {program[i] = step;}
+      }
+      programLength = min(n, MAX_PROGRAM_STEPS);
+      break;
+    }
+    case 'r': {
+      uint32_t duration = pyControl.readUint32();
+      if (programLength < 0) {
+        replyStatus = STATUS_NO_PROGRAM;
+        break;
+      }
+      runProgram(duration);
+      break;
+    }
+  }
+}
+
+void runProgram(uint32_t duration) {
+  markOnset();
+  uint32_t start = onsetMicros;
+  uint32_t startMillis = millis();
+  for (int i = 0; i < programLength; i++) {
+    // Unsigned differences keep working when micros() wraps
+    while ((uint32_t)(micros() - start) < program[i].onsetMicros) {}
+    uint32_t stepMicros = micros();
+    runProgramStep(program[i]);
+    if (commandFramed) {sendRecord(i, stepMicros);}
+  }
+  while ((uint32_t)(millis() - startMillis) < duration) {}
+  onsetMicros = start;
+}
+
+void runProgramStep(ProgramStep &step) {
+  // Arguments as laid out by STEP_TYPES in stim_program.py. Durations in ms, amps in percent
+  switch (step.opcode) {
+    case 'p':
+      cobalt.pulse(amp2float(step.arg2), step.arg0);
+      break;
+    case 't':
+      cobalt.train(amp2float(step.arg2), float(step.arg1), step.arg3, step.arg0);
+      break;
+    case 'g':
+      if (step.arg2 < numGpPins) {
+        digitalWrite(gpPins[step.arg2], HIGH);
+        delay(step.arg0);
+        digitalWrite(gpPins[step.arg2], LOW);
+      }
+      break;
+    case 'h':
+      if (step.arg2 < numGpPins) {digitalWrite(gpPins[step.arg2], HIGH);}
+      break;
+    case 'l':
+      if (step.arg2 < numGpPins) {digitalWrite(gpPins[step.arg2], LOW);}
+      break;
+    case 'a':
+      tbox.playTone(step.arg0, step.arg1); // Plays in the background
+      break;
+    case 'v':
+      if (step.arg2 < numValves) {setValves(step.arg2);}
+      break;
+    case 'b':
+      setOlfactometerValves(step.arg2);
+      break;
+    case 'c':
+      tbox.hering_breuer_start();
+      delay(step.arg0);
+      tbox.hering_breuer_stop();
+      break;
+  }
+}
+
+void sendRecord(uint16_t index, uint32_t stepMicros) {
+  pyControl.writeUint8(RECORD_START);
+  pyControl.writeUint8(commandSeq);
+  pyControl.writeUint8(index & 0xFF);
+  pyControl.writeUint8(index >> 8);
+  for (int i = 0; i < 4; i++) {pyControl.writeUint8((stepMicros >> (8 * i)) & 0xFF);}
+}
+
+void setOlfactometerValves(uint8_t valves) {
+  // Like 'sb', without a status for the host
+  olfactometer.writeChar('b');
+  olfactometer.writeUint8(valves);
+  uint32_t t_wait_init = millis();
+  while (olfactometer.available()==0 && (millis()-t_wait_init)<=1000) {}
+  while (olfactometer.available()>0){olfactometer.readByte();}
+}
+
 //olfactometer (smell) Simply forward the command
 void processCommandS(){
   char subcommand = pyControl.readChar();
@@ -119,7 +313,7 @@ void processCommandS(){
   int t_wait_init = millis();
   while (olfactometer.available()==0){
     if ((millis()-t_wait_init)>1000){
-      pyControl.writeUint8(111);
+      replyStatus = STATUS_OLFACTOMETER_TIMEOUT;
       break;
     }
   } // Wait for response
@@ -157,7 +351,7 @@ void processCommandO(){ // opto utilities
   switch (subcommand){
     case 'p':
       power = cobalt.poll_laser_power(amp_f);
-      pyControl.writeUint16(power);
+      replyUint16(power);
       break;
     //poll
     case 'o':
@@ -205,6 +399,7 @@ void processCommandR() {
 void processCommandV() {
   int valveNumber = pyControl.readUint8();
   if (valveNumber >= 0 && valveNumber < numValves) {
+    markOnset();
     setValves(valveNumber);
   }
 }
@@ -215,6 +410,7 @@ void processCommandP() {
   int amp = pyControl.readUint8();
   float amp_f = amp2float(amp);
 
+  markOnset();
   cobalt.pulse(amp_f,duration);
 }
 
@@ -225,6 +421,7 @@ void processCommandT() {
   int amp = pyControl.readUint8();
   int pulse_dur = pyControl.readUint8();
   float amp_f = amp2float(amp);
+  markOnset();
   cobalt.train(amp_f,float(freq), pulse_dur, duration);
 }
 
@@ -241,6 +438,7 @@ void processCommandA() {
       playTone();
       break;
     case 's':
+      markOnset();
       tbox.syncUSV();
       break;
     case 'v':
@@ -249,6 +447,12 @@ void processCommandA() {
     case 'h':
       runPhasic_HB();
       break;
+    case 'V':
+      replyUint8(PROTOCOL_VERSION); // Protocol version query. v1 firmware only acks.
+      break;
+    case 'C':
+      markOnset(); // Clock ping: the onset is all the host needs
+      break;
 }
 }
 //Manual
@@ -257,6 +461,7 @@ void processCommandM() {
   int duration = pyControl.readUint16();
   int p = pyControl.readUint8();
   int usePin = gpPins[p];
+  markOnset();
   switch (subcommand) {
     case 'p':
       digitalWrite(usePin,HIGH);
@@ -293,6 +498,7 @@ void processCameraCommands(){
 void playTone() {
   int freq = pyControl.readUint16();
   int duration = pyControl.readUint16();
+  markOnset();
   tbox.playTone(freq,duration);
   delay(duration);
 }